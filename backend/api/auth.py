@@ -1,17 +1,19 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr, Field
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
 
 import models
 from database import get_db
 from security import (
+    PasswordHasherBusy,
     create_access_token,
     get_current_user,
-    get_password_hash,
     get_user_by_email,
-    verify_password,
+    password_hasher,
+    password_needs_rehash,
+    user_cache,
 )
 
 router = APIRouter(prefix="/auth", tags=["auth"])
@@ -24,6 +26,11 @@ class UserCreate(BaseModel):
     default_temperature: Optional[float] = None
 
 
+class UserSettingsUpdate(BaseModel):
+    default_top_p: Optional[float] = None
+    default_temperature: Optional[float] = None
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str = "bearer"
@@ -40,6 +47,14 @@ class UserResponse(BaseModel):
         from_attributes = True
 
 
+def _hasher_busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many authentication requests, please retry shortly",
+        headers={"Retry-After": "1"},
+    )
+
+
 def _clamp_top_p(value: Optional[float], fallback: float = 0.9) -> float:
     if value is None:
         return fallback
@@ -53,21 +68,26 @@ def _clamp_temperature(value: Optional[float], fallback: float = 0.7) -> float:
 
 
 @router.post("/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-def register_user(payload: UserCreate, db: Session = Depends(get_db)):
+async def register_user(payload: UserCreate, db: AsyncSession = Depends(get_db)):
     normalized_email = payload.email.lower()
-    existing_user = get_user_by_email(db, normalized_email)
+    existing_user = await get_user_by_email(db, normalized_email)
     if existing_user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
 
+    try:
+        hashed_password = await password_hasher.hash(payload.password)
+    except PasswordHasherBusy:
+        raise _hasher_busy()
+
     user = models.User(
         email=normalized_email,
-        hashed_password=get_password_hash(payload.password),
+        hashed_password=hashed_password,
         default_top_p=_clamp_top_p(payload.default_top_p),
         default_temperature=_clamp_temperature(payload.default_temperature),
     )
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
     return UserResponse(
         id=user.id,
         email=user.email,
@@ -78,18 +98,30 @@ def register_user(payload: UserCreate, db: Session = Depends(get_db)):
 
 
 @router.post("/login", response_model=Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     normalized_email = form_data.username.lower()
-    user = get_user_by_email(db, normalized_email)
-    if not user or not verify_password(form_data.password, user.hashed_password):
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
+    user = await get_user_by_email(db, normalized_email)
+    try:
+        if not user or not await password_hasher.verify(form_data.password, user.hashed_password):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
+    except PasswordHasherBusy:
+        raise _hasher_busy()
+
+    # The cost factor changed since this hash was stored; upgrade it while we know the password
+    if password_needs_rehash(user.hashed_password):
+        try:
+            user.hashed_password = await password_hasher.hash(form_data.password)
+            await db.commit()
+            user_cache.invalidate(user.email)
+        except PasswordHasherBusy:
+            pass  # Try again on a later login
 
     access_token = create_access_token({"sub": user.email})
     return Token(access_token=access_token)
 
 
 @router.get("/me", response_model=UserResponse)
-def get_me(current_user: models.User = Depends(get_current_user)):
+async def get_me(current_user: models.User = Depends(get_current_user)):
     return UserResponse(
         id=current_user.id,
         email=current_user.email,
@@ -97,3 +129,25 @@ def get_me(current_user: models.User = Depends(get_current_user)):
         default_temperature=current_user.default_temperature,
         created_at=current_user.created_at.isoformat(),
     )
+
+
+@router.patch("/me", response_model=UserResponse)
+async def update_me(
+    payload: UserSettingsUpdate,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    user = await db.get(models.User, current_user.id)
+    if payload.default_top_p is not None:
+        user.default_top_p = _clamp_top_p(payload.default_top_p)
+    if payload.default_temperature is not None:
+        user.default_temperature = _clamp_temperature(payload.default_temperature)
+    await db.commit()
+    user_cache.invalidate(user.email)
+    return UserResponse(
+        id=user.id,
+        email=user.email,
+        default_top_p=user.default_top_p,
+        default_temperature=user.default_temperature,
+        created_at=user.created_at.isoformat(),
+    )
@@ -1,22 +1,51 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from sqlalchemy.orm import Session, sessionmaker
-from typing import List, Optional
-from services.llm import stream_llm_response
-from database import get_db, SessionLocal
+from sqlalchemy import and_, delete, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from typing import List, Optional, Tuple
+from datetime import datetime
+from services.llm import generation_scheduler, stream_llm_response
+from services.metrics import active_streams, db_commit_seconds
+from services import sse
+from services.checkpoints import ResponseCheckpointer
+from services.coalescing import SSE_COALESCE_BYTES, SSE_COALESCE_MS, coalesce_events
+from services.context_cache import context_cache
+from services.context_window import context_window
+from services.persistence import merge_pending, message_writer
+from services.rate_limit import chat_rate_limiter
+from services.replay import SSE_RESUMABLE, ReplayGapError, replay_registry
+from services.scheduler import QueueFull, request_priority
+from services.tracing import current_trace, span
+from database import get_db, get_read_db, write_lock, AsyncSessionLocal, ReadSessionLocal
 import models
 from security import get_current_user
+import anyio
+import base64
 import json
+import os
+import time
 
 router = APIRouter()
 
+# Rows fetched per round trip by the streaming history endpoint
+HISTORY_STREAM_BATCH = int(os.getenv("HISTORY_STREAM_BATCH", "200"))
+
 class ChatRequest(BaseModel):
     message: str
     history: List[dict] = Field(default_factory=list)
     conversation_id: Optional[int] = None
+    # When set, the prompt history is rebuilt server-side from the stored messages
+    # of conversation_id and the `history` field is ignored.
+    server_history: bool = False
     top_p: Optional[float] = None
     temperature: Optional[float] = None
+    # Override SSE_COALESCE_MS / SSE_COALESCE_BYTES for this response; 0 ms sends every delta as its own frame
+    coalesce_ms: Optional[int] = Field(None, ge=0, le=1000)
+    coalesce_bytes: Optional[int] = Field(None, ge=1, le=65536)
+    # Keep generating after a disconnect so the client can resume via /chat/{generation_id}/events;
+    # defaults to SSE_RESUMABLE
+    resumable: Optional[bool] = None
 
 class ConversationResponse(BaseModel):
     id: int
@@ -29,13 +58,24 @@ class ConversationResponse(BaseModel):
         from_attributes = True
 
 class MessageResponse(BaseModel):
+    # Null while the message is still queued for the background writer
+    id: Optional[int] = None
     role: str
     content: str
     response_time: Optional[int] = None
+    # The client disconnected before the answer was complete
+    truncated: bool = False
+    # "streaming" while the answer is still being generated, "interrupted" if the server stopped mid-answer
+    status: str = "complete"
 
     class Config:
         from_attributes = True
 
+class MessagePage(BaseModel):
+    messages: List[MessageResponse]
+    # Pass back as `cursor` to fetch the previous (older) page; null on the oldest page
+    next_cursor: Optional[str] = None
+
 def _clamp_top_p(value: Optional[float], fallback: float = 0.9) -> float:
     if value is None:
         return fallback
@@ -48,22 +88,73 @@ def _clamp_temperature(value: Optional[float], fallback: float = 0.7) -> float:
     return max(0.0, min(2.0, value))
 
 
+def _encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _before_cursor(model, cursor: str):
+    """Keyset condition selecting rows that sort before the cursor in (created_at, id) order."""
+    created_at, row_id = _decode_cursor(cursor)
+    return or_(
+        model.created_at < created_at,
+        and_(model.created_at == created_at, model.id < row_id),
+    )
+
+
+async def _get_user_conversation(db: AsyncSession, conversation_id: int, user_id: int) -> Optional[models.Conversation]:
+    result = await db.execute(
+        select(models.Conversation).where(
+            models.Conversation.id == conversation_id,
+            models.Conversation.user_id == user_id,
+        )
+    )
+    return result.scalars().first()
+
+
+def _estimate_prompt_tokens(history: List[dict], message: str) -> int:
+    tokens = context_window.count_message({"content": message})
+    tokens += sum(context_window.count_message(m) for m in history)
+    # Longer histories are summarized down to the context window
+    return min(tokens, context_window.max_tokens)
+
+
+async def _load_history(db: AsyncSession, conversation_id: int) -> List[dict]:
+    cached = context_cache.get(conversation_id)
+    if cached is not None:
+        return cached
+
+    pending = message_writer.pending(conversation_id)
+    result = await db.execute(
+        select(models.Message.id, models.Message.role, models.Message.content)
+        .where(models.Message.conversation_id == conversation_id)
+        .order_by(models.Message.created_at, models.Message.id)
+    )
+    rows = merge_pending(result.all(), pending)
+    history = [{"role": row.role, "content": row.content} for row in rows]
+    context_cache.put(conversation_id, history)
+    return history
+
+
 @router.post("/chat")
 async def chat_endpoint(
     request: ChatRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user),
 ):
     # 1. Get or Create Conversation
+    created = False
     if request.conversation_id:
-        conversation = (
-            db.query(models.Conversation)
-            .filter(
-                models.Conversation.id == request.conversation_id,
-                models.Conversation.user_id == current_user.id,
-            )
-            .first()
-        )
+        conversation = await _get_user_conversation(db, request.conversation_id, current_user.id)
         if not conversation:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
@@ -72,7 +163,6 @@ async def chat_endpoint(
             conversation.top_p = _clamp_top_p(request.top_p, conversation.top_p)
         if request.temperature is not None:
             conversation.temperature = _clamp_temperature(request.temperature, conversation.temperature)
-        db.commit()
     else:
         # Create title from first few words of message
         title = " ".join(request.message.split()[:5]).strip() or "New Chat"
@@ -85,94 +175,262 @@ async def chat_endpoint(
             temperature=temperature,
             user_id=current_user.id,
         )
+        # Inserted together with the user message, in one short write transaction below
         db.add(conversation)
-        db.commit()
-        db.refresh(conversation)
+        created = True
+
+    with span("history"):
+        history = request.history
+        if request.server_history:
+            history = [] if created else await _load_history(db, conversation.id)
+        summary = await db.get(models.ConversationSummary, conversation.id) if request.conversation_id else None
+    summary_content = summary.content if summary else None
+    summarized_count = summary.message_count if summary else 0
+
+    # Admission control, then the per-user rate limit: both reject right away,
+    # before anything is stored for this request. A request turned away with
+    # 503 is not charged against the user's quota.
+    prompt_chars = len(request.message) + sum(len(m.get("content") or "") for m in history)
+    try:
+        admission = generation_scheduler.enqueue(request_priority(not history, prompt_chars))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    rate_limit_headers = {}
+    if chat_rate_limiter.enabled:
+        try:
+            with span("rate_limit"):
+                tokens = _estimate_prompt_tokens(history, request.message) if chat_rate_limiter.unit == "tokens" else 1
+                rate_limit = await chat_rate_limiter.check(current_user.id, chat_rate_limiter.cost(tokens))
+        except BaseException:
+            if admission is not None:
+                admission.release()
+            raise
+        rate_limit_headers = rate_limit.headers()
+        if not rate_limit.allowed:
+            if admission is not None:
+                admission.release()
+            raise HTTPException(status_code=429, detail="Rate limit exceeded", headers=rate_limit_headers)
 
     # 2. Save User Message
-    user_msg = models.Message(
-        conversation_id=conversation.id,
-        role="user",
-        content=request.message
-    )
-    db.add(user_msg)
-    db.commit()
+    # With the background writer running the message is queued and written in a
+    # batch; otherwise it shares the request transaction with the conversation.
+    if created or db.dirty or not message_writer.running:
+        try:
+            async with write_lock(db):
+                with db_commit_seconds.time(("user_message",)), span("db_commit"):
+                    if created:
+                        # Assigns the conversation id
+                        await db.flush()
+                    if not message_writer.running:
+                        user_msg = models.Message(
+                            conversation_id=conversation.id,
+                            role="user",
+                            content=request.message
+                        )
+                        db.add(user_msg)
+                    await db.commit()
+        except BaseException:
+            if admission is not None:
+                admission.release()
+            raise
+    if created:
+        context_cache.put(conversation.id, [])
+    if message_writer.running:
+        message_writer.submit(conversation.id, "user", request.message)
+    context_cache.append(conversation.id, {"role": "user", "content": request.message})
 
     # 3. Define callback to save Assistant Message using the same DB bind as the request
-    bind = db.get_bind()
+    bind = db.bind
     session_factory = (
-        sessionmaker(autocommit=False, autoflush=False, bind=bind)
+        async_sessionmaker(bind=bind, autoflush=False, expire_on_commit=False)
         if bind is not None
-        else SessionLocal
+        else AsyncSessionLocal
     )
+    # Hand the request's connection back to the pool now; the dependency would
+    # only close the session after the whole answer has been streamed
+    await db.close()
 
-    async def save_assistant_message(content, duration_ms):
-        db_session = session_factory()
-        try:
-            assistant_msg = models.Message(
-                conversation_id=conversation.id,
-                role="assistant",
-                content=content,
-                response_time=duration_ms
-            )
-            db_session.add(assistant_msg)
-            db_session.commit()
-        except Exception as e:
-            db_session.rollback()
-            print(f"Error saving assistant message: {e}")
-        finally:
-            db_session.close()
+    resumable = request.resumable if request.resumable is not None else SSE_RESUMABLE
+    generation = replay_registry.create(current_user.id, conversation.id) if resumable else None
+
+    # Long answers are checkpointed into a "streaming" row while they are generated
+    checkpointer = ResponseCheckpointer(session_factory, conversation.id)
+
+    async def save_assistant_message(content, duration_ms, truncated=False):
+        if await checkpointer.finalize(content, duration_ms, truncated):
+            context_cache.append(conversation.id, {"role": "assistant", "content": content})
+            return
+        if message_writer.running:
+            message_writer.submit(conversation.id, "assistant", content, duration_ms, truncated=truncated)
+            context_cache.append(conversation.id, {"role": "assistant", "content": content})
+            return
+        async with session_factory() as db_session, write_lock(db_session):
+            try:
+                assistant_msg = models.Message(
+                    conversation_id=conversation.id,
+                    role="assistant",
+                    content=content,
+                    response_time=duration_ms,
+                    truncated=truncated,
+                )
+                db_session.add(assistant_msg)
+                with db_commit_seconds.time(("assistant_message",)):
+                    await db_session.commit()
+                context_cache.append(conversation.id, {"role": "assistant", "content": content})
+            except Exception as e:
+                await db_session.rollback()
+                print(f"Error saving assistant message: {e}")
+
+    async def save_summary(content, message_count):
+        async with session_factory() as db_session, write_lock(db_session):
+            try:
+                if content:
+                    await db_session.merge(models.ConversationSummary(
+                        conversation_id=conversation.id,
+                        content=content,
+                        message_count=message_count,
+                    ))
+                else:
+                    await db_session.execute(
+                        delete(models.ConversationSummary).where(
+                            models.ConversationSummary.conversation_id == conversation.id
+                        )
+                    )
+                await db_session.commit()
+            except Exception as e:
+                await db_session.rollback()
+                print(f"Error saving conversation summary: {e}")
 
     # 4. Stream Response
-    # We need to wrap the generator to inject conversation_id into the metadata
+    # The LLM service yields event dicts; add conversation_id to the metadata event
+    # and serialize each event exactly once on the way out.
     async def stream_wrapper():
+        active_streams.inc()
+        trace = current_trace()
         # Pass conversation settings to the LLM service
-        async for chunk in stream_llm_response(
+        llm_stream = stream_llm_response(
             request.message, 
-            request.history, 
+            history, 
             save_assistant_message,
             top_p=conversation.top_p,
-            temperature=conversation.temperature
-        ):
-            # Intercept metadata to add conversation_id
-            # Parse JSON payload instead of string manipulation
-            if chunk.startswith("data: "):
-                try:
-                    data_str = chunk[6:].strip()
-                    data = json.loads(data_str)
-                    
-                    # Add conversation_id to metadata events
-                    if data.get("type") == "metadata":
-                        data["conversation_id"] = conversation.id
-                        yield f"data: {json.dumps(data)}\n\n"
-                    else:
-                        yield chunk
-                except json.JSONDecodeError:
-                    # Pass through malformed chunks
-                    yield chunk
-            else:
-                yield chunk
+            temperature=conversation.temperature,
+            summary=summary_content,
+            summarized_count=summarized_count,
+            on_summary=save_summary,
+            on_checkpoint=checkpointer.checkpoint,
+            affinity_key=conversation.id,
+            admission=admission,
+        )
+        events = coalesce_events(
+            llm_stream,
+            max_delay_ms=request.coalesce_ms if request.coalesce_ms is not None else SSE_COALESCE_MS,
+            max_bytes=request.coalesce_bytes or SSE_COALESCE_BYTES,
+        )
+        try:
+            async for event in events:
+                if not isinstance(event, dict):
+                    # Pre-encoded frame; only a possible metadata frame is decoded
+                    decoded = sse.decode_frame(event) if isinstance(event, str) and '"metadata"' in event else None
+                    if decoded is None or decoded.get("type") != "metadata":
+                        yield event
+                        continue
+                    event = decoded
+                if event.get("type") == "metadata":
+                    event["conversation_id"] = conversation.id
+                    if generation is not None:
+                        event["generation_id"] = generation.id
+                    if trace is not None:
+                        # Server-Timing went out with the headers; the streamed stages are reported here
+                        event["server_timing"] = trace.durations_ms()
+                if trace is None:
+                    yield sse.encode_event(event)
+                    continue
+                encode_started = time.perf_counter()
+                frame = sse.encode_event(event)
+                trace.accumulate("sse_encode", time.perf_counter() - encode_started)
+                yield frame
+        finally:
+            # If the client disconnected we are being closed or cancelled; close the
+            # LLM stream right away so it stops the upstream generation.
+            await events.aclose()
+            await llm_stream.aclose()
+            with anyio.CancelScope(shield=True):
+                await checkpointer.abandon()
+            active_streams.dec()
+
+    if generation is None:
+        return StreamingResponse(
+            stream_wrapper(),
+            media_type="text/event-stream",
+            headers=rate_limit_headers,
+        )
+    # The answer is produced by a background task; this response is only its first subscriber
+    generation.start(stream_wrapper())
+    return StreamingResponse(
+        generation.subscribe(),
+        media_type="text/event-stream",
+        headers={**rate_limit_headers, "X-Generation-Id": generation.id},
+    )
+
 
+@router.get("/chat/{generation_id}/events")
+async def resume_chat_stream(
+    generation_id: str,
+    last_event_id: Optional[int] = Query(None, ge=0),
+    last_event_id_header: Optional[int] = Header(None, alias="Last-Event-ID", ge=0),
+    current_user: models.User = Depends(get_current_user),
+):
+    """
+    Reattaches to a resumable answer. Frames after Last-Event-ID (header or
+    query parameter) are replayed from the buffer, then the live stream follows
+    if the answer is still being generated.
+    """
+    generation = replay_registry.get(generation_id, current_user.id)
+    if generation is None:
+        raise HTTPException(status_code=404, detail="Generation not found")
+    after = last_event_id_header if last_event_id_header is not None else (last_event_id or 0)
+    try:
+        generation.check_resumable(after)
+    except ReplayGapError as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    replay_registry.resumed += 1
     return StreamingResponse(
-        stream_wrapper(),
-        media_type="text/event-stream"
+        generation.subscribe(after),
+        media_type="text/event-stream",
+        headers={"X-Generation-Id": generation.id},
     )
 
 @router.get("/conversations", response_model=List[ConversationResponse])
-def get_conversations(
+async def get_conversations(
+    response: Response,
     skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_read_db),
     current_user: models.User = Depends(get_current_user),
 ):
-    conversations = (
-        db.query(models.Conversation)
-        .filter(models.Conversation.user_id == current_user.id)
-        .order_by(models.Conversation.created_at.desc())
-        .offset(skip)
-        .limit(limit)
-        .all()
+    """
+    Lists conversations, newest first. Pass the X-Next-Cursor response header
+    back as `cursor` to fetch the next page with a keyset query; `skip` is
+    still accepted for offset paging but gets slower on deep pages.
+    """
+    query = (
+        select(models.Conversation)
+        .where(models.Conversation.user_id == current_user.id)
+        .order_by(models.Conversation.created_at.desc(), models.Conversation.id.desc())
+        .limit(limit + 1)
     )
+    if cursor:
+        query = query.where(_before_cursor(models.Conversation, cursor))
+    elif skip:
+        query = query.offset(skip)
+    result = await db.execute(query)
+    conversations = result.scalars().all()
+    if len(conversations) > limit:
+        conversations = conversations[:limit]
+        last = conversations[-1]
+        response.headers["X-Next-Cursor"] = _encode_cursor(last.created_at, last.id)
     # Convert datetime to string for Pydantic if needed, or use orm_mode handles it?
     # Pydantic v1/v2 differences. Let's assume standard behavior.
     # We might need to map created_at to str if Pydantic doesn't auto-convert.
@@ -187,23 +445,149 @@ def get_conversations(
     ]
 
 @router.get("/conversations/{conversation_id}", response_model=List[MessageResponse])
-def get_conversation_history(
+async def get_conversation_history(
     conversation_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
     current_user: models.User = Depends(get_current_user),
 ):
-    conversation = (
-        db.query(models.Conversation)
-        .filter(
-            models.Conversation.id == conversation_id,
-            models.Conversation.user_id == current_user.id,
-        )
-        .first()
-    )
+    conversation = await _get_user_conversation(db, conversation_id, current_user.id)
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    
+
+    # Capture queued messages before querying so rows committed in between are not lost
+    pending = message_writer.pending(conversation.id)
+    # Lazy relationship loads are not available on an AsyncSession, query explicitly
+    result = await db.execute(
+        select(models.Message)
+        .where(models.Message.conversation_id == conversation.id)
+        .order_by(models.Message.created_at, models.Message.id)
+    )
     return [
-        MessageResponse(role=m.role, content=m.content, response_time=m.response_time) 
-        for m in conversation.messages
+        MessageResponse(id=m.id, role=m.role, content=m.content, response_time=m.response_time, truncated=bool(m.truncated), status=m.status) 
+        for m in merge_pending(result.scalars().all(), pending)
     ]
+
+
+@router.get("/conversations/{conversation_id}/messages", response_model=MessagePage)
+async def get_conversation_messages(
+    conversation_id: int,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    """
+    Paginated history: returns the newest `limit` messages in chronological
+    order, then older pages via `next_cursor`. Every page is a keyset query on
+    the (conversation_id, created_at) index, so deep pages cost the same as the first.
+    """
+    conversation = await _get_user_conversation(db, conversation_id, current_user.id)
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    # Queued messages are newer than anything stored, they only belong on the first page
+    pending = message_writer.pending(conversation.id) if not cursor else []
+    query = (
+        select(models.Message)
+        .where(models.Message.conversation_id == conversation.id)
+        .order_by(models.Message.created_at.desc(), models.Message.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor:
+        query = query.where(_before_cursor(models.Message, cursor))
+    result = await db.execute(query)
+    rows = list(result.scalars().all())
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1].created_at, rows[-1].id)
+    rows.reverse()
+
+    return MessagePage(
+        messages=[
+            MessageResponse(id=m.id, role=m.role, content=m.content, response_time=m.response_time, truncated=bool(m.truncated), status=m.status)
+            for m in merge_pending(rows, pending)
+        ],
+        next_cursor=next_cursor,
+    )
+
+
+@router.get("/conversations/{conversation_id}/stream")
+async def stream_conversation_history(
+    conversation_id: int,
+    since_message_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_read_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    """
+    Streams the history as NDJSON, one message object per line, oldest first.
+    Rows are read through a server-side cursor in batches of HISTORY_STREAM_BATCH
+    and encoded as they arrive, so memory use does not grow with the conversation.
+    With since_message_id only messages stored after that one are sent, plus
+    answers checkpointed since then: an answer that was still "streaming" is sent
+    again with its current content and status, clients replace it by id.
+    """
+    conversation = await _get_user_conversation(db, conversation_id, current_user.id)
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    # The response outlives the request session, so the stream opens its own on the same bind
+    bind = db.bind
+    session_factory = (
+        async_sessionmaker(bind=bind, autoflush=False, expire_on_commit=False)
+        if bind is not None
+        else ReadSessionLocal
+    )
+    pending = message_writer.pending(conversation.id)
+
+    query = (
+        select(
+            models.Message.id,
+            models.Message.role,
+            models.Message.content,
+            models.Message.response_time,
+            models.Message.truncated,
+            models.Message.status,
+        )
+        .where(models.Message.conversation_id == conversation.id)
+        .order_by(models.Message.created_at, models.Message.id)
+        .execution_options(yield_per=HISTORY_STREAM_BATCH)
+    )
+    if since_message_id is not None:
+        # Checkpointed answers keep their id while their content and status change,
+        # so rows written after the client's last message was stored are sent again
+        since_created_at = (
+            select(models.Message.created_at)
+            .where(models.Message.id == since_message_id, models.Message.conversation_id == conversation.id)
+            .scalar_subquery()
+        )
+        query = query.where(or_(
+            models.Message.id > since_message_id,
+            models.Message.updated_at >= since_created_at,
+        ))
+
+    def encode(row) -> str:
+        return json.dumps({
+            "id": row.id,
+            "role": row.role,
+            "content": row.content,
+            "response_time": row.response_time,
+            "truncated": bool(row.truncated),
+            "status": row.status,
+        }) + "\n"
+
+    async def ndjson_stream():
+        seen = set()
+        async with session_factory() as db_session:
+            result = await db_session.stream(query)
+            async for partition in result.partitions():
+                if pending:
+                    seen.update(row.id for row in partition)
+                yield "".join(encode(row) for row in partition)
+        for message in pending:
+            if message.id is not None and (message.id in seen or (since_message_id or 0) >= message.id):
+                continue
+            yield encode(message)
+
+    return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
@@ -0,0 +1,60 @@
+import hmac
+import os
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from security import password_hasher, user_cache
+from services.checkpoints import checkpoint_stats
+from services.coalescing import coalescing_stats
+from services.context_cache import context_cache
+from services.llm import backend_pool, cancellation_stats, generation_scheduler
+from services.metrics import metrics
+from services.persistence import message_writer
+from services.rate_limit import chat_rate_limiter
+from services.replay import replay_registry
+from services.response_cache import response_cache
+from services.single_flight import single_flight
+from services.upstream_http import upstream_http
+
+# When set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+router = APIRouter(tags=["metrics"])
+
+# Component -> (stats() callable, keys that are monotonic totals and export as counters)
+for component, (collect, counters) in {
+    "cancellation": (
+        cancellation_stats.stats,
+        ("completed", "cancelled", "tokens_before_cancel", "tokens_saved_estimate"),
+    ),
+    "user_cache": (user_cache.stats, ("hits", "misses", "evictions", "expirations", "invalidations")),
+    "password_hasher": (password_hasher.stats, ("completed", "rejected")),
+    "message_writer": (message_writer.stats, ("batches_written", "messages_written", "write_errors")),
+    "context_cache": (context_cache.stats, ("hits", "misses", "evictions")),
+    "coalescing": (coalescing_stats.stats, ("responses", "frames", "deltas")),
+    "checkpoints": (checkpoint_stats.stats, ("checkpoints", "skipped", "errors", "recovered")),
+    "replay": (replay_registry.stats, ("started", "resumed", "abandoned", "evictions")),
+    "response_cache": (
+        response_cache.stats,
+        ("hits", "disk_hits", "misses", "stores", "evictions", "expirations"),
+    ),
+    "single_flight": (single_flight.stats, ("flights", "shared", "backfilled_deltas", "cancelled")),
+    "backend_pool": (
+        backend_pool.stats,
+        ("retries", "hedges", "hedge_wins", "requests", "failures", "ejections", "prefix_hits", "prefix_misses"),
+    ),
+    "upstream_http": (upstream_http.stats, ("requests", "errors", "pool_timeouts", "drained")),
+    "scheduler": (generation_scheduler.stats, ("admitted", "queued", "rejected", "timeouts", "expired")),
+    "rate_limit": (chat_rate_limiter.stats, ("allowed", "limited", "local_rejections")),
+}.items():
+    metrics.register_collector(component, collect, counters)
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    """Prometheus text exposition of the chat pipeline metrics and service stats."""
+    if METRICS_TOKEN and not hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
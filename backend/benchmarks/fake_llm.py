@@ -0,0 +1,117 @@
+"""
+Local stand-in for an OpenAI-compatible chat completions server, for load tests.
+
+Streams `--tokens` deltas per answer after `--ttft-ms`, at `--tokens-per-second`,
+and fails a `--failure-rate` fraction of requests with HTTP 500. Timing is
+driven by asyncio sleeps, so one process can serve thousands of concurrent
+streams without its own CPU time skewing the numbers.
+
+Run from the backend directory:
+    python -m benchmarks.fake_llm [--port 9100] [--ttft-ms 200] [--tokens-per-second 50]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+@dataclass
+class FakeLLMConfig:
+    ttft_ms: float = 200.0
+    tokens_per_second: float = 50.0
+    tokens: int = 64
+    failure_rate: float = 0.0
+    seed: int = 0
+
+
+def _chunk(completion_id: str, model: str, delta: dict, finish_reason=None) -> bytes:
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload)}\n\n".encode()
+
+
+def create_app(config: FakeLLMConfig) -> Starlette:
+    rng = random.Random(config.seed)
+    words = ["The", " quick", " brown", " fox", " jumps", " over", " the", " lazy", " dog", "."]
+    state = {"requests": 0, "failures": 0, "in_flight": 0, "max_in_flight": 0}
+
+    async def completions(request: Request):
+        body = await request.json()
+        state["requests"] += 1
+        if rng.random() < config.failure_rate:
+            state["failures"] += 1
+            return JSONResponse({"error": {"message": "injected failure", "type": "server_error"}}, status_code=500)
+        model = body.get("model", "fake")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        interval = 1 / config.tokens_per_second if config.tokens_per_second > 0 else 0
+
+        async def stream():
+            state["in_flight"] += 1
+            state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+            try:
+                await asyncio.sleep(config.ttft_ms / 1000)
+                # Sleep until each token's due time so the rate does not drift under load
+                started = time.monotonic()
+                for i in range(config.tokens):
+                    delay = started + i * interval - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    yield _chunk(completion_id, model, {"content": words[i % len(words)]})
+                yield _chunk(completion_id, model, {}, finish_reason="stop")
+                yield b"data: [DONE]\n\n"
+            finally:
+                state["in_flight"] -= 1
+
+        if body.get("stream"):
+            return StreamingResponse(stream(), media_type="text/event-stream")
+        await asyncio.sleep(config.ttft_ms / 1000 + config.tokens * interval)
+        content = "".join(words[i % len(words)] for i in range(config.tokens))
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        })
+
+    async def stats(request: Request):
+        return JSONResponse(state)
+
+    return Starlette(routes=[
+        Route("/v1/chat/completions", completions, methods=["POST"]),
+        Route("/stats", stats),
+    ])
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft-ms", type=float, default=200.0)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = FakeLLMConfig(args.ttft_ms, args.tokens_per_second, args.tokens, args.failure_rate, args.seed)
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+"""
+Load test for the chat backend, end to end through uvicorn.
+
+Starts benchmarks.fake_llm and `main:app` as subprocesses (the app uses a
+throwaway SQLite database in a temporary directory), then runs scenarios:
+
+    chat           users chat concurrently, `--turns` turns each with server_history
+    long_history   users send one turn each with a `--history-turns` long client history
+    login_storm    users log in at the same time (bcrypt through the password hasher)
+    history_reads  users page through their conversations and messages concurrently
+
+For every scenario it reports p50/p95/p99 of time to first token (chat scenarios)
+and request latency, throughput, errors and the server's resident memory. Results
+are written as JSON; compare against a stored baseline to catch regressions:
+
+Run from the backend directory:
+    python -m benchmarks.load --output benchmarks/baselines/load.json
+    python -m benchmarks.load --baseline benchmarks/baselines/load.json [--fail-on-regression]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("chat", "long_history", "login_storm", "history_reads")
+PASSWORD = "benchmark-password"
+
+# (metric path, direction): +1 means higher is worse, -1 means lower is worse
+COMPARED_METRICS = (
+    (("ttft_ms", "p95"), 1),
+    (("latency_ms", "p95"), 1),
+    (("throughput_rps",), -1),
+    (("errors",), 1),
+    (("peak_rss_mb",), 1),
+)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    """Nearest-rank p50/p95/p99."""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def rank(q):
+        return round(ordered[min(len(ordered) - 1, max(0, int(q * len(ordered) + 0.5) - 1))], 1)
+
+    return {"p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99), "max": round(ordered[-1], 1)}
+
+
+def _rss_mb(pid: int) -> Dict[str, Optional[float]]:
+    # Linux only; other platforms report null
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            fields = dict(line.split(":", 1) for line in status if ":" in line)
+        return {
+            "rss_mb": round(int(fields["VmRSS"].split()[0]) / 1024, 1),
+            "peak_rss_mb": round(int(fields["VmHWM"].split()[0]) / 1024, 1),
+        }
+    except (OSError, KeyError, ValueError):
+        return {"rss_mb": None, "peak_rss_mb": None}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{url} exited with code {process.returncode}")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout:g}s")
+
+
+class Servers:
+    """The fake LLM and the app under test, each in its own process."""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="chat-load-")
+        self.llm_port = _free_port()
+        self.app_port = _free_port()
+        self.base_url = f"http://127.0.0.1:{self.app_port}"
+        self.processes: List[subprocess.Popen] = []
+
+    async def __aenter__(self):
+        llm = subprocess.Popen([
+            sys.executable, "-m", "benchmarks.fake_llm",
+            "--port", str(self.llm_port),
+            "--ttft-ms", str(self.args.ttft_ms),
+            "--tokens-per-second", str(self.args.tokens_per_second),
+            "--tokens", str(self.args.tokens),
+            "--failure-rate", str(self.args.failure_rate),
+        ], cwd=BACKEND_DIR)
+        self.processes.append(llm)
+        await _wait_ready(f"http://127.0.0.1:{self.llm_port}/stats", llm)
+
+        env = dict(os.environ)
+        env.update({
+            "LLM_BASE_URL": f"http://127.0.0.1:{self.llm_port}/v1",
+            "LLM_API_KEY": "fake",
+            "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(self.workdir, 'chat.db')}",
+            "RESPONSE_CACHE_PATH": os.path.join(self.workdir, "response_cache.db"),
+            "RATE_LIMIT_PATH": os.path.join(self.workdir, "rate_limit.db"),
+            "DB_PROFILE": self.args.db_profile,
+        })
+        if self.args.bcrypt_rounds:
+            env["BCRYPT_ROUNDS"] = str(self.args.bcrypt_rounds)
+        self.app = subprocess.Popen([
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--app-dir", BACKEND_DIR,
+            "--port", str(self.app_port),
+            "--log-level", "warning",
+        ], cwd=self.workdir, env=env)
+        self.processes.append(self.app)
+        await _wait_ready(f"{self.base_url}/health", self.app)
+        return self
+
+    async def __aexit__(self, *exc):
+        for process in reversed(self.processes):
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+class Sample:
+    def __init__(self):
+        self.ttft_ms: Optional[float] = None
+        self.latency_ms = 0.0
+        self.tokens = 0
+        self.ok = False
+        self.error: Optional[str] = None
+
+
+async def _chat(client: httpx.AsyncClient, token: str, payload: dict) -> (Sample, Optional[int]):
+    sample = Sample()
+    conversation_id = None
+    started = time.perf_counter()
+    try:
+        async with client.stream(
+            "POST", "/api/chat", json=payload, headers={"Authorization": f"Bearer {token}"}
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                sample.error = f"HTTP {response.status_code}"
+                return sample, None
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[6:])
+                if "content" in event:
+                    if sample.ttft_ms is None:
+                        sample.ttft_ms = (time.perf_counter() - started) * 1000
+                    sample.tokens += 1
+                elif event.get("type") == "metadata":
+                    conversation_id = event.get("conversation_id")
+                elif "error" in event:
+                    sample.error = f"stream error: {event['error'][:80]}"
+            if sample.error is None and conversation_id is None:
+                sample.error = "no metadata event"
+            sample.ok = sample.error is None
+    except httpx.HTTPError as e:
+        sample.error = type(e).__name__
+    sample.latency_ms = (time.perf_counter() - started) * 1000
+    return sample, conversation_id
+
+
+async def _timed(coro) -> Sample:
+    sample = Sample()
+    started = time.perf_counter()
+    try:
+        response = await coro
+        sample.ok = response.status_code < 400
+        if not sample.ok:
+            sample.error = f"HTTP {response.status_code}"
+    except httpx.HTTPError as e:
+        sample.error = type(e).__name__
+    sample.latency_ms = (time.perf_counter() - started) * 1000
+    return sample
+
+
+def _summary(samples: List[Sample], elapsed: float, memory: dict) -> dict:
+    ok = [s for s in samples if s.ok]
+    tokens = sum(s.tokens for s in ok)
+    error_kinds: Dict[str, int] = {}
+    for sample in samples:
+        if not sample.ok:
+            error_kinds[sample.error] = error_kinds.get(sample.error, 0) + 1
+    summary = {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "error_kinds": error_kinds,
+        "duration_s": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": percentiles([s.latency_ms for s in ok]),
+        **memory,
+    }
+    ttfts = [s.ttft_ms for s in ok if s.ttft_ms is not None]
+    if ttfts:
+        summary["ttft_ms"] = percentiles(ttfts)
+        summary["tokens_per_second"] = round(tokens / elapsed, 1) if elapsed else 0.0
+    return summary
+
+
+class LoadTest:
+    def __init__(self, args, servers: Servers):
+        self.args = args
+        self.servers = servers
+        self.tokens: List[str] = []
+        self.conversations: Dict[str, int] = {}
+
+    def client(self) -> httpx.AsyncClient:
+        connections = max(100, self.args.users * 2)
+        return httpx.AsyncClient(
+            base_url=self.servers.base_url,
+            timeout=httpx.Timeout(300),
+            limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+        )
+
+    async def setup(self, client: httpx.AsyncClient) -> None:
+        emails = [f"user{i}@example.com" for i in range(self.args.users)]
+        semaphore = asyncio.Semaphore(16)
+
+        async def register_and_login(email):
+            async with semaphore:
+                response = await client.post("/api/auth/register", json={"email": email, "password": PASSWORD})
+                if response.status_code not in (201, 400):  # 400: already registered
+                    response.raise_for_status()
+                response = await client.post("/api/auth/login", data={"username": email, "password": PASSWORD})
+                response.raise_for_status()
+                return response.json()["access_token"]
+
+        self.tokens = await asyncio.gather(*(register_and_login(email) for email in emails))
+
+    async def chat(self, client: httpx.AsyncClient) -> List[Sample]:
+        async def user(token):
+            samples, conversation_id = [], self.conversations.get(token)
+            for turn in range(self.args.turns):
+                payload = {"message": f"Question {turn}: tell me about foxes", "conversation_id": conversation_id,
+                           "server_history": conversation_id is not None}
+                sample, returned_id = await _chat(client, token, payload)
+                conversation_id = returned_id or conversation_id
+                samples.append(sample)
+            if conversation_id is not None:
+                self.conversations[token] = conversation_id
+            return samples
+
+        results = await asyncio.gather(*(user(token) for token in self.tokens))
+        return [sample for samples in results for sample in samples]
+
+    async def long_history(self, client: httpx.AsyncClient) -> List[Sample]:
+        turn = "Some earlier context about the topic at hand, repeated for length. " * 6
+        history = [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": f"{i}: {turn}"}
+            for i in range(self.args.history_turns)
+        ]
+        payload = {"message": "Summarize what we discussed", "history": history}
+        results = await asyncio.gather(*(_chat(client, token, payload) for token in self.tokens))
+        return [sample for sample, _ in results]
+
+    async def login_storm(self, client: httpx.AsyncClient) -> List[Sample]:
+        return await asyncio.gather(*(
+            _timed(client.post("/api/auth/login", data={"username": f"user{i}@example.com", "password": PASSWORD}))
+            for i in range(self.args.users)
+        ))
+
+    async def history_reads(self, client: httpx.AsyncClient) -> List[Sample]:
+        missing = [token for token in self.tokens if token not in self.conversations]
+        for token, (_, conversation_id) in zip(missing, await asyncio.gather(*(
+            _chat(client, token, {"message": "Hello"}) for token in missing
+        ))):
+            if conversation_id is not None:
+                self.conversations[token] = conversation_id
+
+        async def reader(token):
+            headers = {"Authorization": f"Bearer {token}"}
+            conversation_id = self.conversations.get(token)
+            samples = []
+            for _ in range(self.args.reads):
+                samples.append(await _timed(client.get("/api/conversations", headers=headers)))
+                if conversation_id is not None:
+                    samples.append(await _timed(client.get(
+                        f"/api/conversations/{conversation_id}/messages", headers=headers
+                    )))
+            return samples
+
+        results = await asyncio.gather(*(reader(token) for token in self.tokens))
+        return [sample for samples in results for sample in samples]
+
+    async def run(self, scenarios) -> Dict[str, dict]:
+        results = {}
+        async with self.client() as client:
+            await self.setup(client)
+            for name in scenarios:
+                started = time.perf_counter()
+                samples = await getattr(self, name)(client)
+                elapsed = time.perf_counter() - started
+                results[name] = _summary(samples, elapsed, _rss_mb(self.servers.app.pid))
+        return results
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Returns one line per metric that is worse than the baseline by more than `tolerance`."""
+    regressions = []
+    for scenario, result in current.get("scenarios", {}).items():
+        previous = baseline.get("scenarios", {}).get(scenario)
+        if not previous:
+            continue
+        for path, direction in COMPARED_METRICS:
+            now, before = result, previous
+            for key in path:
+                now = now.get(key) if isinstance(now, dict) else None
+                before = before.get(key) if isinstance(before, dict) else None
+            if now is None or before is None:
+                continue
+            name = f"{scenario}.{'.'.join(path)}"
+            if path == ("errors",):
+                if now > before:
+                    regressions.append(f"{name}: {before} -> {now}")
+                continue
+            if before and direction * (now - before) / before > tolerance:
+                regressions.append(f"{name}: {before} -> {now} ({(now - before) / before:+.0%})")
+    return regressions
+
+
+def _print_report(report: dict) -> None:
+    print(f"commit {report['commit']}  {json.dumps(report['config'])}")
+    for name, result in report["scenarios"].items():
+        ttft = result.get("ttft_ms") or {}
+        latency = result.get("latency_ms") or {}
+        print(
+            f"  {name:<14} {result['requests']:>5} req  {result['errors']:>3} err  "
+            f"{result['throughput_rps']:>8.2f} req/s  "
+            f"ttft p50/p95/p99 {ttft.get('p50', '-')}/{ttft.get('p95', '-')}/{ttft.get('p99', '-')} ms  "
+            f"latency p50/p95/p99 {latency.get('p50', '-')}/{latency.get('p95', '-')}/{latency.get('p99', '-')} ms  "
+            f"rss {result['rss_mb']} MB (peak {result['peak_rss_mb']})"
+        )
+
+
+async def _main(args) -> int:
+    scenarios = SCENARIOS if args.scenario == "all" else tuple(args.scenario.split(","))
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    async with Servers(args) as servers:
+        results = await LoadTest(args, servers).run(scenarios)
+
+    config = {key: getattr(args, key) for key in (
+        "users", "turns", "history_turns", "reads", "ttft_ms", "tokens_per_second", "tokens", "failure_rate",
+        "db_profile",
+    )}
+    report = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": config,
+        "scenarios": results,
+    }
+    _print_report(report)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("Warning: the baseline was recorded with a different configuration")
+        regressions = compare(report, baseline, args.tolerance)
+        print(f"Compared with {args.baseline} (commit {baseline.get('commit')}, tolerance {args.tolerance:.0%})")
+        for line in regressions:
+            print(f"  REGRESSION {line}")
+        if not regressions:
+            print("  no regressions")
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", default="all", help=f"comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--history-turns", type=int, default=200)
+    parser.add_argument("--reads", type=int, default=5)
+    parser.add_argument("--ttft-ms", type=float, default=200.0)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--db-profile", default="production", help="DB_PROFILE for the app (SQLite tuning)")
+    parser.add_argument("--bcrypt-rounds", type=int, help="override BCRYPT_ROUNDS for the app")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="compare against a JSON report from an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="relative change that counts as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(_main(args)))
+
+
+if __name__ == "__main__":
+    main()
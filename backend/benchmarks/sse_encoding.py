@@ -0,0 +1,86 @@
+"""
+Microbenchmark for the per-token cost of producing SSE frames.
+
+"before" replays the old pipeline: the LLM service json.dumps-ed every token
+into a `data:` string and the chat stream wrapper stripped the prefix and
+json.loads-ed it again to look for the metadata event. "after" is the current
+one: the service yields event dicts and services.sse encodes each exactly once.
+
+Run from the backend directory:
+    python -m benchmarks.sse_encoding [--tokens 100000]
+"""
+import argparse
+import json
+import time
+
+from services import sse
+
+
+def _tokens(count):
+    words = ["Hello", " world", ",", " this", " is", " a", " tokén", " \"quoted\"", "\n"]
+    return [words[i % len(words)] for i in range(count)]
+
+
+def before(tokens, conversation_id=1):
+    frames = []
+    for token in tokens:
+        chunk = f"data: {json.dumps({'content': token})}\n\n"
+        if chunk.startswith("data: "):
+            try:
+                data = json.loads(chunk[6:].strip())
+                if data.get("type") == "metadata":
+                    data["conversation_id"] = conversation_id
+                    frames.append(f"data: {json.dumps(data)}\n\n")
+                else:
+                    frames.append(chunk)
+            except json.JSONDecodeError:
+                frames.append(chunk)
+    return frames
+
+
+def after(tokens, conversation_id=1):
+    frames = []
+    for token in tokens:
+        event = {"content": token}
+        if event.get("type") == "metadata":
+            event["conversation_id"] = conversation_id
+        frames.append(sse.encode_event(event))
+    return frames
+
+
+def _per_token_ns(fn, tokens, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        fn(tokens)
+        best = min(best, time.perf_counter_ns() - start)
+    return best / len(tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    tokens = _tokens(args.tokens)
+    orjson = sse.orjson
+    runs = [("before (dumps + loads)", before, orjson)]
+    if orjson is not None:
+        runs.append(("after (orjson)", after, orjson))
+    runs.append(("after (stdlib json)", after, None))
+
+    baseline = None
+    print(f"{args.tokens} tokens, best of {args.repeat}")
+    for label, fn, backend in runs:
+        sse.orjson = backend
+        try:
+            ns = _per_token_ns(fn, tokens, args.repeat)
+        finally:
+            sse.orjson = orjson
+        baseline = baseline or ns
+        print(f"  {label:<24} {ns:8.0f} ns/token  {baseline / ns:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
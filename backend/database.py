@@ -1,19 +1,168 @@
-from sqlalchemy import create_engine
+import asyncio
+import os
+import weakref
+from contextlib import asynccontextmanager
+
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateColumn
+
+ASYNC_SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./chat.db")
+SQLALCHEMY_DATABASE_URL = make_url(ASYNC_SQLALCHEMY_DATABASE_URL).set(drivername="sqlite").render_as_string(hide_password=False)
+
+# "default" keeps SQLite's stock settings, "production" enables WAL and the
+# pragmas below. Individual SQLITE_* variables override the profile values.
+DB_PROFILE = os.getenv("DB_PROFILE", "default")
+SQLITE_PROFILES = {
+    "default": {},
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # negative values are KiB
+        "busy_timeout": 5000,
+        "temp_store": "MEMORY",
+    },
+}
+_PRAGMA_ENV = {
+    "journal_mode": "SQLITE_JOURNAL_MODE",
+    "synchronous": "SQLITE_SYNCHRONOUS",
+    "mmap_size": "SQLITE_MMAP_SIZE",
+    "cache_size": "SQLITE_CACHE_SIZE",
+    "busy_timeout": "SQLITE_BUSY_TIMEOUT_MS",
+}
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# A separate read-only pool lets history reads run next to the chat write path.
+# It only helps with WAL, where readers do not wait for the writer.
+DB_READ_POOL = os.getenv("DB_READ_POOL", "1" if DB_PROFILE == "production" else "0") == "1"
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "10"))
+
+
+def sqlite_pragmas(profile: str = DB_PROFILE) -> dict:
+    if profile not in SQLITE_PROFILES:
+        raise RuntimeError(f"Unknown DB_PROFILE '{profile}'. Expected one of: {', '.join(SQLITE_PROFILES)}")
+    pragmas = dict(SQLITE_PROFILES[profile])
+    for name, var_name in _PRAGMA_ENV.items():
+        value = os.getenv(var_name)
+        if value:
+            pragmas[name] = value
+    return pragmas
+
+
+def _is_memory_database(url: str) -> bool:
+    return make_url(url).database in (None, "", ":memory:")
+
+
+def _pool_kwargs(url: str, pool_size: int) -> dict:
+    if not url.startswith("sqlite") or _is_memory_database(url):
+        # In-memory SQLite uses a single static connection, pool sizing does not apply
+        return {}
+    return {"pool_size": pool_size, "max_overflow": DB_MAX_OVERFLOW, "pool_timeout": DB_POOL_TIMEOUT}
+
+
+def configure_sqlite(sync_engine, pragmas: dict, read_only: bool = False) -> None:
+    """Apply PRAGMAs to every new DBAPI connection of the engine."""
+    if sync_engine.dialect.name != "sqlite":
+        return
+    statements = [
+        f"PRAGMA {name}={value}"
+        for name, value in pragmas.items()
+        # The journal mode is a property of the database file, set it from the write side
+        if not (read_only and name == "journal_mode")
+    ]
+    if read_only:
+        statements.append("PRAGMA query_only=ON")
+    if not statements:
+        return
+
+    @event.listens_for(sync_engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./chat.db"
 
+_pragmas = sqlite_pragmas()
+
+# The synchronous engine is only used for schema creation and offline scripts;
+# request handlers go through the async engine so DB I/O never blocks the event loop.
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
+configure_sqlite(engine, _pragmas)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, **_pool_kwargs(ASYNC_SQLALCHEMY_DATABASE_URL, DB_POOL_SIZE))
+configure_sqlite(async_engine.sync_engine, _pragmas)
+# expire_on_commit=False keeps loaded attributes usable after commit; lazy
+# refreshes are not possible outside of an awaited call in async code.
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+if DB_READ_POOL and not _is_memory_database(ASYNC_SQLALCHEMY_DATABASE_URL):
+    read_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, **_pool_kwargs(ASYNC_SQLALCHEMY_DATABASE_URL, DB_READ_POOL_SIZE))
+    configure_sqlite(read_engine.sync_engine, _pragmas, read_only=True)
+else:
+    read_engine = async_engine
+ReadSessionLocal = async_sessionmaker(bind=read_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+# SQLite lets one connection write at a time. Connections that find the database
+# locked poll it with growing sleeps (busy_timeout), so under load many small
+# concurrent write transactions wait far longer than the writes take, and some
+# give up with "database is locked". The write transactions of the chat path
+# take turns on a lock instead; keep them short (flush and commit only).
+_write_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+
+
+@asynccontextmanager
+async def write_lock(db: AsyncSession):
+    """Holds the write lock of the running event loop for a write transaction on `db`."""
+    # Check the connection out first: a lock holder waiting for the pool while the
+    # sessions holding the pool's connections wait for the lock would deadlock
+    await db.connection()
+    loop = asyncio.get_running_loop()
+    lock = _write_locks.get(loop)
+    if lock is None:
+        lock = _write_locks[loop] = asyncio.Lock()
+    async with lock:
+        yield
+
+
+def init_db() -> None:
+    """Create missing tables, columns and indexes. Call after the models module is imported."""
+    Base.metadata.create_all(bind=engine)
+    # New columns on existing tables must be nullable or carry a server_default
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+    # create_all skips the indexes of tables that already exist, so databases
+    # created by older versions would never receive newly added indexes.
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_read_db():
+    """Session for read-only endpoints, served by the read pool when it is enabled."""
+    async with ReadSessionLocal() as db:
         yield db
-    finally:
-        db.close()
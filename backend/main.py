@@ -1,13 +1,46 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from api.chat import router as chat_router
 from api.auth import router as auth_router
-from database import engine
+from api.metrics import router as metrics_router
+from database import AsyncSessionLocal, init_db
+from services.checkpoints import recover_after_grace, recover_interrupted_messages
+from services.persistence import message_writer
+from services.rate_limit import chat_rate_limiter
+from services.replay import replay_registry
+from services.response_cache import response_cache
+from services.tracing import TracingMiddleware
+from services.upstream_http import upstream_http
+from security import password_hasher
 import models
 
-models.Base.metadata.create_all(bind=engine)
+init_db()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    recovered = await recover_interrupted_messages(AsyncSessionLocal)
+    if recovered:
+        print(f"Marked {recovered} interrupted assistant message(s) from a previous run")
+    late_recovery = asyncio.create_task(recover_after_grace(AsyncSessionLocal))
+    await message_writer.start(AsyncSessionLocal)
+    upstream_http.start()
+    yield
+    late_recovery.cancel()
+    # Let running answers save their partial content, then flush queued messages
+    await replay_registry.shutdown()
+    await message_writer.stop()
+    # Only after the answers above are done with their upstream connections
+    await upstream_http.close()
+    password_hasher.shutdown()
+    response_cache.close()
+    chat_rate_limiter.close()
+
 
-app = FastAPI(title="LLM Chat Backend")
+app = FastAPI(title="LLM Chat Backend", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,10 +48,17 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[
+        "X-Next-Cursor", "X-Generation-Id", "Retry-After", "RateLimit-Limit", "RateLimit-Remaining", "RateLimit-Reset",
+        "Server-Timing", "X-Trace-Id",
+    ],
 )
+# Opt-in request tracing (TRACE_SAMPLE_RATE, or the X-Debug-Trace header with TRACE_DEBUG_TOKEN); a pass-through otherwise
+app.add_middleware(TracingMiddleware)
 
 app.include_router(auth_router, prefix="/api")
 app.include_router(chat_router, prefix="/api")
+app.include_router(metrics_router)
 
 @app.get("/health")
 async def health_check():
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Float, UniqueConstraint
+from sqlalchemy import Boolean, Column, Integer, String, Text, DateTime, ForeignKey, Float, Index, UniqueConstraint, text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base
@@ -20,6 +20,9 @@ class User(Base):
 
 class Conversation(Base):
     __tablename__ = "conversations"
+    # Serves the per-user listing ordered by created_at; SQLite appends the rowid
+    # to every index, so the (created_at, id) keyset order needs no extra column.
+    __table_args__ = (Index("ix_conversations_user_id_created_at", "user_id", "created_at"),)
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String, default="New Chat")
@@ -30,10 +33,27 @@ class Conversation(Base):
 
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
     user = relationship("User", back_populates="conversations")
+    summary = relationship("ConversationSummary", back_populates="conversation", uselist=False, cascade="all, delete-orphan")
+
+
+class ConversationSummary(Base):
+    __tablename__ = "conversation_summaries"
+
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), primary_key=True)
+    content = Column(Text, nullable=False)
+    message_count = Column(Integer, nullable=False)  # leading messages folded into the summary
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    conversation = relationship("Conversation", back_populates="summary")
 
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_conversation_id_created_at", "conversation_id", "created_at"),
+        # Partial index: only in-flight answers are indexed, for the startup recovery pass
+        Index("ix_messages_streaming", "updated_at", sqlite_where=text("status = 'streaming'")),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False)
@@ -41,5 +61,11 @@ class Message(Base):
     content = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
     response_time = Column(Integer, nullable=True)  # in milliseconds
+    # Set when the client disconnected and only a partial answer was generated
+    truncated = Column(Boolean, nullable=False, default=False, server_default="0")
+    # "streaming" while the answer is being generated and checkpointed, "interrupted"
+    # if the process died before it completed, "complete" otherwise
+    status = Column(String(16), nullable=False, default="complete", server_default="complete")
+    updated_at = Column(DateTime, nullable=True)  # last checkpoint of a streamed answer
 
     conversation = relationship("Conversation", back_populates="messages")
@@ -1,4 +1,9 @@
+import asyncio
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
@@ -7,14 +12,28 @@ from fastapi.security import OAuth2PasswordBearer
 import bcrypt
 from jose import JWTError, jwt
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import models
 from database import get_db
+from services.tracing import span
 
 SECRET_KEY = os.getenv("AUTH_SECRET_KEY", "change-me")
 ALGORITHM = os.getenv("AUTH_ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
+# Resolved users are cached per token subject; the TTL bounds how long another
+# worker process can serve a stale copy after a change it was not told about.
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "4096"))
+# bcrypt cost factor for new hashes; stored hashes with another cost are upgraded on login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Password hashing runs off the event loop on a dedicated pool. bcrypt releases
+# the GIL, so threads are enough; "process" isolates hashing from the API process.
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Hash jobs allowed to wait or run at once; beyond this, requests are rejected with 503
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
@@ -23,15 +42,163 @@ class TokenData(BaseModel):
     email: Optional[str] = None
 
 
+class UserCache:
+    """
+    TTL + LRU cache of authenticated users keyed by token subject (email).
+    Cached users are detached from their session, so only their loaded column
+    attributes may be used. Call invalidate() whenever a user row changes.
+    """
+
+    def __init__(self, ttl_seconds: float = USER_CACHE_TTL_SECONDS, max_entries: int = USER_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, subject: str) -> Optional[models.User]:
+        with self._lock:
+            entry = self._entries.get(subject)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, user = entry
+            if expires_at <= time.monotonic():
+                del self._entries[subject]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(subject)
+            self.hits += 1
+            return user
+
+    def put(self, subject: str, user: models.User) -> None:
+        if self.max_entries <= 0 or self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[subject] = (time.monotonic() + self.ttl_seconds, user)
+            self._entries.move_to_end(subject)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, subject: str) -> None:
+        with self._lock:
+            if self._entries.pop(subject, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+user_cache = UserCache()
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
 
 
-def get_password_hash(password: str) -> str:
-    salt = bcrypt.gensalt()
+def get_password_hash(password: str, rounds: Optional[int] = None) -> str:
+    salt = bcrypt.gensalt(rounds or BCRYPT_ROUNDS)
     return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
 
 
+def password_needs_rehash(hashed_password: str, rounds: Optional[int] = None) -> bool:
+    # bcrypt hashes look like $2b$12$<salt+hash>; the second field is the cost
+    try:
+        return int(hashed_password.split("$")[2]) != (rounds or BCRYPT_ROUNDS)
+    except (IndexError, ValueError):
+        return True
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a bounded executor so hashing bursts (login/register storms)
+    cannot starve the event loop. At most max_pending jobs may be queued or
+    running; further calls raise PasswordHasherBusy instead of piling up.
+    """
+
+    def __init__(
+        self,
+        workers: int = PASSWORD_HASH_WORKERS,
+        max_pending: int = PASSWORD_HASH_MAX_PENDING,
+        executor_kind: str = PASSWORD_HASH_EXECUTOR,
+    ):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor_kind = executor_kind
+        self._executor: Optional[Executor] = None
+        self.pending = 0
+        self.max_pending_seen = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        return self._executor
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self.pending += 1
+        self.max_pending_seen = max(self.max_pending_seen, self.pending)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password, BCRYPT_ROUNDS)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            # Jobs waiting for a free worker, as opposed to running
+            "queue_depth": max(0, self.pending - self.workers),
+            "max_pending_seen": self.max_pending_seen,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
@@ -40,13 +207,14 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
-def get_user_by_email(db: Session, email: str) -> Optional[models.User]:
-    return db.query(models.User).filter(models.User.email == email).first()
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[models.User]:
+    result = await db.execute(select(models.User).where(models.User.email == email))
+    return result.scalars().first()
 
 
-def get_current_user(
+async def get_current_user(
     token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ) -> models.User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -54,7 +222,8 @@ def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with span("auth"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: Optional[str] = payload.get("sub")
         if email is None:
             raise credentials_exception
@@ -62,7 +231,15 @@ def get_current_user(
     except JWTError:
         raise credentials_exception
 
-    user = get_user_by_email(db, token_data.email)
+    user = user_cache.get(token_data.email)
+    if user is not None:
+        return user
+
+    with span("auth_db"):
+        user = await get_user_by_email(db, token_data.email)
     if user is None:
         raise credentials_exception
+    # Detach so later commits in this session cannot expire the shared cached copy
+    db.expunge(user)
+    user_cache.put(token_data.email, user)
     return user
@@ -0,0 +1,388 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import math
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from typing import List, Optional
+
+from openai import AsyncOpenAI
+
+from services.upstream_http import upstream_http
+
+# JSON list of inference endpoints, e.g.
+# [{"name": "box1", "base_url": "http://10.0.0.5:1234/v1", "model": "qwen/qwen3-1.7b", "weight": 2, "max_concurrency": 4}]
+# "api_key" defaults to LLM_API_KEY. When unset, LLM_BASE_URL is the only backend.
+LLM_BACKENDS = os.getenv("LLM_BACKENDS", "")
+# "least_outstanding" sends each request to the backend with the fewest requests in
+# flight per unit of weight; "ewma" also weighs in the smoothed time to first token;
+# "affinity" keeps a conversation on one backend (consistent hashing with bounded
+# load) so the server can reuse its prompt-prefix cache across turns.
+LLM_ROUTING = os.getenv("LLM_ROUTING", "least_outstanding")
+# A backend takes affinity traffic only while it has less than this factor times
+# its weighted share of the requests in flight
+LLM_AFFINITY_LOAD_FACTOR = float(os.getenv("LLM_AFFINITY_LOAD_FACTOR", "1.25"))
+# Conversations whose last backend is remembered for the prefix-reuse statistics
+LLM_AFFINITY_TRACKED = int(os.getenv("LLM_AFFINITY_TRACKED", "10000"))
+LLM_BACKEND_MAX_CONCURRENCY = int(os.getenv("LLM_BACKEND_MAX_CONCURRENCY", "0"))  # 0 = unlimited
+LLM_BACKEND_MAX_FAILURES = int(os.getenv("LLM_BACKEND_MAX_FAILURES", "3"))
+LLM_BACKEND_EJECT_SECONDS = float(os.getenv("LLM_BACKEND_EJECT_SECONDS", "30"))
+LLM_BACKEND_ACQUIRE_TIMEOUT_SECONDS = float(os.getenv("LLM_BACKEND_ACQUIRE_TIMEOUT_SECONDS", "30"))
+# Extra attempts after a connection error or 5xx before the first token, with
+# full-jitter exponential backoff between them; later attempts prefer other backends
+LLM_RETRY_ATTEMPTS = int(os.getenv("LLM_RETRY_ATTEMPTS", "2"))
+LLM_RETRY_BACKOFF_MS = float(os.getenv("LLM_RETRY_BACKOFF_MS", "100"))
+LLM_RETRY_BACKOFF_MAX_MS = float(os.getenv("LLM_RETRY_BACKOFF_MAX_MS", "2000"))
+# Send a second (hedged) request to another backend when the first token takes longer
+# than this percentile of recent times to first token; the slower one is cancelled. 0 = off
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))
+LLM_HEDGE_MIN_DELAY_MS = float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "100"))
+
+EWMA_ALPHA = 0.3
+# Recent times to first token kept for the hedging percentile, and the samples needed before hedging
+HEDGE_WINDOW = 1000
+HEDGE_MIN_SAMPLES = 20
+HEDGE_REFRESH_EVERY = 50
+RING_POINTS_PER_WEIGHT = 64
+ROUTING_MODES = ("least_outstanding", "ewma", "affinity")
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class NoBackendAvailable(Exception):
+    """Every backend stayed at its concurrency limit until the acquire timeout."""
+
+
+class Backend:
+    def __init__(self, name: str, client, model: str, weight: float = 1.0, max_concurrency: int = LLM_BACKEND_MAX_CONCURRENCY):
+        if weight <= 0:
+            raise RuntimeError(f"LLM backend '{name}' needs a positive weight")
+        self.name = name
+        self.client = client
+        self.model = model
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        # Circuit breaker: tripped from an ejection until a request succeeds again;
+        # once the ejection window passed, one probe request at a time is let through
+        self.tripped = False
+        self.probing = False
+        # Smoothed time to first token in seconds; None until the first sample
+        self.ewma_latency: Optional[float] = None
+        # Turns that reached the backend that served the conversation's previous turn
+        self.prefix_hits = 0
+        self.prefix_misses = 0
+        self._ttft = {True: [0.0, 0], False: [0.0, 0]}
+
+    def circuit(self, now: float) -> str:
+        if now < self.ejected_until:
+            return "open"
+        return "half_open" if self.tripped else "closed"
+
+    def healthy(self, now: float) -> bool:
+        if now < self.ejected_until:
+            return False
+        return not (self.tripped and self.probing)
+
+    def has_capacity(self) -> bool:
+        return not self.max_concurrency or self.outstanding < self.max_concurrency
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "model": self.model,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "healthy": self.healthy(time.monotonic()),
+            "circuit": self.circuit(time.monotonic()),
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 1) if self.ewma_latency is not None else None,
+            "prefix_hits": self.prefix_hits,
+            "prefix_misses": self.prefix_misses,
+            "prefix_hit_rate": self.prefix_hits / (self.prefix_hits + self.prefix_misses) if self.prefix_hits + self.prefix_misses else 0.0,
+            "ttft_prefix_hit_ms": self._mean_ttft_ms(True),
+            "ttft_prefix_miss_ms": self._mean_ttft_ms(False),
+        }
+
+    def _mean_ttft_ms(self, prefix_hit: bool) -> Optional[float]:
+        total, count = self._ttft[prefix_hit]
+        return round(total / count * 1000, 1) if count else None
+
+
+class BackendPool:
+    """
+    Routes upstream requests over several OpenAI-compatible backends.
+    Health checks are passive, as a circuit breaker per backend: max_failures
+    consecutive errors or timeouts open it (the backend is ejected) for
+    eject_seconds, then it is half-open and takes a single probe request at a
+    time until one succeeds (closed) or fails (open again). If every backend is
+    ejected at once, all of them are considered again instead of failing every
+    request. A backend at its max_concurrency is skipped; when all are full,
+    acquire() waits for a slot.
+
+    With affinity routing each backend owns RING_POINTS_PER_WEIGHT points per unit
+    of weight on a hash ring. A conversation walks the ring from its own hash and
+    takes the first backend that is healthy, has capacity and is below
+    affinity_load_factor times its share of the load; this keeps turns on one
+    backend while it is not overloaded, and only moves the conversations of a
+    backend that joins, leaves or is ejected.
+    """
+
+    def __init__(
+        self,
+        backends: List[Backend],
+        routing: str = LLM_ROUTING,
+        max_failures: int = LLM_BACKEND_MAX_FAILURES,
+        eject_seconds: float = LLM_BACKEND_EJECT_SECONDS,
+        acquire_timeout: float = LLM_BACKEND_ACQUIRE_TIMEOUT_SECONDS,
+        affinity_load_factor: float = LLM_AFFINITY_LOAD_FACTOR,
+        affinity_tracked: int = LLM_AFFINITY_TRACKED,
+        retry_attempts: int = LLM_RETRY_ATTEMPTS,
+        retry_backoff: float = LLM_RETRY_BACKOFF_MS / 1000,
+        retry_backoff_max: float = LLM_RETRY_BACKOFF_MAX_MS / 1000,
+        hedge_percentile: float = LLM_HEDGE_PERCENTILE,
+        hedge_min_delay: float = LLM_HEDGE_MIN_DELAY_MS / 1000,
+    ):
+        if not backends:
+            raise RuntimeError("The LLM backend pool needs at least one backend")
+        if routing not in ROUTING_MODES:
+            raise RuntimeError(f"Unknown LLM_ROUTING '{routing}'. Expected one of: {', '.join(ROUTING_MODES)}")
+        self.backends = backends
+        self.routing = routing
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.acquire_timeout = acquire_timeout
+        self.affinity_load_factor = affinity_load_factor
+        self.affinity_tracked = affinity_tracked
+        self.retry_attempts = retry_attempts
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._ttft_window: deque = deque(maxlen=HEDGE_WINDOW)
+        self._hedge_delay: Optional[float] = None
+        self._ttft_samples = 0
+        self._released = asyncio.Event()
+        self._last_route: "OrderedDict[str, str]" = OrderedDict()
+        self._ring = sorted(
+            (_hash(f"{backend.name}#{i}"), index)
+            for index, backend in enumerate(backends)
+            for i in range(max(1, round(RING_POINTS_PER_WEIGHT * backend.weight)))
+        )
+        self._ring_hashes = [point for point, _ in self._ring]
+
+    @property
+    def model_key(self) -> str:
+        """Identifies the model(s) answering through this pool, for cache keys."""
+        return "|".join(sorted({b.model for b in self.backends}))
+
+    @property
+    def capacity(self) -> int:
+        """Total concurrency limit of the pool, or 0 if any backend is unlimited."""
+        if any(not b.max_concurrency for b in self.backends):
+            return 0
+        return sum(b.max_concurrency for b in self.backends)
+
+    def _score(self, backend: Backend) -> float:
+        load = (backend.outstanding + 1) / backend.weight
+        if self.routing == "ewma":
+            # Unmeasured backends score 0 so they get a first sample quickly
+            return (backend.ewma_latency or 0.0) * load
+        return load
+
+    def pick(self, affinity_key=None, avoid=()) -> Optional[Backend]:
+        """Picks a backend, preferring ones not in `avoid` (already tried for this request)."""
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b.healthy(now)] or self.backends
+        candidates = [b for b in candidates if b.has_capacity()]
+        if avoid:
+            candidates = [b for b in candidates if b not in avoid] or candidates
+        if not candidates:
+            return None
+        if self.routing == "affinity" and affinity_key is not None:
+            backend = self._pick_affine(str(affinity_key), candidates)
+            if backend is not None:
+                return backend
+        return min(candidates, key=lambda b: (self._score(b), b.outstanding))
+
+    def _pick_affine(self, key: str, candidates: List[Backend]) -> Optional[Backend]:
+        allowed = {id(b) for b in candidates}
+        in_flight = sum(b.outstanding for b in self.backends) + 1
+        total_weight = sum(b.weight for b in self.backends)
+        start = bisect.bisect(self._ring_hashes, _hash(key))
+        seen = set()
+        for offset in range(len(self._ring)):
+            backend = self.backends[self._ring[(start + offset) % len(self._ring)][1]]
+            if id(backend) in seen:
+                continue
+            seen.add(id(backend))
+            bound = math.ceil(self.affinity_load_factor * in_flight * backend.weight / total_weight)
+            if id(backend) in allowed and backend.outstanding < bound:
+                return backend
+            if len(seen) == len(self.backends):
+                break
+        return None
+
+    def note_route(self, affinity_key, backend: Backend) -> Optional[bool]:
+        """
+        Remembers which backend served a conversation and returns whether it is the
+        one that served its previous turn (its prompt prefix is likely cached there).
+        Returns None for the first turn seen or when there is no key.
+        """
+        if affinity_key is None or self.affinity_tracked <= 0:
+            return None
+        key = str(affinity_key)
+        previous = self._last_route.pop(key, None)
+        self._last_route[key] = backend.name
+        while len(self._last_route) > self.affinity_tracked:
+            self._last_route.popitem(last=False)
+        if previous is None:
+            return None
+        hit = previous == backend.name
+        if hit:
+            backend.prefix_hits += 1
+        else:
+            backend.prefix_misses += 1
+        return hit
+
+    def _take(self, backend: Backend) -> Backend:
+        backend.outstanding += 1
+        backend.requests += 1
+        if backend.tripped:
+            backend.probing = True
+        return backend
+
+    async def acquire(self, affinity_key=None, avoid=()) -> Backend:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.acquire_timeout
+        while True:
+            backend = self.pick(affinity_key, avoid)
+            if backend is not None:
+                return self._take(backend)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise NoBackendAvailable("All LLM backends are at their concurrency limit")
+            released = self._released
+            try:
+                await asyncio.wait_for(released.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def try_acquire_other(self, avoid) -> Optional[Backend]:
+        """A backend outside `avoid` with a free slot right now, for a hedged request."""
+        backend = self.pick(avoid=avoid)
+        if backend is None or backend in avoid or not backend.healthy(time.monotonic()):
+            return None
+        return self._take(backend)
+
+    def release(self, backend: Backend) -> None:
+        backend.outstanding -= 1
+        backend.probing = False
+        self._released.set()
+        self._released = asyncio.Event()
+
+    def record_latency(self, backend: Backend, seconds: float, prefix_hit: Optional[bool] = None) -> None:
+        if prefix_hit is not None:
+            backend._ttft[prefix_hit][0] += seconds
+            backend._ttft[prefix_hit][1] += 1
+        if backend.ewma_latency is None:
+            backend.ewma_latency = seconds
+        else:
+            backend.ewma_latency += EWMA_ALPHA * (seconds - backend.ewma_latency)
+        if self.hedge_percentile:
+            self._ttft_window.append(seconds)
+            self._ttft_samples += 1
+            # The percentile is refreshed every HEDGE_REFRESH_EVERY samples, not re-sorted per request
+            if len(self._ttft_window) >= HEDGE_MIN_SAMPLES and (
+                self._hedge_delay is None or self._ttft_samples % HEDGE_REFRESH_EVERY == 0
+            ):
+                self._update_hedge_delay()
+
+    def _update_hedge_delay(self) -> None:
+        ordered = sorted(self._ttft_window)
+        rank = max(0, math.ceil(self.hedge_percentile / 100 * len(ordered)) - 1)
+        self._hedge_delay = max(self.hedge_min_delay, ordered[rank])
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds without a first token after which a hedged request is sent, or None."""
+        if not self.hedge_percentile or len(self.backends) < 2:
+            return None
+        return self._hedge_delay
+
+    def retry_delay(self, attempt: int) -> float:
+        """Full-jitter exponential backoff before retry number `attempt` (0-based)."""
+        return random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * 2 ** attempt))
+
+    def record_success(self, backend: Backend) -> None:
+        backend.consecutive_failures = 0
+        if backend.tripped:
+            backend.tripped = False
+            print(f"LLM backend '{backend.name}' recovered")
+
+    def record_failure(self, backend: Backend) -> None:
+        backend.failures += 1
+        backend.consecutive_failures += 1
+        if self.max_failures and backend.consecutive_failures >= self.max_failures:
+            backend.ejected_until = time.monotonic() + self.eject_seconds
+            backend.ejections += 1
+            backend.tripped = True
+            print(f"Ejecting LLM backend '{backend.name}' for {self.eject_seconds:g}s after {backend.consecutive_failures} failures")
+
+    def stats(self) -> dict:
+        hedge_delay = self.hedge_delay()
+        return {
+            "routing": self.routing,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_delay_ms": round(hedge_delay * 1000, 1) if hedge_delay is not None else None,
+            "backends": [b.stats() for b in self.backends],
+        }
+
+
+def load_backends(spec: str, default_api_key: Optional[str], default_model: str) -> List[Backend]:
+    """Builds backends from the LLM_BACKENDS JSON list."""
+    try:
+        entries = json.loads(spec)
+    except json.JSONDecodeError as e:
+        raise RuntimeError(f"LLM_BACKENDS is not valid JSON: {e}")
+    if not isinstance(entries, list):
+        raise RuntimeError("LLM_BACKENDS must be a JSON list of backend objects")
+    backends = []
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get("base_url"):
+            raise RuntimeError(f"LLM_BACKENDS entry {i} needs a base_url")
+        api_key = entry.get("api_key") or default_api_key
+        if not api_key:
+            raise RuntimeError(f"LLM_BACKENDS entry {i} needs an api_key (or set LLM_API_KEY)")
+        client = AsyncOpenAI(
+            base_url=entry["base_url"],
+            api_key=api_key,
+            http_client=upstream_http.client,
+            timeout=upstream_http.timeout,
+            # Retries are done by the pool, where they can move to another backend
+            max_retries=0,
+        )
+        backends.append(Backend(
+            name=entry.get("name") or entry["base_url"],
+            client=client,
+            model=entry.get("model") or default_model,
+            weight=float(entry.get("weight", 1)),
+            max_concurrency=int(entry.get("max_concurrency", LLM_BACKEND_MAX_CONCURRENCY)),
+        ))
+    return backends
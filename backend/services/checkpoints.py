@@ -0,0 +1,228 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import update
+
+import models
+from database import write_lock
+from services.metrics import db_commit_seconds
+
+# An in-flight answer is written to its Message row every CHECKPOINT_EVERY_TOKENS
+# deltas or CHECKPOINT_EVERY_SECONDS, whichever comes first. Set both to 0 to
+# only write answers once they are complete.
+CHECKPOINT_EVERY_TOKENS = int(os.getenv("CHECKPOINT_EVERY_TOKENS", "64"))
+CHECKPOINT_EVERY_SECONDS = float(os.getenv("CHECKPOINT_EVERY_SECONDS", "2"))
+# Rows still "streaming" at startup belong to a process that died. Another worker
+# on the same database may still be writing its own, so only rows not checkpointed
+# for several checkpoint intervals are touched; a second pass once the grace has
+# passed picks up rows that were still too fresh at startup.
+CHECKPOINT_RECOVERY_GRACE_SECONDS = float(
+    os.getenv("CHECKPOINT_RECOVERY_GRACE_SECONDS", str(max(10.0, 5 * CHECKPOINT_EVERY_SECONDS)))
+)
+
+# The final write of a checkpointed answer is retried before giving up on it
+FINALIZE_ATTEMPTS = 3
+FINALIZE_RETRY_DELAY_SECONDS = 0.05
+
+
+class ChunkAccumulator:
+    """
+    Collects streamed deltas in a list and only joins them when the text is
+    needed, instead of growing a string with += on every token.
+    """
+
+    def __init__(self, every_tokens: int = CHECKPOINT_EVERY_TOKENS, every_seconds: float = CHECKPOINT_EVERY_SECONDS):
+        self.every_tokens = every_tokens
+        self.every_seconds = every_seconds
+        self.tokens = 0
+        self._parts = []
+        self._checkpoint_tokens = 0
+        self._checkpoint_time = time.monotonic()
+
+    def append(self, text: str) -> None:
+        self._parts.append(text)
+        self.tokens += 1
+
+    def text(self) -> str:
+        if len(self._parts) > 1:
+            self._parts[:] = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def checkpoint_due(self) -> bool:
+        """True once every_tokens deltas or every_seconds passed since the last checkpoint."""
+        due = bool(self.every_tokens) and self.tokens - self._checkpoint_tokens >= self.every_tokens
+        if not due and self.every_seconds and self.tokens > self._checkpoint_tokens:
+            due = time.monotonic() - self._checkpoint_time >= self.every_seconds
+        if due:
+            self._checkpoint_tokens = self.tokens
+            self._checkpoint_time = time.monotonic()
+        return due
+
+
+class CheckpointStats:
+    def __init__(self):
+        self.checkpoints = 0
+        self.skipped = 0
+        self.errors = 0
+        self.recovered = 0
+
+    def stats(self) -> dict:
+        return {
+            "checkpoints": self.checkpoints,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "recovered": self.recovered,
+        }
+
+
+checkpoint_stats = CheckpointStats()
+
+
+class ResponseCheckpointer:
+    """
+    Keeps the partial answer of one response in a Message row with status
+    "streaming". The row is inserted on the first checkpoint and updated on
+    later ones. Writes run in a background task so the token loop never waits
+    on the database; a checkpoint that comes while a write is still running is
+    skipped, the next one carries the newer text anyway. A checkpoint still
+    waiting for the write lock when the answer completes is dropped.
+    """
+
+    def __init__(self, session_factory, conversation_id: int, stats: Optional[CheckpointStats] = None):
+        self._session_factory = session_factory
+        self.conversation_id = conversation_id
+        self.stats = stats if stats is not None else checkpoint_stats
+        self.message_id: Optional[int] = None
+        self.finalized = False
+        self._task: Optional[asyncio.Task] = None
+        # True while the background write holds the write lock
+        self._writing = False
+
+    async def checkpoint(self, content: str) -> None:
+        if self.finalized:
+            return
+        if self._task is not None and not self._task.done():
+            self.stats.skipped += 1
+            return
+        self._task = asyncio.create_task(self._write(content))
+
+    async def finalize(self, content: str, duration_ms: int, truncated: bool = False) -> bool:
+        """
+        Writes the final answer into the checkpointed row and marks it complete.
+        Returns False only when nothing was checkpointed, the caller stores the
+        answer then. Once a row exists the answer must not be inserted again: the
+        final write is retried, and if it keeps failing the row is marked interrupted.
+        """
+        self.finalized = True
+        if self._task is not None and not self._writing:
+            # Still queued for the write lock: the final write below supersedes it
+            self._task.cancel()
+        await self._drain()
+        if self.message_id is None:
+            return False
+        for attempt in range(FINALIZE_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(FINALIZE_RETRY_DELAY_SECONDS * attempt)
+            if await self._update(
+                content=content,
+                response_time=duration_ms,
+                truncated=truncated,
+                status="complete",
+            ):
+                return True
+        await self._update(truncated=True, status="interrupted")
+        return True
+
+    async def abandon(self) -> None:
+        """Marks a checkpointed row that was never finalized (e.g. upstream error) as interrupted."""
+        await self._drain()
+        if self.finalized:
+            return
+        self.finalized = True
+        if self.message_id is not None:
+            await self._update(truncated=True, status="interrupted")
+
+    async def _drain(self) -> None:
+        if self._task is not None:
+            await asyncio.wait({self._task})
+            self._task = None
+
+    async def _write(self, content: str) -> None:
+        try:
+            async with self._session_factory() as db_session, write_lock(db_session):
+                self._writing = True
+                try:
+                    if self.message_id is None:
+                        row = models.Message(
+                            conversation_id=self.conversation_id,
+                            role="assistant",
+                            content=content,
+                            status="streaming",
+                            updated_at=datetime.utcnow(),
+                        )
+                        db_session.add(row)
+                        with db_commit_seconds.time(("checkpoint",)):
+                            await db_session.commit()
+                        self.message_id = row.id
+                    elif not await self._execute_update(db_session, content=content):
+                        return
+                finally:
+                    self._writing = False
+            self.stats.checkpoints += 1
+        except Exception as e:
+            self.stats.errors += 1
+            print(f"Error checkpointing response for conversation {self.conversation_id}: {e}")
+
+    async def _update(self, **values) -> bool:
+        async with self._session_factory() as db_session:
+            try:
+                async with write_lock(db_session):
+                    return await self._execute_update(db_session, **values)
+            except Exception as e:
+                # Checking out a connection failed
+                self.stats.errors += 1
+                print(f"Error updating checkpointed message {self.message_id}: {e}")
+                return False
+
+    async def _execute_update(self, db_session, **values) -> bool:
+        try:
+            await db_session.execute(
+                update(models.Message)
+                .where(models.Message.id == self.message_id)
+                .values(updated_at=datetime.utcnow(), **values)
+            )
+            with db_commit_seconds.time(("checkpoint",)):
+                await db_session.commit()
+            return True
+        except Exception as e:
+            await db_session.rollback()
+            self.stats.errors += 1
+            print(f"Error updating checkpointed message {self.message_id}: {e}")
+            return False
+
+
+async def recover_interrupted_messages(session_factory, grace_seconds: float = CHECKPOINT_RECOVERY_GRACE_SECONDS) -> int:
+    """Marks answers left in the "streaming" state by a previous process as interrupted."""
+    query = update(models.Message).where(models.Message.status == "streaming")
+    if grace_seconds > 0:
+        cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+        query = query.where(models.Message.updated_at < cutoff)
+    async with session_factory() as db_session:
+        result = await db_session.execute(query.values(status="interrupted", truncated=True))
+        await db_session.commit()
+    checkpoint_stats.recovered += result.rowcount
+    return result.rowcount
+
+
+async def recover_after_grace(session_factory, grace_seconds: float = CHECKPOINT_RECOVERY_GRACE_SECONDS) -> int:
+    """Runs recovery again once rows that were still fresh at startup have gone stale."""
+    if grace_seconds <= 0:
+        return 0
+    await asyncio.sleep(grace_seconds)
+    recovered = await recover_interrupted_messages(session_factory, grace_seconds)
+    if recovered:
+        print(f"Marked {recovered} interrupted assistant message(s) from a previous run")
+    return recovered
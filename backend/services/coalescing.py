@@ -0,0 +1,130 @@
+import asyncio
+import os
+from typing import AsyncIterator, Optional
+
+import anyio
+
+# Content deltas are buffered for at most SSE_COALESCE_MS before they are sent
+# as one frame, or until SSE_COALESCE_BYTES have accumulated. 0 ms disables
+# buffering; requests can override both values.
+SSE_COALESCE_MS = int(os.getenv("SSE_COALESCE_MS", "0"))
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "1024"))
+
+
+class CoalescingStats:
+    """Frames sent per response and upstream deltas merged into each frame."""
+
+    def __init__(self):
+        self.responses = 0
+        self.frames = 0
+        self.deltas = 0
+
+    def record(self, frames: int, deltas: int) -> None:
+        self.responses += 1
+        self.frames += frames
+        self.deltas += deltas
+
+    def stats(self) -> dict:
+        return {
+            "responses": self.responses,
+            "frames": self.frames,
+            "deltas": self.deltas,
+            "frames_per_response": self.frames / self.responses if self.responses else 0.0,
+            "deltas_per_frame": self.deltas / self.frames if self.frames else 0.0,
+        }
+
+
+coalescing_stats = CoalescingStats()
+
+
+async def coalesce_events(
+    events: AsyncIterator,
+    max_delay_ms: int = SSE_COALESCE_MS,
+    max_bytes: int = SSE_COALESCE_BYTES,
+    stats: Optional[CoalescingStats] = None,
+):
+    """
+    Merges consecutive {"content": ...} events into one event per time window.
+    The first content event is always sent immediately so time-to-first-token
+    is unchanged; later ones are held until max_delay_ms after the first
+    buffered delta or until max_bytes are buffered. Any other event flushes
+    the buffer and is passed on; the metadata event gets the frame count.
+    """
+    stats = stats if stats is not None else coalescing_stats
+    loop = asyncio.get_running_loop()
+    max_delay = max_delay_ms / 1000
+    source = events.__aiter__()
+    frames = 0
+    deltas = 0
+    buffer = []
+    buffered_bytes = 0
+    deadline = 0.0
+    first_sent = False
+    # While content is buffered the next upstream event is awaited in a task, so
+    # the buffer can be flushed on time without cancelling the upstream read.
+    pending = None
+
+    try:
+        while True:
+            try:
+                if pending is None and not buffer:
+                    event = await source.__anext__()
+                else:
+                    if pending is None:
+                        pending = asyncio.ensure_future(source.__anext__())
+                    if buffer:
+                        done, _ = await asyncio.wait({pending}, timeout=max(0.0, deadline - loop.time()))
+                        if not done:
+                            frames += 1
+                            yield {"content": "".join(buffer)}
+                            buffer.clear()
+                            buffered_bytes = 0
+                            continue
+                    task, pending = pending, None
+                    event = await task
+            except StopAsyncIteration:
+                break
+
+            if isinstance(event, dict) and "content" in event and len(event) == 1:
+                deltas += 1
+                if max_delay <= 0 or not first_sent:
+                    first_sent = True
+                    frames += 1
+                    yield event
+                    continue
+                if not buffer:
+                    deadline = loop.time() + max_delay
+                buffer.append(event["content"])
+                buffered_bytes += len(event["content"].encode())
+                if buffered_bytes >= max_bytes:
+                    frames += 1
+                    yield {"content": "".join(buffer)}
+                    buffer.clear()
+                    buffered_bytes = 0
+                continue
+
+            if buffer:
+                frames += 1
+                yield {"content": "".join(buffer)}
+                buffer.clear()
+                buffered_bytes = 0
+            frames += 1
+            if isinstance(event, dict) and event.get("type") == "metadata":
+                event["frames"] = frames
+            yield event
+
+        if buffer:
+            frames += 1
+            yield {"content": "".join(buffer)}
+    finally:
+        if pending is not None:
+            # Cancelling the read stops the upstream generation like a disconnect does
+            pending.cancel()
+            with anyio.CancelScope(shield=True):
+                try:
+                    await pending
+                except (asyncio.CancelledError, StopAsyncIteration):
+                    pass
+                except Exception as e:
+                    print(f"Error stopping coalesced stream: {e}")
+        stats.record(frames, deltas)
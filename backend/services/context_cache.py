@@ -0,0 +1,118 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+CONTEXT_CACHE_MAX_BYTES = int(os.getenv("CONTEXT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+CONTEXT_CACHE_MAX_CONVERSATIONS = int(os.getenv("CONTEXT_CACHE_MAX_CONVERSATIONS", "1024"))
+# The cache is per process and only sees the writes of its own worker: with
+# several uvicorn workers another worker's turns would leave it stale, so it is
+# off unless the app runs in a single worker.
+CONTEXT_CACHE_ENABLED = int(os.getenv("WEB_CONCURRENCY", "1")) <= 1
+
+
+def _message_size(message: dict) -> int:
+    # Rough in-memory footprint: content dominates, role is a short constant string.
+    return len(message.get("content") or "") + len(message.get("role") or "")
+
+
+class ConversationContextCache:
+    """
+    Per-conversation LRU cache of prompt history (list of {"role", "content"} dicts).
+    Entries are evicted least-recently-used first whenever the total cached size
+    exceeds max_bytes or more than max_conversations are held. Single-worker
+    only: when disabled every get() misses and nothing is stored.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = CONTEXT_CACHE_MAX_BYTES,
+        max_conversations: int = CONTEXT_CACHE_MAX_CONVERSATIONS,
+        enabled: bool = CONTEXT_CACHE_ENABLED,
+    ):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.max_conversations = max_conversations
+        self._entries: "OrderedDict[int, List[dict]]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, conversation_id: int) -> Optional[List[dict]]:
+        with self._lock:
+            messages = self._entries.get(conversation_id) if self.enabled else None
+            if messages is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(conversation_id)
+            self.hits += 1
+            return list(messages)
+
+    def put(self, conversation_id: int, messages: List[dict]) -> None:
+        entry = [{"role": m["role"], "content": m["content"]} for m in messages]
+        size = sum(_message_size(m) for m in entry)
+        with self._lock:
+            self._remove(conversation_id)
+            if not self.enabled or size > self.max_bytes:
+                return
+            self._entries[conversation_id] = entry
+            self._sizes[conversation_id] = size
+            self._total_bytes += size
+            self._evict()
+
+    def append(self, conversation_id: int, message: dict) -> bool:
+        """Append a message to a cached conversation. Uncached conversations are left alone."""
+        entry = {"role": message["role"], "content": message["content"]}
+        size = _message_size(entry)
+        with self._lock:
+            messages = self._entries.get(conversation_id)
+            if messages is None:
+                return False
+            messages.append(entry)
+            self._sizes[conversation_id] += size
+            self._total_bytes += size
+            self._entries.move_to_end(conversation_id)
+            if self._sizes[conversation_id] > self.max_bytes:
+                self._remove(conversation_id)
+                return False
+            self._evict()
+            return True
+
+    def invalidate(self, conversation_id: int) -> None:
+        with self._lock:
+            self._remove(conversation_id)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "conversations": len(self._entries),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, conversation_id: int) -> None:
+        if conversation_id in self._entries:
+            del self._entries[conversation_id]
+            self._total_bytes -= self._sizes.pop(conversation_id)
+
+    def _evict(self) -> None:
+        while self._entries and (
+            self._total_bytes > self.max_bytes or len(self._entries) > self.max_conversations
+        ):
+            conversation_id, _ = self._entries.popitem(last=False)
+            self._total_bytes -= self._sizes.pop(conversation_id)
+            self.evictions += 1
+
+
+context_cache = ConversationContextCache()
@@ -0,0 +1,174 @@
+import os
+import re
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Protocol
+
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "3072"))
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "384"))
+# After folding, the kept turns only fill this fraction of the budget so the
+# summary is not rebuilt on every single turn of a long chat.
+CONTEXT_LOW_WATERMARK = float(os.getenv("CONTEXT_LOW_WATERMARK", "0.75"))
+# "auto" uses tiktoken when it is installed and its encoding is available offline,
+# "heuristic" never touches tiktoken, "tiktoken:<encoding>" forces an encoding.
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "auto")
+
+# Chat templates add a few tokens of framing around every message.
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+SUMMARY_SNIPPET_CHARS = 240
+
+_THINK_BLOCK = re.compile(r"<think>.*?</think>", re.DOTALL)
+_WIDE_CHARS = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+
+
+class Tokenizer(Protocol):
+    def count(self, text: str) -> int: ...
+
+
+class HeuristicTokenizer:
+    """
+    Offline token estimate: about four characters per token for latin text,
+    one token per CJK character. Deliberately errs on the high side.
+    """
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        wide = len(_WIDE_CHARS.findall(text))
+        return wide + (len(text) - wide + 3) // 4
+
+
+class TiktokenTokenizer:
+    def __init__(self, encoding_name: str = "cl100k_base"):
+        import tiktoken
+
+        self._encoding = tiktoken.get_encoding(encoding_name)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+def get_tokenizer(spec: str = CONTEXT_TOKENIZER) -> Tokenizer:
+    if spec == "heuristic":
+        return HeuristicTokenizer()
+    encoding_name = spec.split(":", 1)[1] if spec.startswith("tiktoken:") else "cl100k_base"
+    try:
+        return TiktokenTokenizer(encoding_name)
+    except Exception:
+        # tiktoken missing, or its encoding file cannot be fetched without network access
+        if spec.startswith("tiktoken:"):
+            raise
+        return HeuristicTokenizer()
+
+
+def extractive_summary(previous: Optional[str], messages: List[dict], max_tokens: int, tokenizer: Tokenizer) -> str:
+    """
+    Fold messages into the previous summary without calling the model: one
+    line per turn with the opening of its content, keeping the newest lines
+    that fit within max_tokens.
+    """
+    lines = previous.splitlines() if previous else []
+    for m in messages:
+        text = " ".join(_THINK_BLOCK.sub("", m.get("content") or "").split())
+        if not text:
+            continue
+        if len(text) > SUMMARY_SNIPPET_CHARS:
+            text = text[:SUMMARY_SNIPPET_CHARS].rsplit(" ", 1)[0] + "..."
+        lines.append(f"{m.get('role', 'user')}: {text}")
+
+    kept: List[str] = []
+    used = 0
+    for line in reversed(lines):
+        cost = tokenizer.count(line) + 1
+        if used + cost > max_tokens:
+            break
+        kept.append(line)
+        used += cost
+    return "\n".join(reversed(kept))
+
+
+Summarizer = Callable[[Optional[str], List[dict], int, Tokenizer], str]
+
+
+@dataclass
+class ContextWindow:
+    messages: List[dict]
+    summary: Optional[str]
+    summarized_count: int
+    tokens: int
+
+
+class ContextWindowManager:
+    """
+    Fits a conversation into a token budget. The newest turns are sent
+    verbatim; older turns are folded into a rolling summary that is sent as a
+    system message. `summarized_count` is the number of leading history
+    messages already covered by `summary`, so callers can cache the summary
+    and only fold new turns as the conversation grows.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = CONTEXT_MAX_TOKENS,
+        summary_max_tokens: int = CONTEXT_SUMMARY_MAX_TOKENS,
+        tokenizer: Optional[Tokenizer] = None,
+        summarizer: Summarizer = extractive_summary,
+        low_watermark: float = CONTEXT_LOW_WATERMARK,
+    ):
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.tokenizer = tokenizer or get_tokenizer()
+        self.summarizer = summarizer
+        self.low_watermark = low_watermark
+
+    def count_message(self, message: dict) -> int:
+        return self.tokenizer.count(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+    def fit(self, history: List[dict], message: str, summary: Optional[str] = None, summarized_count: int = 0) -> ContextWindow:
+        if summarized_count > len(history) or (summarized_count and not summary):
+            # The cached summary does not describe this history; start over.
+            summary, summarized_count = None, 0
+
+        user_message = {"role": "user", "content": message}
+        budget = self.max_tokens - self.count_message(user_message)
+        tail = history[summarized_count:]
+        costs = [self.count_message(m) for m in tail]
+        summary_cost = self._summary_cost(summary)
+
+        if sum(costs) + summary_cost > budget:
+            keep_budget = int((budget - self.summary_max_tokens - MESSAGE_OVERHEAD_TOKENS) * self.low_watermark)
+            kept = 0
+            used = 0
+            for cost in reversed(costs):
+                if used + cost > keep_budget:
+                    break
+                used += cost
+                kept += 1
+            folded = tail[: len(tail) - kept]
+            summary = self.summarizer(summary, folded, self.summary_max_tokens, self.tokenizer) or None
+            summarized_count += len(folded)
+            tail = tail[len(tail) - kept:]
+            costs = costs[len(costs) - kept:]
+            summary_cost = self._summary_cost(summary)
+
+        messages = []
+        if summary:
+            messages.append({"role": "system", "content": SUMMARY_PREFIX + summary})
+        messages.extend(tail)
+        messages.append(user_message)
+        return ContextWindow(
+            messages=messages,
+            summary=summary,
+            summarized_count=summarized_count,
+            tokens=sum(costs) + summary_cost + self.count_message(user_message),
+        )
+
+    def _summary_cost(self, summary: Optional[str]) -> int:
+        if not summary:
+            return 0
+        return self.tokenizer.count(SUMMARY_PREFIX + summary) + MESSAGE_OVERHEAD_TOKENS
+
+
+context_window = ContextWindowManager()
@@ -1,8 +1,27 @@
 import os
-import json
+import asyncio
 import time
+import anyio
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+import httpx
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, InternalServerError
+
+from services.backends import LLM_BACKENDS, Backend, BackendPool, load_backends
+from services.checkpoints import ChunkAccumulator
+from services.context_window import context_window
+from services.metrics import (
+    generation_seconds,
+    generations_total,
+    inter_token_seconds,
+    output_tokens,
+    queue_wait_seconds,
+    ttft_seconds,
+)
+from services.response_cache import response_cache
+from services.scheduler import GENERATION_MAX_CONCURRENCY, GenerationScheduler
+from services.single_flight import SINGLE_FLIGHT, SINGLE_FLIGHT_MAX_TEMPERATURE, single_flight
+from services.tracing import current_trace, span
+from services.upstream_http import StallWatchdog, UpstreamTimeout, upstream_http
 
 load_dotenv()
 
@@ -15,45 +34,387 @@ def _require_env(var_name: str) -> str:
         )
     return value
 
-BASE_URL = _require_env("LLM_BASE_URL")
-API_KEY = _require_env("LLM_API_KEY")
+MODEL_NAME = "qwen/qwen3-1.7b"  # LM Studio usually ignores this or maps it to the loaded model
+
+if LLM_BACKENDS:
+    # Several inference servers; `client` stays available as the first of them
+    backend_pool = BackendPool(load_backends(LLM_BACKENDS, os.getenv("LLM_API_KEY"), MODEL_NAME))
+    client = backend_pool.backends[0].client
+else:
+    BASE_URL = _require_env("LLM_BASE_URL")
+    API_KEY = _require_env("LLM_API_KEY")
+    client = AsyncOpenAI(
+        base_url=BASE_URL,
+        api_key=API_KEY,
+        http_client=upstream_http.client,
+        timeout=upstream_http.timeout,
+        max_retries=0,
+    )
+    backend_pool = BackendPool([Backend("default", client, MODEL_NAME)])
 
-client = AsyncOpenAI(base_url=BASE_URL, api_key=API_KEY)
+generation_scheduler = GenerationScheduler(GENERATION_MAX_CONCURRENCY or backend_pool.capacity)
 
-async def stream_llm_response(message: str, history: list, on_complete=None, top_p=0.9, temperature=0.7):
+
+class CancellationStats:
     """
-    Streams the response from the LLM.
-    on_complete: async callback function(content, duration_ms)
+    Counts generations stopped because the client disconnected. Tokens saved
+    are estimated from a moving average of the length of completed answers.
+    """
+
+    def __init__(self):
+        self.completed = 0
+        self.cancelled = 0
+        self.tokens_before_cancel = 0
+        self.tokens_saved_estimate = 0
+        self.avg_completion_tokens = 0.0
+
+    def record_completion(self, tokens: int) -> None:
+        self.completed += 1
+        if self.completed == 1:
+            self.avg_completion_tokens = float(tokens)
+        else:
+            self.avg_completion_tokens += 0.1 * (tokens - self.avg_completion_tokens)
+
+    def record_cancellation(self, tokens: int) -> None:
+        self.cancelled += 1
+        self.tokens_before_cancel += tokens
+        self.tokens_saved_estimate += max(0, round(self.avg_completion_tokens) - tokens)
+
+    def stats(self) -> dict:
+        return {
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "tokens_before_cancel": self.tokens_before_cancel,
+            "tokens_saved_estimate": self.tokens_saved_estimate,
+        }
+
+
+cancellation_stats = CancellationStats()
+
+# Failures before the first token that another attempt may not hit: the request
+# did not reach a working server, or the server failed it as a whole
+RETRYABLE_ERRORS = (APIConnectionError, InternalServerError, httpx.TransportError)
+
+
+def _backend_at_fault(error: BaseException) -> bool:
+    """
+    Whether an error says something about the backend's health. Client errors
+    (400 bad request, 401 unauthorized, 429 rate limited, ...) are answers from
+    a working server and do not count towards ejecting it.
+    """
+    if isinstance(error, RETRYABLE_ERRORS + (UpstreamTimeout,)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+async def _close_stream(stream) -> None:
+    # Closing the HTTP response makes the upstream server stop generating
+    close = getattr(stream, "close", None) or getattr(stream, "aclose", None)
+    if close is None:
+        return
+    try:
+        await close()
+    except Exception as e:
+        print(f"Error closing upstream stream: {e}")
+
+
+async def _first_chunk(backend: Backend, messages, temperature, top_p):
+    """Opens a completion on `backend` and waits for its first chunk (None for an empty answer)."""
+    stream = await backend.client.chat.completions.create(
+        model=backend.model,
+        messages=messages,
+        stream=True,
+        temperature=temperature,
+        top_p=top_p
+    )
+    chunks = stream.__aiter__()
+    try:
+        return stream, chunks, await chunks.__anext__()
+    except StopAsyncIteration:
+        return stream, chunks, None
+    except BaseException:
+        with anyio.CancelScope(shield=True):
+            await _close_stream(stream)
+        raise
+
+
+async def _race_first_chunk(backend: Backend, messages, temperature, top_p, affinity_key, tried: list):
+    """
+    Waits for the first chunk from `backend` and, once that takes longer than the
+    pool's hedge delay, also from another backend with a free slot. The first
+    one to answer wins and the other is cancelled. Returns (backend, stream,
+    chunks, first chunk) with the winner still acquired; every other backend
+    is released here, and counted as failed if it timed out or failed with
+    a server-side error.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + upstream_http.first_token_timeout if upstream_http.first_token_timeout else None
+    hedge_at = None
+    hedge_delay = backend_pool.hedge_delay()
+    if hedge_delay is not None:
+        hedge_at = started + hedge_delay
+    attempts = {asyncio.create_task(_first_chunk(backend, messages, temperature, top_p)): (backend, started)}
+    error = None
+    timed_out = False
+    try:
+        while attempts:
+            wake_at = min((t for t in (hedge_at, deadline) if t is not None), default=None)
+            done, _ = await asyncio.wait(
+                attempts,
+                timeout=wake_at - loop.time() if wake_at is not None else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                attempt_backend, attempt_started = attempts.pop(task)
+                if task.exception() is None:
+                    if attempt_backend is not backend:
+                        backend_pool.hedge_wins += 1
+                    prefix_hit = backend_pool.note_route(affinity_key, attempt_backend)
+                    backend_pool.record_latency(attempt_backend, loop.time() - attempt_started, prefix_hit)
+                    return (attempt_backend,) + task.result()
+                error = task.exception()
+                if _backend_at_fault(error):
+                    backend_pool.record_failure(attempt_backend)
+                backend_pool.release(attempt_backend)
+            now = loop.time()
+            if hedge_at is not None and now >= hedge_at and attempts:
+                hedge_at = None
+                other = backend_pool.try_acquire_other(tried)
+                if other is not None:
+                    tried.append(other)
+                    backend_pool.hedges += 1
+                    attempts[asyncio.create_task(_first_chunk(other, messages, temperature, top_p))] = (other, now)
+            if deadline is not None and now >= deadline and attempts:
+                timed_out = True
+                raise UpstreamTimeout(f"No first token from {backend.name} within {upstream_http.first_token_timeout:g}s")
+        raise error
+    finally:
+        # Losers, or everything when timed out or cancelled
+        for task in attempts:
+            task.cancel()
+        with anyio.CancelScope(shield=True):
+            results = await asyncio.gather(*attempts, return_exceptions=True)
+            for result in results:
+                if isinstance(result, tuple):
+                    # Answered while being cancelled
+                    await _close_stream(result[0])
+        for attempt_backend, _ in attempts.values():
+            if timed_out:
+                backend_pool.record_failure(attempt_backend)
+            backend_pool.release(attempt_backend)
+
+
+async def _open_upstream(messages, temperature, top_p, affinity_key):
+    """
+    Acquires a backend and waits for the first chunk of a completion. Connection
+    errors and 5xx responses are retried up to the pool's retry_attempts, with
+    jittered backoff and preferably on another backend; nothing has been sent
+    to the client yet at this point.
+    """
+    tried = []
+    attempt = 0
+    while True:
+        backend = await backend_pool.acquire(affinity_key, avoid=tried)
+        tried.append(backend)
+        try:
+            return await _race_first_chunk(backend, messages, temperature, top_p, affinity_key, tried)
+        except RETRYABLE_ERRORS:
+            if attempt >= backend_pool.retry_attempts:
+                raise
+        await asyncio.sleep(backend_pool.retry_delay(attempt))
+        attempt += 1
+        backend_pool.retries += 1
+
+
+async def _upstream_deltas(messages, temperature, top_p, affinity_key=None):
+    """
+    Yields the content deltas of one upstream completion from a backend of the
+    pool and closes it when done or abandoned. Server errors and stalls count
+    against the backend; client errors and a consumer that goes away do not.
+    """
+    backend, stream, chunks, chunk = await _open_upstream(messages, temperature, top_p, affinity_key)
+    # Each chunk has to follow the previous one within the inter-token timeout
+    watchdog = StallWatchdog()
+    try:
+        while chunk is not None:
+            if chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            watchdog.arm(upstream_http.inter_token_timeout)
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                chunk = None
+            watchdog.disarm()
+        backend_pool.record_success(backend)
+    except asyncio.CancelledError:
+        if not watchdog.expired():
+            raise
+        backend_pool.record_failure(backend)
+        raise UpstreamTimeout(f"{backend.name} stalled for more than {upstream_http.inter_token_timeout:g}s between tokens")
+    except Exception as e:
+        if _backend_at_fault(e):
+            backend_pool.record_failure(backend)
+        raise
+    finally:
+        watchdog.close()
+        with anyio.CancelScope(shield=True):
+            await _close_stream(stream)
+        backend_pool.release(backend)
+
+
+async def _abort_generation(stream, content, token_count, start_time, on_complete) -> None:
+    cancellation_stats.record_cancellation(token_count)
+    generations_total.inc(labels=("cancelled",))
+    if stream is not None:
+        await _close_stream(stream)
+    if on_complete and content:
+        duration_ms = int((time.time() - start_time) * 1000)
+        try:
+            await on_complete(content, duration_ms, truncated=True)
+        except Exception as e:
+            print(f"Error saving truncated response: {e}")
+
+
+async def stream_llm_response(
+    message: str,
+    history: list,
+    on_complete=None,
+    top_p=0.9,
+    temperature=0.7,
+    summary=None,
+    summarized_count=0,
+    on_summary=None,
+    on_checkpoint=None,
+    affinity_key=None,
+    admission=None,
+):
+    """
+    Streams the response from the LLM as event dicts: {"content": ...} per token,
+    then {"type": "metadata", ...} or {"error": ...}. services.sse encodes them.
+    The metadata event carries duration_ms, ttft_ms and tokens_per_second (deltas
+    per second after the first one).
+    on_complete: async callback function(content, duration_ms, truncated=False); when the
+        consumer goes away mid-stream it is called with the partial content and truncated=True
+    summary / summarized_count: cached rolling summary covering history[:summarized_count]
+    on_summary: async callback function(summary, summarized_count), called when older turns
+        had to be folded into the summary to fit the context window
+    on_checkpoint: async callback function(partial_content), called every CHECKPOINT_EVERY_TOKENS
+        deltas or CHECKPOINT_EVERY_SECONDS; it must return quickly, it runs inside the token loop
+    affinity_key: routing key (the conversation id) that LLM_ROUTING=affinity keeps on one backend
+    admission: generation_scheduler ticket; while it waits for a slot {"type": "queue", "position": n}
+        events are yielded. It is released when the stream ends. Cached answers and requests
+        that join a running single flight do not wait.
+    With RESPONSE_CACHE enabled, deterministic requests (temperature <= RESPONSE_CACHE_MAX_TEMPERATURE)
+    are answered from the response cache when possible; the metadata event then has cached=True.
     """
-    messages = history + [{"role": "user", "content": message}]
-    
     start_time = time.time()
-    full_content = ""
+    started = time.monotonic()
+    first_token_at = last_token_at = None
+    accumulator = ChunkAccumulator()
+    stream = None
+    completed = False
+    # Per-token stages are summed into the request trace instead of one span per token
+    trace = current_trace()
     
     try:
-        stream = await client.chat.completions.create(
-            model="qwen/qwen3-1.7b", # LM Studio usually ignores this or maps it to the loaded model
-            messages=messages,
-            stream=True,
-            temperature=temperature,
-            top_p=top_p
-        )
+        with span("context_window"):
+            window = context_window.fit(history, message, summary, summarized_count)
+        if on_summary and window.summarized_count != summarized_count:
+            await on_summary(window.summary, window.summarized_count)
+        messages = window.messages
 
-        async for chunk in stream:
-            if chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                full_content += content
-                # SSE format: data: <content>\n\n
-                yield f"data: {json.dumps({'content': content})}\n\n"
+        cache_key = None
+        if response_cache.cacheable(temperature):
+            cache_key = response_cache.key(backend_pool.model_key, messages, temperature, top_p)
+            with span("cache_lookup"):
+                cached = await response_cache.get(cache_key)
+            if cached is not None:
+                # Replay the stored answer through the same event path, without an upstream call
+                accumulator.append(cached)
+                yield {"content": cached}
+                duration_ms = int((time.time() - start_time) * 1000)
+                completed = True
+                generations_total.inc(labels=("cached",))
+                if on_complete:
+                    with anyio.CancelScope(shield=True):
+                        await on_complete(cached, duration_ms)
+                yield {"type": "metadata", "duration_ms": duration_ms, "ttft_ms": duration_ms, "cached": True}
+                return
+
+        flight_key = None
+        if SINGLE_FLIGHT and temperature <= SINGLE_FLIGHT_MAX_TEMPERATURE:
+            # Identical deterministic prompts running at the same time share one upstream stream
+            flight_key = cache_key or response_cache.key(backend_pool.model_key, messages, temperature, top_p)
+
+        if admission is not None and not (flight_key is not None and single_flight.running(flight_key)):
+            queued_at = time.monotonic()
+            async for position in admission.wait():
+                yield {"type": "queue", "position": position}
+            queue_wait_seconds.observe(time.monotonic() - queued_at)
+            if trace is not None:
+                trace.accumulate("queue_wait", time.monotonic() - queued_at)
+
+        if flight_key is not None:
+            stream = single_flight.stream(
+                flight_key, lambda: _upstream_deltas(messages, temperature, top_p, affinity_key), admission
+            )
+            # The flight releases the slot when its upstream generation ends, not when this caller leaves
+            admission = None
+        else:
+            stream = _upstream_deltas(messages, temperature, top_p, affinity_key)
+
+        resumed = time.monotonic()
+        async for content in stream:
+            now = time.monotonic()
+            if trace is not None:
+                trace.accumulate("upstream_ttft" if first_token_at is None else "upstream_wait", now - resumed)
+            if first_token_at is None:
+                first_token_at = now
+                ttft_seconds.observe(now - started)
+            else:
+                inter_token_seconds.observe(now - last_token_at)
+            last_token_at = now
+            accumulator.append(content)
+            if on_checkpoint and accumulator.checkpoint_due():
+                await on_checkpoint(accumulator.text())
+            yield {"content": content}
+            if trace is not None:
+                resumed = time.monotonic()
         
         end_time = time.time()
         duration_ms = int((end_time - start_time) * 1000)
         
+        completed = True
+        cancellation_stats.record_completion(accumulator.tokens)
+        generations_total.inc(labels=("completed",))
+        generation_seconds.observe(time.monotonic() - started)
+        output_tokens.observe(accumulator.tokens)
+        if cache_key is not None:
+            await response_cache.put(cache_key, accumulator.text())
         if on_complete:
-            await on_complete(full_content, duration_ms)
+            # Shielded so a disconnect right at the end cannot lose the finished answer
+            with anyio.CancelScope(shield=True), span("persist"):
+                await on_complete(accumulator.text(), duration_ms)
             
         # Send metadata as the final event
-        yield f"data: {json.dumps({'type': 'metadata', 'duration_ms': duration_ms})}\n\n"
-                
+        metadata = {"type": "metadata", "duration_ms": duration_ms}
+        if first_token_at is not None:
+            metadata["ttft_ms"] = int((first_token_at - started) * 1000)
+            if accumulator.tokens > 1 and last_token_at > first_token_at:
+                metadata["tokens_per_second"] = round((accumulator.tokens - 1) / (last_token_at - first_token_at), 1)
+        yield metadata
+
+    except (asyncio.CancelledError, GeneratorExit):
+        # The consumer was cancelled or closed us (client disconnected): stop the
+        # upstream generation now and keep what was produced so far.
+        if not completed:
+            with anyio.CancelScope(shield=True):
+                await _abort_generation(stream, accumulator.text(), accumulator.tokens, start_time, on_complete)
+        raise
     except Exception as e:
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        generations_total.inc(labels=("error",))
+        yield {"error": str(e)}
+    finally:
+        if admission is not None:
+            admission.release()
@@ -0,0 +1,224 @@
+import bisect
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Bucket upper bounds; +Inf is implied
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+INTER_TOKEN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+TOKEN_BUCKETS = (1, 8, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram in the Prometheus data model. observe() is a
+    bisect and two additions, cheap enough to call once per streamed token.
+    """
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, labels: Tuple = ()) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, labels: Tuple = ()):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, labels)
+
+    def snapshot(self, labels: Tuple = ()) -> Optional[dict]:
+        series = self._series.get(labels)
+        if series is None:
+            return None
+        return {"count": series[2], "sum": series[1], "buckets": list(series[0])}
+
+    def quantile(self, q: float, labels: Tuple = ()) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile, as histogram_quantile() would bracket it."""
+        series = self._series.get(labels)
+        if series is None or not series[2]:
+            return None
+        rank = q * series[2]
+        seen = 0
+        for bound, count in zip(self.buckets + (math.inf,), series[0]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, labels: Tuple = ()) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels: Tuple = ()) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {_format_value(self.value)}",
+        ]
+
+
+class MetricsRegistry:
+    """
+    In-process metrics rendered in the Prometheus text format. Besides its own
+    histograms, counters and gauges it exports the stats() dicts of the other
+    services as series named <prefix>_<component>_<key>; lists of dicts with a
+    "name" become one labelled series per entry. Keys a collector declares as
+    counters (monotonic totals) are exported as counters with a _total suffix,
+    so rate() and increase() handle process restarts; the rest are gauges.
+    """
+
+    def __init__(self, prefix: str = "chat"):
+        self.prefix = prefix
+        self._metrics: list = []
+        self._collectors: Dict[str, Tuple[Callable[[], dict], frozenset]] = {}
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS, labelnames: Sequence[str] = ()) -> Histogram:
+        metric = Histogram(f"{self.prefix}_{name}", documentation, buckets, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(f"{self.prefix}_{name}", documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        metric = Gauge(f"{self.prefix}_{name}", documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, component: str, collect: Callable[[], dict], counters: Sequence[str] = ()) -> None:
+        """`counters` names the stats keys (and fields of listed entries) that only ever grow."""
+        self._collectors[component] = (collect, frozenset(counters))
+
+    def _collected(self, component: str, stats: dict, counters: frozenset = frozenset()) -> List[str]:
+        lines = []
+        for key, value in stats.items():
+            name = f"{self.prefix}_{component}_{key}"
+            if isinstance(value, list):
+                series = [item for item in value if isinstance(item, dict) and "name" in item]
+                fields = sorted({k for item in series for k, v in item.items() if _numeric(v)})
+                for field_name in fields:
+                    series_name, kind = _typed(f"{name}_{field_name}", field_name in counters)
+                    lines.append(f"# TYPE {series_name} {kind}")
+                    for item in series:
+                        if _numeric(item.get(field_name)):
+                            lines.append(f'{series_name}{{name="{_escape(item["name"])}"}} {_format_value(float(item[field_name]))}')
+            elif _numeric(value):
+                series_name, kind = _typed(name, key in counters)
+                lines.append(f"# TYPE {series_name} {kind}")
+                lines.append(f"{series_name} {_format_value(float(value))}")
+        return lines
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for component, (collect, counters) in self._collectors.items():
+            try:
+                lines.extend(self._collected(component, collect(), counters))
+            except Exception as e:
+                print(f"Error collecting {component} metrics: {e}")
+        return "\n".join(lines) + "\n"
+
+
+def _numeric(value) -> bool:
+    return isinstance(value, (int, float)) and not (isinstance(value, float) and math.isnan(value))
+
+
+def _typed(name: str, counter: bool) -> Tuple[str, str]:
+    if counter:
+        return (name if name.endswith("_total") else f"{name}_total"), "counter"
+    return name, "gauge"
+
+
+metrics = MetricsRegistry()
+
+ttft_seconds = metrics.histogram("ttft_seconds", "Time from request to the first streamed token.")
+inter_token_seconds = metrics.histogram(
+    "inter_token_seconds", "Time between consecutive streamed tokens.", INTER_TOKEN_BUCKETS
+)
+generation_seconds = metrics.histogram("generation_seconds", "Total time to generate an answer.")
+output_tokens = metrics.histogram("output_tokens", "Streamed deltas per completed answer.", TOKEN_BUCKETS)
+queue_wait_seconds = metrics.histogram("queue_wait_seconds", "Time a generation waited for an admission slot.")
+db_commit_seconds = metrics.histogram(
+    "db_commit_seconds", "Latency of database commits on the chat path.", DB_BUCKETS, labelnames=("operation",)
+)
+generations_total = metrics.counter("generations_total", "Generations by outcome.", labelnames=("outcome",))
+active_streams = metrics.gauge("active_streams", "Chat responses currently streaming.")
@@ -0,0 +1,189 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import models
+from database import write_lock
+from services.metrics import db_commit_seconds
+
+MESSAGE_WRITER_MAX_BATCH = int(os.getenv("MESSAGE_WRITER_MAX_BATCH", "64"))
+MESSAGE_WRITER_MAX_LATENCY_MS = int(os.getenv("MESSAGE_WRITER_MAX_LATENCY_MS", "50"))
+
+
+@dataclass(eq=False)
+class PendingMessage:
+    conversation_id: int
+    role: str
+    content: str
+    response_time: Optional[int] = None
+    truncated: bool = False
+    status: str = "complete"
+    created_at: datetime = field(default_factory=datetime.utcnow)
+    # Set once the row has been flushed inside the batch transaction
+    id: Optional[int] = None
+
+
+class MessageWriter:
+    """
+    Write-behind persistence for chat messages. Messages are queued in memory
+    and written by a single background task in batched transactions: a batch
+    is committed once it holds max_batch messages or max_latency_ms after its
+    first message arrived, whichever comes first.
+
+    Queued messages stay visible through pending() until their batch commits,
+    so readers can merge them into query results (read-your-writes).
+    """
+
+    def __init__(self, max_batch: int = MESSAGE_WRITER_MAX_BATCH, max_latency_ms: int = MESSAGE_WRITER_MAX_LATENCY_MS):
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms / 1000
+        self._session_factory = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, List[PendingMessage]] = {}
+        self.batches_written = 0
+        self.messages_written = 0
+        self.write_errors = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self, session_factory) -> None:
+        if self.running:
+            return
+        self._session_factory = session_factory
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Flush everything that is still queued, then stop the worker."""
+        if not self.running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def submit(
+        self,
+        conversation_id: int,
+        role: str,
+        content: str,
+        response_time: Optional[int] = None,
+        truncated: bool = False,
+    ) -> PendingMessage:
+        if not self.running:
+            raise RuntimeError("MessageWriter is not running")
+        message = PendingMessage(
+            conversation_id=conversation_id,
+            role=role,
+            content=content,
+            response_time=response_time,
+            truncated=truncated,
+        )
+        self._pending.setdefault(conversation_id, []).append(message)
+        self._queue.put_nowait(message)
+        return message
+
+    def pending(self, conversation_id: int) -> List[PendingMessage]:
+        return list(self._pending.get(conversation_id, ()))
+
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+
+    async def _write(self, batch: List[PendingMessage]) -> None:
+        try:
+            await self._commit(batch)
+        except Exception as e:
+            print(f"Error writing message batch, retrying individually: {e}")
+            for message in batch:
+                message.id = None
+            for message in batch:
+                try:
+                    await self._commit([message])
+                except Exception as e:
+                    self.write_errors += 1
+                    print(f"Error saving message for conversation {message.conversation_id}: {e}")
+        finally:
+            for message in batch:
+                self._forget(message)
+
+    async def _commit(self, batch: List[PendingMessage]) -> None:
+        async with self._session_factory() as db_session, write_lock(db_session):
+            rows = [
+                models.Message(
+                    conversation_id=m.conversation_id,
+                    role=m.role,
+                    content=m.content,
+                    response_time=m.response_time,
+                    truncated=m.truncated,
+                    created_at=m.created_at,
+                )
+                for m in batch
+            ]
+            db_session.add_all(rows)
+            # Flush first so ids are known before the rows become visible to readers
+            await db_session.flush()
+            for message, row in zip(batch, rows):
+                message.id = row.id
+            with db_commit_seconds.time(("message_batch",)):
+                await db_session.commit()
+        self.batches_written += 1
+        self.messages_written += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batches_written": self.batches_written,
+            "messages_written": self.messages_written,
+            "write_errors": self.write_errors,
+        }
+
+    def _forget(self, message: PendingMessage) -> None:
+        pending = self._pending.get(message.conversation_id)
+        if not pending:
+            return
+        try:
+            pending.remove(message)
+        except ValueError:
+            return
+        if not pending:
+            del self._pending[message.conversation_id]
+
+
+def merge_pending(rows: list, pending: List[PendingMessage]) -> list:
+    """
+    Append queued messages to rows read from the DB. `pending` must be captured
+    before the query ran; messages whose batch committed in between are
+    recognised by id and not duplicated.
+    """
+    if not pending:
+        return list(rows)
+    seen = {row.id for row in rows}
+    return list(rows) + [m for m in pending if m.id is None or m.id not in seen]
+
+
+message_writer = MessageWriter()
@@ -0,0 +1,216 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import anyio
+
+# "off" disables rate limiting, "memory" keeps buckets in this process, "sqlite"
+# shares them through RATE_LIMIT_PATH so limits hold across uvicorn workers.
+RATE_LIMIT = os.getenv("RATE_LIMIT", "off")
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", "./rate_limit.db")
+# "requests" charges 1 per chat turn, "tokens" charges the estimated prompt tokens
+RATE_LIMIT_UNIT = os.getenv("RATE_LIMIT_UNIT", "requests")
+# Bucket size (the allowed burst) and refill rate, in units of RATE_LIMIT_UNIT
+RATE_LIMIT_CAPACITY = float(os.getenv("RATE_LIMIT_CAPACITY", "20"))
+RATE_LIMIT_REFILL_PER_SECOND = float(os.getenv("RATE_LIMIT_REFILL_PER_SECOND", "0.2"))
+# In-process buckets kept before full ones are dropped
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+# One statement refills and charges the bucket; no row comes back when it is too empty
+_TAKE_SQL = """
+INSERT INTO rate_limit_buckets (key, tokens, updated_at) VALUES (:key, :capacity - :cost, :now)
+ON CONFLICT(key) DO UPDATE SET
+    tokens = min(:capacity, tokens + max(0, :now - updated_at) * :rate) - :cost,
+    updated_at = :now
+WHERE min(:capacity, tokens + max(0, :now - updated_at) * :rate) >= :cost
+RETURNING tokens
+"""
+
+
+@dataclass
+class RateLimitResult:
+    allowed: bool
+    limit: float
+    remaining: float
+    # Seconds until the bucket is full again
+    reset: float
+    # Seconds until the request could be afforded; 0 when allowed
+    retry_after: float
+
+    def headers(self) -> Dict[str, str]:
+        headers = {
+            "RateLimit-Limit": str(int(self.limit)),
+            "RateLimit-Remaining": str(max(0, int(self.remaining))),
+            "RateLimit-Reset": str(math.ceil(self.reset)),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter keyed by user id. Every key gets a bucket of
+    `capacity` units that refills at `refill_per_second`; a request is allowed
+    when the bucket holds at least its cost. The memory backend is a dict
+    behind a lock; the sqlite backend refills and charges a bucket with a
+    single UPSERT on a small local file, so several workers share limits
+    without touching the application database. Each worker remembers the last
+    level it saw per bucket; other workers can only have drained it since, so
+    a request it could not afford even with everything refilled since then is
+    rejected without touching the file.
+    """
+
+    def __init__(
+        self,
+        mode: str = RATE_LIMIT,
+        path: Optional[str] = RATE_LIMIT_PATH,
+        unit: str = RATE_LIMIT_UNIT,
+        capacity: float = RATE_LIMIT_CAPACITY,
+        refill_per_second: float = RATE_LIMIT_REFILL_PER_SECOND,
+        max_keys: int = RATE_LIMIT_MAX_KEYS,
+    ):
+        if mode not in ("off", "memory", "sqlite"):
+            raise RuntimeError(f"Unknown RATE_LIMIT '{mode}'. Expected one of: off, memory, sqlite")
+        if unit not in ("requests", "tokens"):
+            raise RuntimeError(f"Unknown RATE_LIMIT_UNIT '{unit}'. Expected one of: requests, tokens")
+        self.mode = mode
+        self.path = path if mode == "sqlite" else None
+        self.unit = unit
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        # key -> (tokens, wall time) last read from the shared file
+        self._seen: Dict[str, Tuple[float, float]] = {}
+        self.allowed = 0
+        self.limited = 0
+        self.local_rejections = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def cost(self, tokens: int) -> float:
+        """Units charged for a request with this many estimated tokens, capped at the bucket size."""
+        return min(self.capacity, 1.0 if self.unit == "requests" else float(max(1, tokens)))
+
+    async def check(self, key, cost: float = 1.0) -> Optional[RateLimitResult]:
+        """Charges `cost` to the bucket of `key`; returns None when rate limiting is off."""
+        if not self.enabled:
+            return None
+        cost = min(cost, self.capacity)
+        if self.path:
+            seen = self._seen.get(str(key))
+            upper_bound = self._refilled(*seen, time.time()) if seen else self.capacity
+            if upper_bound < cost:
+                remaining, allowed = upper_bound, False
+                self.local_rejections += 1
+            else:
+                remaining, allowed = await anyio.to_thread.run_sync(self._take_disk, str(key), cost)
+        else:
+            remaining, allowed = self._take_memory(str(key), cost)
+        if allowed:
+            self.allowed += 1
+        else:
+            self.limited += 1
+        rate = self.refill_per_second
+        return RateLimitResult(
+            allowed=allowed,
+            limit=self.capacity,
+            remaining=remaining,
+            reset=(self.capacity - remaining) / rate if rate > 0 else 0.0,
+            retry_after=0.0 if allowed else ((cost - remaining) / rate if rate > 0 else 3600.0),
+        )
+
+    def _refilled(self, tokens: float, updated_at: float, now: float) -> float:
+        return min(self.capacity, tokens + max(0.0, now - updated_at) * self.refill_per_second)
+
+    def _take_memory(self, key: str, cost: float) -> Tuple[float, bool]:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens = self._refilled(*bucket, now) if bucket else self.capacity
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+            return tokens, allowed
+
+    def _prune(self, now: float) -> None:
+        # Buckets that have refilled completely carry no state worth keeping
+        full = [k for k, bucket in self._buckets.items() if self._refilled(*bucket, now) >= self.capacity]
+        for key in full:
+            del self._buckets[key]
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # Losing the last few charges in a power cut is fine for a rate limiter
+            self._db.execute("PRAGMA synchronous=OFF")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+        return self._db
+
+    def _take_disk(self, key: str, cost: float) -> Tuple[float, bool]:
+        # Shared between processes, so buckets are timed by the wall clock
+        now = time.time()
+        params = {"key": key, "cost": cost, "now": now, "capacity": self.capacity, "rate": self.refill_per_second}
+        with self._db_lock:
+            db = self._connect()
+            with db:
+                row = db.execute(_TAKE_SQL, params).fetchone()
+                if row is not None:
+                    tokens, allowed = row[0], True
+                else:
+                    stored, updated_at = db.execute(
+                        "SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?", (key,)
+                    ).fetchone()
+                    tokens, allowed = self._refilled(stored, updated_at, now), False
+        with self._lock:
+            self._seen[key] = (tokens, now)
+            if len(self._seen) > self.max_keys:
+                self._seen.clear()
+        return tokens, allowed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+            self._seen.clear()
+        if self.path:
+            with self._db_lock:
+                with self._connect() as db:
+                    db.execute("DELETE FROM rate_limit_buckets")
+
+    def close(self) -> None:
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            keys = len(self._buckets)
+        return {
+            "mode": self.mode,
+            "unit": self.unit,
+            "keys": keys,
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "local_rejections": self.local_rejections,
+        }
+
+
+chat_rate_limiter = RateLimiter()
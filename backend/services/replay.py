@@ -0,0 +1,230 @@
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Optional, Union
+
+import anyio
+
+# Run answers as resumable generations unless the request says otherwise
+SSE_RESUMABLE = os.getenv("SSE_RESUMABLE", "0") == "1"
+# Frames kept per generation for clients that reconnect with Last-Event-ID
+SSE_REPLAY_MAX_EVENTS = int(os.getenv("SSE_REPLAY_MAX_EVENTS", "4096"))
+# Total size of all replay buffers; finished generations are dropped oldest first beyond it
+SSE_REPLAY_MAX_BYTES = int(os.getenv("SSE_REPLAY_MAX_BYTES", str(32 * 1024 * 1024)))
+# How long a finished generation can still be replayed
+SSE_REPLAY_TTL_SECONDS = float(os.getenv("SSE_REPLAY_TTL_SECONDS", "120"))
+# How long a generation keeps running without any connected client before it is cancelled
+SSE_RESUME_GRACE_SECONDS = float(os.getenv("SSE_RESUME_GRACE_SECONDS", "30"))
+
+
+class ReplayGapError(Exception):
+    """The requested events have already been dropped from the replay buffer."""
+
+
+class Generation:
+    """
+    One chat answer produced by a background task, decoupled from the HTTP
+    response that started it. Every frame gets the next SSE id and is kept in a
+    bounded ring buffer, so any number of subscribers can attach, detach and
+    resume from a Last-Event-ID. When the last subscriber leaves, the task keeps
+    running for grace_seconds and is cancelled if nobody comes back.
+    """
+
+    def __init__(self, registry: "ReplayRegistry", user_id: int, conversation_id: int):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.last_event_id = 0
+        self.size = 0
+        self.done = False
+        self.finished_at: Optional[float] = None
+        self.subscribers = 0
+        self._registry = registry
+        self._frames: deque = deque()
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._grace: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, frames: AsyncIterator[Union[bytes, str]]) -> None:
+        self._task = asyncio.create_task(self._pump(frames))
+        # Also covers a client that never attaches to the response
+        self._arm_grace()
+
+    async def _pump(self, frames) -> None:
+        try:
+            async for frame in frames:
+                self._publish(frame)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Error in generation {self.id}: {e}")
+        finally:
+            with anyio.CancelScope(shield=True):
+                await frames.aclose()
+            self._finish()
+
+    def _publish(self, frame: Union[bytes, str]) -> None:
+        if isinstance(frame, str):
+            frame = frame.encode()
+        self.last_event_id += 1
+        frame = b"id: %d\n" % self.last_event_id + frame
+        self._frames.append((self.last_event_id, frame))
+        self._grow(len(frame))
+        while len(self._frames) > self._registry.max_events:
+            self._grow(-len(self._frames.popleft()[1]))
+        self._notify()
+
+    def _grow(self, size: int) -> None:
+        self.size += size
+        self._registry.total_bytes += size
+
+    def _finish(self) -> None:
+        self.done = True
+        self.finished_at = time.monotonic()
+        if self._grace is not None:
+            self._grace.cancel()
+            self._grace = None
+        self._notify()
+        self._registry.enforce_limits()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def cancel(self) -> None:
+        if self.running:
+            self._task.cancel()
+
+    async def wait(self) -> None:
+        if self._task is not None:
+            await asyncio.wait({self._task})
+
+    def check_resumable(self, last_event_id: int) -> None:
+        """Raises ReplayGapError when frames after last_event_id were already evicted."""
+        first_id = self._frames[0][0] if self._frames else self.last_event_id + 1
+        if last_event_id + 1 < first_id:
+            raise ReplayGapError(f"Events after {last_event_id} are no longer available")
+
+    async def subscribe(self, last_event_id: int = 0):
+        """
+        Yields the frames after last_event_id, then live frames until the generation
+        ends. Stops early if the frames it needs were evicted; see check_resumable().
+        """
+        self.subscribers += 1
+        if self._grace is not None:
+            self._grace.cancel()
+            self._grace = None
+        try:
+            sent = last_event_id
+            while True:
+                changed = self._changed
+                while sent < self.last_event_id:
+                    if not self._frames or sent + 1 < self._frames[0][0]:
+                        # Fell further behind than the ring buffer reaches
+                        return
+                    yield self._frames[sent + 1 - self._frames[0][0]][1]
+                    sent += 1
+                if self.done:
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            self._arm_grace()
+
+    def _arm_grace(self) -> None:
+        if not self.subscribers and self.running and self._grace is None:
+            self._grace = asyncio.get_running_loop().call_later(self._registry.grace_seconds, self._abandon)
+
+    def _abandon(self) -> None:
+        self._grace = None
+        if not self.subscribers:
+            self._registry.abandoned += 1
+            self.cancel()
+
+
+class ReplayRegistry:
+    """
+    In-memory index of resumable generations. Finished generations expire after
+    ttl_seconds; when the replay buffers together exceed max_bytes the oldest
+    finished generations are dropped first. Running ones are only bounded by
+    their own ring buffer of max_events frames.
+    """
+
+    def __init__(
+        self,
+        max_events: int = SSE_REPLAY_MAX_EVENTS,
+        max_bytes: int = SSE_REPLAY_MAX_BYTES,
+        ttl_seconds: float = SSE_REPLAY_TTL_SECONDS,
+        grace_seconds: float = SSE_RESUME_GRACE_SECONDS,
+    ):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.grace_seconds = grace_seconds
+        self.total_bytes = 0
+        self._generations: "OrderedDict[str, Generation]" = OrderedDict()
+        self.started = 0
+        self.resumed = 0
+        self.abandoned = 0
+        self.evictions = 0
+
+    def create(self, user_id: int, conversation_id: int) -> Generation:
+        self.enforce_limits()
+        generation = Generation(self, user_id, conversation_id)
+        self._generations[generation.id] = generation
+        self.started += 1
+        return generation
+
+    def get(self, generation_id: str, user_id: int) -> Optional[Generation]:
+        self.enforce_limits()
+        generation = self._generations.get(generation_id)
+        if generation is None or generation.user_id != user_id:
+            return None
+        return generation
+
+    def enforce_limits(self) -> None:
+        now = time.monotonic()
+        finished = [g for g in self._generations.values() if g.done]
+        finished.sort(key=lambda g: g.finished_at)
+        for generation in finished:
+            expired = now - generation.finished_at >= self.ttl_seconds
+            if not expired and self.total_bytes <= self.max_bytes:
+                break
+            self._remove(generation)
+
+    def _remove(self, generation: Generation) -> None:
+        if self._generations.pop(generation.id, None) is not None:
+            self.total_bytes -= generation.size
+            self.evictions += 1
+
+    async def shutdown(self) -> None:
+        """Cancels running generations and waits until their answers are saved."""
+        running = [g for g in self._generations.values() if g.running]
+        for generation in running:
+            generation.cancel()
+        for generation in running:
+            await generation.wait()
+
+    def clear(self) -> None:
+        self._generations.clear()
+        self.total_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "generations": len(self._generations),
+            "running": sum(1 for g in self._generations.values() if g.running),
+            "bytes": self.total_bytes,
+            "started": self.started,
+            "resumed": self.resumed,
+            "abandoned": self.abandoned,
+            "evictions": self.evictions,
+        }
+
+
+replay_registry = ReplayRegistry()
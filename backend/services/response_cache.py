@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import anyio
+
+# "off" disables the cache, "memory" keeps answers in an in-process LRU,
+# "sqlite" adds a persistent tier in RESPONSE_CACHE_PATH behind the LRU.
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "off")
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "./response_cache.db")
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+# Only requests sampled at or below this temperature are deterministic enough to cache
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "0"))
+
+
+def _normalize(messages: List[dict]) -> List[dict]:
+    return [
+        {"role": m["role"].strip().lower(), "content": (m.get("content") or "").replace("\r\n", "\n").strip()}
+        for m in messages
+    ]
+
+
+class ResponseCache:
+    """
+    Exact-match cache of complete answers, keyed by a hash of the model, the
+    normalized prompt messages and the sampling parameters. The in-memory tier
+    is an LRU with a TTL; with a path set, answers are also written to a SQLite
+    file so they survive restarts. Disk hits are promoted into memory.
+    """
+
+    def __init__(
+        self,
+        mode: str = RESPONSE_CACHE,
+        path: Optional[str] = RESPONSE_CACHE_PATH,
+        ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        max_temperature: float = RESPONSE_CACHE_MAX_TEMPERATURE,
+    ):
+        if mode not in ("off", "memory", "sqlite"):
+            raise RuntimeError(f"Unknown RESPONSE_CACHE '{mode}'. Expected one of: off, memory, sqlite")
+        self.mode = mode
+        self.path = path if mode == "sqlite" else None
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_temperature = max_temperature
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def cacheable(self, temperature: float) -> bool:
+        return self.enabled and temperature <= self.max_temperature
+
+    @staticmethod
+    def key(model: str, messages: List[dict], temperature: float, top_p: float) -> str:
+        payload = json.dumps(
+            {"model": model, "messages": _normalize(messages), "temperature": temperature, "top_p": top_p},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        content = self._get_memory(key)
+        if content is None and self.path:
+            content = await anyio.to_thread.run_sync(self._get_disk, key)
+            if content is not None:
+                self.disk_hits += 1
+                self._put_memory(key, content)
+        if content is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return content
+
+    async def put(self, key: str, content: str) -> None:
+        if not self.enabled or not content:
+            return
+        self._put_memory(key, content)
+        self.stores += 1
+        if self.path:
+            try:
+                await anyio.to_thread.run_sync(self._put_disk, key, content)
+            except sqlite3.Error as e:
+                print(f"Error writing response cache: {e}")
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, content = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return content
+
+    def _put_memory(self, key: str, content: str) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, content)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, content TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        return self._db
+
+    def _get_disk(self, key: str) -> Optional[str]:
+        # Persisted entries outlive the process, so they expire by wall-clock time
+        with self._db_lock:
+            db = self._connect()
+            row = db.execute("SELECT content, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= time.time():
+                with db:
+                    db.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self.expirations += 1
+                return None
+            return row[0]
+
+    def _put_disk(self, key: str, content: str) -> None:
+        now = time.time()
+        with self._db_lock:
+            db = self._connect()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, content, expires_at) VALUES (?, ?, ?)",
+                    (key, content, now + self.ttl_seconds),
+                )
+                db.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        if self.path:
+            with self._db_lock:
+                with self._connect() as db:
+                    db.execute("DELETE FROM response_cache")
+
+    def close(self) -> None:
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._entries)
+        return {
+            "mode": self.mode,
+            "size": size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,197 @@
+import asyncio
+import itertools
+import math
+import os
+import time
+from typing import List, Optional, Tuple
+
+# Generations allowed to run at once; 0 derives it from the backends' max_concurrency
+# (and disables admission control when any backend is unlimited)
+GENERATION_MAX_CONCURRENCY = int(os.getenv("GENERATION_MAX_CONCURRENCY", "0"))
+# Requests allowed to wait for a slot; beyond this new requests get 503 + Retry-After
+GENERATION_QUEUE_MAX = int(os.getenv("GENERATION_QUEUE_MAX", "64"))
+GENERATION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("GENERATION_QUEUE_TIMEOUT_SECONDS", "60"))
+# Waiting longer than this overrides the priority order, so large prompts are not starved
+GENERATION_QUEUE_AGING_SECONDS = float(os.getenv("GENERATION_QUEUE_AGING_SECONDS", "10"))
+# Prompts are ranked by size in buckets of this many characters; FIFO within a bucket
+GENERATION_PRIORITY_BUCKET_CHARS = 512
+
+EWMA_ALPHA = 0.2
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("The server is busy, please retry later")
+        self.retry_after = retry_after
+
+
+class QueueTimeout(Exception):
+    """A queued generation did not get a slot within the queue timeout."""
+
+
+def request_priority(first_turn: bool, prompt_chars: int) -> Tuple[int, int]:
+    """Lower runs first: opening turns before follow-ups, then shorter prompts first."""
+    return (0 if first_turn else 1, prompt_chars // GENERATION_PRIORITY_BUCKET_CHARS)
+
+
+class Ticket:
+    def __init__(self, scheduler: "GenerationScheduler", priority: tuple, seq: int):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.granted_at: Optional[float] = None
+        self.released = False
+        self.waiting = False
+        self._changed = asyncio.Event()
+
+    def sort_key(self, now: float) -> tuple:
+        aged = now - self.enqueued_at >= self.scheduler.aging_seconds
+        return (0, self.seq) if aged else (1, self.priority, self.seq)
+
+    async def wait(self):
+        """
+        Waits for a generation slot, yielding the 1-based queue position every
+        time it changes. Yields nothing when a slot is free right away.
+        """
+        scheduler = self.scheduler
+        deadline = self.enqueued_at + scheduler.timeout
+        self.waiting = True
+        scheduler._dispatch()
+        position = None
+        while self.granted_at is None:
+            current = scheduler.position(self)
+            if current != position:
+                position = current
+                yield position
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                scheduler.timeouts += 1
+                self.release()
+                raise QueueTimeout("Timed out waiting for a free generation slot")
+            self._changed.clear()
+            try:
+                # Wake up at least once a second so aging is reflected in the position
+                await asyncio.wait_for(self._changed.wait(), min(remaining, 1.0))
+            except asyncio.TimeoutError:
+                scheduler._dispatch()
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self)
+
+
+class GenerationScheduler:
+    """
+    Admission control for upstream generations. At most `capacity` generations
+    run at once; further requests wait in a bounded priority queue and are
+    rejected with a retry hint once it is full. Tickets that were enqueued but
+    never waited on (the response was never streamed) expire after the queue
+    timeout instead of holding their place forever.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        max_queue: int = GENERATION_QUEUE_MAX,
+        timeout: float = GENERATION_QUEUE_TIMEOUT_SECONDS,
+        aging_seconds: float = GENERATION_QUEUE_AGING_SECONDS,
+    ):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.aging_seconds = aging_seconds
+        self.running = 0
+        self._queue: List[Ticket] = []
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.expired = 0
+        self.max_wait_ms = 0
+        self.avg_wait_ms = 0.0
+        # Smoothed seconds a generation holds its slot, for Retry-After
+        self.avg_hold_seconds: Optional[float] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def retry_after(self) -> int:
+        hold = self.avg_hold_seconds or 1.0
+        return max(1, math.ceil(hold * (len(self._queue) + 1) / max(1, self.capacity)))
+
+    def enqueue(self, priority: tuple = ()) -> Optional[Ticket]:
+        """Returns a ticket to wait on, None when admission control is off, or raises QueueFull."""
+        if not self.enabled:
+            return None
+        self._expire()
+        if self.running >= self.capacity and len(self._queue) >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull(self.retry_after())
+        ticket = Ticket(self, priority, next(self._seq))
+        self._queue.append(ticket)
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        now = time.monotonic()
+        key = ticket.sort_key(now)
+        return 1 + sum(1 for other in self._queue if other.sort_key(now) < key)
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.timeout
+        stale = [t for t in self._queue if not t.waiting and t.enqueued_at <= cutoff]
+        for ticket in stale:
+            self._queue.remove(ticket)
+            ticket.released = True
+            self.expired += 1
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        while self.running < self.capacity:
+            ready = [t for t in self._queue if t.waiting]
+            if not ready:
+                break
+            ticket = min(ready, key=lambda t: t.sort_key(now))
+            self._queue.remove(ticket)
+            ticket.granted_at = now
+            # It left the queue, so the loop below would not wake it
+            ticket._changed.set()
+            self.running += 1
+            self.admitted += 1
+            wait_ms = int((now - ticket.enqueued_at) * 1000)
+            if wait_ms:
+                self.queued += 1
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            self.avg_wait_ms += EWMA_ALPHA * (wait_ms - self.avg_wait_ms)
+        for ticket in self._queue:
+            ticket._changed.set()
+
+    def _release(self, ticket: Ticket) -> None:
+        if ticket.granted_at is None:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+        else:
+            self.running -= 1
+            held = time.monotonic() - ticket.granted_at
+            if self.avg_hold_seconds is None:
+                self.avg_hold_seconds = held
+            else:
+                self.avg_hold_seconds += EWMA_ALPHA * (held - self.avg_hold_seconds)
+        self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "running": self.running,
+            "waiting": len(self._queue),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "expired": self.expired,
+            "avg_wait_ms": round(self.avg_wait_ms, 1),
+            "max_wait_ms": self.max_wait_ms,
+        }
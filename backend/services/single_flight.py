@@ -0,0 +1,138 @@
+import asyncio
+import os
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set
+
+import anyio
+
+# Optional: concurrent identical deterministic requests share one upstream generation
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "0") == "1"
+SINGLE_FLIGHT_MAX_TEMPERATURE = float(os.getenv("SINGLE_FLIGHT_MAX_TEMPERATURE", "0"))
+
+_END = object()
+
+
+class _Flight:
+    def __init__(self, group: "SingleFlight", key: str, factory: Callable[[], AsyncIterator[str]], admission=None):
+        self.group = group
+        self.key = key
+        self.deltas: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._factory = factory
+        self._queues: Set[asyncio.Queue] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._admission = admission
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+        if self._admission is not None:
+            # The slot is held for as long as the upstream generation runs, whichever
+            # caller stays; a done callback also covers a task cancelled before it ran
+            self._task.add_done_callback(lambda task: self._admission.release())
+
+    async def _run(self) -> None:
+        source = self._factory()
+        try:
+            async for delta in source:
+                self.deltas.append(delta)
+                # put_nowait on unbounded queues: a slow subscriber never holds up the others
+                for queue in self._queues:
+                    queue.put_nowait(delta)
+        except asyncio.CancelledError:
+            self.error = RuntimeError("Upstream generation was cancelled")
+        except Exception as e:
+            self.error = e
+        finally:
+            with anyio.CancelScope(shield=True):
+                await source.aclose()
+            self.done = True
+            self.group._finished(self)
+            for queue in self._queues:
+                queue.put_nowait(_END)
+
+    def join(self) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        # Late joiners are backfilled with everything produced so far
+        for delta in self.deltas:
+            queue.put_nowait(delta)
+        if self.done:
+            queue.put_nowait(_END)
+        self._queues.add(queue)
+        return queue
+
+    def leave(self, queue: asyncio.Queue) -> None:
+        self._queues.discard(queue)
+        if not self._queues and not self.done and self._task is not None:
+            # Nobody is listening anymore: stop the upstream generation
+            self._task.cancel()
+            self.group.cancelled += 1
+            # Callers arriving from now on start a new flight
+            self.group._finished(self)
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent upstream generations by key. The first caller
+    starts a producer task that reads the upstream deltas; every caller,
+    including the first, reads them from its own queue. Callers that join
+    while the flight is running first receive the deltas produced so far.
+    The producer is cancelled once all callers are gone, and holds the
+    admission slot of the caller that started it until then.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.flights = 0
+        self.shared = 0
+        self.backfilled_deltas = 0
+        self.cancelled = 0
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[str]], admission=None):
+        """
+        admission: the caller's generation_scheduler ticket, if any. A caller that
+        starts the flight hands it to the producer, which releases it when the
+        upstream generation ends; a caller that joins releases it right away.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(self, key, factory, admission)
+            self._flights[key] = flight
+            flight.start()
+            self.flights += 1
+        else:
+            self.shared += 1
+            self.backfilled_deltas += len(flight.deltas)
+            if admission is not None:
+                # Joining starts no upstream generation, so it takes no slot
+                admission.release()
+        queue = flight.join()
+        try:
+            while True:
+                delta = await queue.get()
+                if delta is _END:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                yield delta
+        finally:
+            flight.leave(queue)
+
+    def running(self, key: str) -> bool:
+        """Whether stream(key, ...) would join a flight instead of starting one."""
+        return key in self._flights
+
+    def _finished(self, flight: _Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "flights": self.flights,
+            "shared": self.shared,
+            "backfilled_deltas": self.backfilled_deltas,
+            "cancelled": self.cancelled,
+        }
+
+
+single_flight = SingleFlight()
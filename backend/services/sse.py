@@ -0,0 +1,35 @@
+import json
+from typing import Optional, Union
+
+# orjson is optional; it serializes the per-token events several times faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def encode_event(event: Union[dict, str, bytes]) -> Union[bytes, str]:
+    """
+    Serializes one stream event as an SSE `data:` frame. This is the only place
+    events are encoded; frames that are already encoded pass through unchanged.
+    """
+    if isinstance(event, (bytes, str)):
+        return event
+    return b"data: " + dumps(event) + b"\n\n"
+
+
+def decode_frame(frame: str) -> Optional[dict]:
+    """Parses a pre-encoded `data:` frame back into an event, or None if it is not JSON."""
+    if not frame.startswith("data: "):
+        return None
+    try:
+        event = json.loads(frame[6:])
+    except json.JSONDecodeError:
+        return None
+    return event if isinstance(event, dict) else None
@@ -0,0 +1,245 @@
+import asyncio
+import contextvars
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# Fraction of requests traced at random; 0 disables sampling
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# Requests carrying this header are traced; "profile" also runs the sampling profiler
+TRACE_HEADER = os.getenv("TRACE_HEADER", "X-Debug-Trace")
+# The trace header is only honoured together with "X-Debug-Token: <token>"; unset ignores the header
+TRACE_DEBUG_TOKEN = os.getenv("TRACE_DEBUG_TOKEN", "")
+# Directory for JSON trace files (Chrome trace format) and profiles; unset keeps traces in headers only
+TRACE_DIR = os.getenv("TRACE_DIR", "")
+TRACE_PROFILE_INTERVAL_MS = float(os.getenv("TRACE_PROFILE_INTERVAL_MS", "5"))
+
+_current: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    """
+    Spans of one request. span() records a timed stage; accumulate() adds up
+    stages that repeat many times per request (waiting for upstream chunks,
+    encoding frames) so they cost one addition instead of one span each.
+    """
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started = time.perf_counter()
+        self.started_wall = time.time()
+        self.spans: List[tuple] = []
+        self.totals: Dict[str, List[float]] = {}
+        self.finished: Optional[float] = None
+
+    @contextmanager
+    def span(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, started - self.started, time.perf_counter() - started))
+
+    def accumulate(self, name: str, seconds: float) -> None:
+        total = self.totals.get(name)
+        if total is None:
+            self.totals[name] = [seconds, 1]
+        else:
+            total[0] += seconds
+            total[1] += 1
+
+    def finish(self) -> None:
+        if self.finished is None:
+            self.finished = time.perf_counter()
+
+    def durations_ms(self) -> Dict[str, float]:
+        """Milliseconds per stage, spans with the same name summed."""
+        durations: Dict[str, float] = {}
+        for name, _, duration in self.spans:
+            durations[name] = durations.get(name, 0.0) + duration * 1000
+        for name, (seconds, _) in self.totals.items():
+            durations[name] = durations.get(name, 0.0) + seconds * 1000
+        return {name: round(ms, 2) for name, ms in durations.items()}
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={ms}" for name, ms in self.durations_ms().items())
+
+    def to_chrome_trace(self) -> dict:
+        """Chrome trace event format; open in Perfetto or chrome://tracing."""
+        base_us = self.started_wall * 1_000_000
+        events = [
+            {"name": self.name, "ph": "X", "ts": base_us, "dur": ((self.finished or time.perf_counter()) - self.started) * 1_000_000,
+             "pid": 1, "tid": 1, "args": {"trace_id": self.id}},
+        ]
+        for name, offset, duration in self.spans:
+            events.append({"name": name, "ph": "X", "ts": base_us + offset * 1_000_000, "dur": duration * 1_000_000, "pid": 1, "tid": 1})
+        return {
+            "traceEvents": events,
+            "otherData": {
+                "trace_id": self.id,
+                "request": self.name,
+                "accumulated": {name: {"ms": round(s * 1000, 3), "count": n} for name, (s, n) in self.totals.items()},
+            },
+        }
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str):
+    """Times a stage of the current request; a shared no-op when it is not traced."""
+    trace = _current.get()
+    if trace is None:
+        return _NO_SPAN
+    return trace.span(name)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread every interval from a background thread
+    and counts identical stacks, in the folded format flamegraph.pl and
+    speedscope read. The event loop runs every request on the same thread,
+    so concurrent requests show up in each other's profiles.
+    """
+
+    def __init__(self, thread_id: int, interval: float = TRACE_PROFILE_INTERVAL_MS / 1000):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="trace-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class TracingMiddleware:
+    """
+    Pure ASGI middleware that decides per request whether to trace it. Traced
+    requests get a Server-Timing header with the stages finished before the
+    response started (the rest of a streamed answer is reported in its
+    metadata event) and, with TRACE_DIR set, a JSON trace file. The trace
+    header needs a matching debug token, so clients cannot make the server
+    trace or profile their requests without one. Untraced requests cost one
+    random() call and a header lookup.
+    """
+
+    def __init__(
+        self,
+        app,
+        sample_rate: float = TRACE_SAMPLE_RATE,
+        header: str = TRACE_HEADER,
+        debug_token: str = TRACE_DEBUG_TOKEN,
+        trace_dir: str = TRACE_DIR,
+    ):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.header = header.lower().encode()
+        self.debug_token = debug_token.encode()
+        self.trace_dir = trace_dir
+        self._profiling = threading.Lock()
+        self.traced = 0
+
+    def _mode(self, scope) -> Optional[str]:
+        if self.debug_token:
+            requested = None
+            token = b""
+            for name, value in scope.get("headers", ()):
+                if name == self.header:
+                    requested = value.decode("latin-1")
+                elif name == b"x-debug-token":
+                    token = value
+            if requested and hmac.compare_digest(token, self.debug_token):
+                return "profile" if requested == "profile" else "trace"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "trace"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        mode = self._mode(scope)
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(f"{scope['method']} {scope['path']}")
+        token = _current.set(trace)
+        profiler = None
+        if mode == "profile" and self._profiling.acquire(blocking=False):
+            profiler = SamplingProfiler(threading.get_ident())
+            profiler.start()
+        self.traced += 1
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", ()))
+                headers.append((b"server-timing", trace.server_timing().encode()))
+                headers.append((b"x-trace-id", trace.id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            trace.finish()
+            if profiler is not None:
+                profiler.stop()
+                self._profiling.release()
+            if self.trace_dir:
+                # Serializing and writing a long trace would block the event loop
+                await asyncio.to_thread(self._write, trace, profiler)
+
+    def _write(self, trace: Trace, profiler: Optional[SamplingProfiler]) -> None:
+        try:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            with open(os.path.join(self.trace_dir, f"{trace.id}.json"), "w") as f:
+                json.dump(trace.to_chrome_trace(), f)
+            if profiler is not None:
+                with open(os.path.join(self.trace_dir, f"{trace.id}.folded"), "w") as f:
+                    f.write(profiler.folded())
+        except OSError as e:
+            print(f"Error writing trace {trace.id}: {e}")
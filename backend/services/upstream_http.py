@@ -0,0 +1,242 @@
+import asyncio
+import os
+from typing import Optional
+
+import anyio
+import httpx
+
+# Connection pool shared by every upstream LLM client. Each streaming answer holds
+# one connection for its whole duration, so the limit caps concurrent generations.
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "1000"))
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS", "100"))
+# Keep below the upstream server's idle timeout so pooled connections are not reused after it closed them
+LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS", "5"))
+# HTTP/2 multiplexes streams over fewer connections; needs the h2 package (pip install "httpx[http2]")
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "0").lower() in ("1", "true", "yes")
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("LLM_CONNECT_TIMEOUT_SECONDS", "5"))
+# Waiting for a free pooled connection when LLM_HTTP_MAX_CONNECTIONS are busy
+LLM_POOL_TIMEOUT_SECONDS = float(os.getenv("LLM_POOL_TIMEOUT_SECONDS", "10"))
+# From sending the request to the first token (covers queueing and prompt processing upstream)
+LLM_FIRST_TOKEN_TIMEOUT_SECONDS = float(
+    os.getenv("LLM_FIRST_TOKEN_TIMEOUT_SECONDS", os.getenv("LLM_BACKEND_TIMEOUT_SECONDS", "60"))
+)
+# Longest gap between two tokens before the stream counts as stalled; 0 disables
+LLM_INTER_TOKEN_TIMEOUT_SECONDS = float(os.getenv("LLM_INTER_TOKEN_TIMEOUT_SECONDS", "30"))
+
+# The end of a body after `data: [DONE]` normally arrives right away
+_DRAIN_TIMEOUT_SECONDS = 0.1
+
+
+class UpstreamTimeout(Exception):
+    pass
+
+
+class StallWatchdog:
+    """
+    Deadline for a sequence of awaits (the upstream chunks of one answer) that
+    is cheap to move: arm() only stores a deadline, and a single timer per
+    timeout period checks for a stall, where a cancel scope per token would
+    schedule and cancel a timer for every chunk. When the deadline passes
+    while the stream is waiting upstream, the waiting task is cancelled and
+    expired() turns that cancellation into UpstreamTimeout.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = None
+        self._handle = None
+        self.deadline = 0.0
+        self.waiting = False
+        self.fired = False
+
+    def arm(self, timeout: float) -> None:
+        """Call before each await; a falsy timeout disables the deadline for it."""
+        self._task = asyncio.current_task()
+        self.waiting = bool(timeout)
+        if not timeout:
+            return
+        self.deadline = self._loop.time() + timeout
+        if self._handle is None:
+            self._handle = self._loop.call_at(self.deadline, self._check)
+        elif self.deadline < self._handle.when():
+            # Shorter timeout than the pending check, e.g. inter-token after first-token
+            self._handle.cancel()
+            self._handle = self._loop.call_at(self.deadline, self._check)
+
+    def disarm(self) -> None:
+        """Call after each await returned."""
+        self.waiting = False
+
+    def expired(self) -> bool:
+        """In an except CancelledError block: True if the watchdog cancelled the task."""
+        if not self.fired:
+            return False
+        # Python 3.11+ counts cancel requests: take ours back so the task is not
+        # left cancelling, and let a cancellation from elsewhere win
+        uncancel = getattr(self._task, "uncancel", None)
+        return uncancel is None or uncancel() == 0
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _check(self) -> None:
+        self._handle = None
+        if self._loop.time() < self.deadline:
+            self._handle = self._loop.call_at(self.deadline, self._check)
+        elif self.waiting and not self.fired:
+            self.fired = True
+            self._task.cancel("upstream stalled")
+        # Otherwise the consumer is holding the stream; the next arm() reschedules
+
+
+class _PooledTransport(httpx.AsyncBaseTransport):
+    """
+    Forwards to the pool owned by UpstreamHTTP and counts requests in flight;
+    a request stays in flight until its response body is closed.
+    """
+
+    def __init__(self, owner: "UpstreamHTTP"):
+        self.owner = owner
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        owner = self.owner
+        transport = owner.start()
+        owner.requests += 1
+        owner.in_flight += 1
+        owner.peak_in_flight = max(owner.peak_in_flight, owner.in_flight)
+        try:
+            response = await transport.handle_async_request(request)
+        except BaseException as e:
+            owner.in_flight -= 1
+            if isinstance(e, httpx.PoolTimeout):
+                owner.pool_timeouts += 1
+            elif isinstance(e, Exception):
+                owner.errors += 1
+            raise
+        response.stream = _CountedStream(response.stream, owner)
+        return response
+
+
+class _CountedStream(httpx.AsyncByteStream):
+    """
+    Response body that marks the request done when closed. The OpenAI SDK
+    stops reading at `data: [DONE]` and closes the response before the end of
+    the chunked body, which makes httpcore drop the connection instead of
+    returning it to the pool; the rest of such a body is read here first.
+    """
+
+    def __init__(self, stream, owner: "UpstreamHTTP"):
+        self.stream = stream
+        self.owner = owner
+        self.closed = False
+        self._parts = None
+        self._finished = False
+        self._at_done = False
+
+    async def __aiter__(self):
+        self._parts = self.stream.__aiter__()
+        async for part in self._parts:
+            self._at_done = part.endswith(b"[DONE]\n\n")
+            yield part
+        self._finished = True
+
+    async def aclose(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.owner.in_flight -= 1
+            if self._at_done and not self._finished:
+                await self._drain()
+        await self.stream.aclose()
+
+    async def _drain(self) -> None:
+        with anyio.move_on_after(_DRAIN_TIMEOUT_SECONDS):
+            try:
+                async for _ in self._parts:
+                    pass
+            except httpx.HTTPError:
+                return
+            self.owner.drained += 1
+
+
+class UpstreamHTTP:
+    """
+    One httpx.AsyncClient shared by the AsyncOpenAI clients of all backends.
+    The client object only holds configuration and exists from import on, so
+    the OpenAI clients can be built at import time; the connection pool behind
+    it is opened by start() in the app lifespan (or lazily on first use outside
+    the app) and closed by close() on shutdown.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = LLM_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections: int = LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS,
+        http2: bool = LLM_HTTP2,
+        connect_timeout: float = LLM_CONNECT_TIMEOUT_SECONDS,
+        pool_timeout: float = LLM_POOL_TIMEOUT_SECONDS,
+        first_token_timeout: float = LLM_FIRST_TOKEN_TIMEOUT_SECONDS,
+        inter_token_timeout: float = LLM_INTER_TOKEN_TIMEOUT_SECONDS,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections or None,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self.first_token_timeout = first_token_timeout
+        self.inter_token_timeout = inter_token_timeout
+        # Socket-level backstop; the first-token and inter-token deadlines are
+        # enforced per stream by the LLM service
+        self.timeout = httpx.Timeout(
+            connect=connect_timeout,
+            read=max(first_token_timeout, inter_token_timeout) or None,
+            write=connect_timeout,
+            pool=pool_timeout,
+        )
+        self.client = httpx.AsyncClient(transport=_PooledTransport(self), timeout=self.timeout)
+        self._transport: Optional[httpx.AsyncHTTPTransport] = None
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.errors = 0
+        self.pool_timeouts = 0
+        self.drained = 0
+
+    def start(self) -> httpx.AsyncHTTPTransport:
+        if self._transport is None:
+            try:
+                self._transport = httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2)
+            except ImportError:
+                raise RuntimeError('LLM_HTTP2=1 needs the h2 package (pip install "httpx[http2]")')
+        return self._transport
+
+    async def close(self) -> None:
+        transport, self._transport = self._transport, None
+        if transport is not None:
+            await transport.aclose()
+
+    def stats(self) -> dict:
+        # httpcore does not expose pool state publicly; read it best-effort
+        pool = getattr(self._transport, "_pool", None)
+        connections = list(getattr(pool, "connections", ()))
+        max_connections = self.limits.max_connections
+        return {
+            "started": self._transport is not None,
+            "http2": self.http2,
+            "max_connections": max_connections,
+            "connections": len(connections),
+            "idle_connections": sum(1 for c in connections if c.is_idle()),
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "utilization": round(self.in_flight / max_connections, 4) if max_connections else None,
+            "requests": self.requests,
+            "errors": self.errors,
+            "pool_timeouts": self.pool_timeouts,
+            "drained": self.drained,
+        }
+
+
+upstream_http = UpstreamHTTP()
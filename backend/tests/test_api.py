@@ -1,44 +1,49 @@
 import os
+import tempfile
 import uuid
 
 import pytest
 from httpx import ASGITransport, AsyncClient
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
 from unittest.mock import patch
 
-from security import get_password_hash
+from security import get_password_hash, get_user_by_email, user_cache
 
 os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
 os.environ.setdefault("LLM_API_KEY", "test-key")
 
-from database import Base, get_db
+from database import Base, get_db, get_read_db
 from main import app
 import models
 
-SQLALCHEMY_DATABASE_URL = "sqlite://"
+# The app talks to the DB through an async engine while fixtures and assertions
+# use a sync engine, so both point at the same temporary SQLite file.
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "test_api.db")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DB_PATH}"
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base.metadata.create_all(bind=engine)
 
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_PATH}")
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 @pytest.fixture(scope="module", autouse=True)
 def override_dependencies():
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
     yield
     app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_read_db, None)
 
 
 @pytest.fixture
@@ -48,6 +53,7 @@ def clear_db():
     db.query(models.Conversation).delete()
     db.query(models.User).delete()
     db.commit()
+    user_cache.clear()
     db.close()
     yield
 
@@ -198,3 +204,29 @@ async def test_update_settings(async_client, test_user, auth_headers):
         assert updated_conv.temperature == 1.5
         assert updated_conv.user_id == test_user["id"]
         db.close()
+
+
+@pytest.mark.asyncio
+async def test_authenticated_user_is_cached_between_requests(async_client, test_user, auth_headers):
+    with patch("security.get_user_by_email", wraps=get_user_by_email) as lookup:
+        for _ in range(3):
+            response = await async_client.get("/api/auth/me", headers=auth_headers)
+            assert response.status_code == 200
+    assert lookup.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_update_user_settings_invalidates_cache(async_client, test_user, auth_headers):
+    await async_client.get("/api/auth/me", headers=auth_headers)
+
+    response = await async_client.patch(
+        "/api/auth/me",
+        headers=auth_headers,
+        json={"default_top_p": 0.3, "default_temperature": 5.0},
+    )
+    assert response.status_code == 200
+    assert response.json()["default_temperature"] == 2.0
+
+    me = await async_client.get("/api/auth/me", headers=auth_headers)
+    assert me.json()["default_top_p"] == 0.3
+    assert me.json()["default_temperature"] == 2.0
@@ -0,0 +1,330 @@
+"""Tests for the multi-backend LLM pool"""
+import asyncio
+import os
+import time
+
+import httpx
+import pytest
+from openai import APIConnectionError, AuthenticationError, BadRequestError, InternalServerError
+from unittest.mock import AsyncMock, MagicMock, patch
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from services.backends import Backend, BackendPool, NoBackendAvailable, load_backends
+from services.llm import stream_llm_response
+
+
+def _client(tokens=("ok",), error=None, first_token_delay=0.0):
+    async def create(**kwargs):
+        if error is not None:
+            raise error
+
+        async def gen():
+            await asyncio.sleep(first_token_delay)
+            for token in tokens:
+                chunk = MagicMock()
+                chunk.choices = [MagicMock(delta=MagicMock(content=token))]
+                yield chunk
+        return gen()
+
+    client = MagicMock()
+    client.chat.completions.create = AsyncMock(side_effect=create)
+    return client
+
+
+def test_load_backends_from_json():
+    backends = load_backends(
+        '[{"name": "a", "base_url": "http://a/v1", "weight": 2, "max_concurrency": 4},'
+        ' {"base_url": "http://b/v1", "model": "other", "api_key": "k"}]',
+        default_api_key="default-key",
+        default_model="default-model",
+    )
+    assert [(b.name, b.model, b.weight, b.max_concurrency) for b in backends] == [
+        ("a", "default-model", 2.0, 4),
+        ("http://b/v1", "other", 1.0, 0),
+    ]
+    assert backends[0].client.api_key == "default-key"
+    assert BackendPool(backends).model_key == "default-model|other"
+
+    for spec in ["not json", '{"base_url": "x"}', '[{"name": "no url"}]']:
+        with pytest.raises(RuntimeError):
+            load_backends(spec, "k", "m")
+
+
+@pytest.mark.asyncio
+async def test_least_outstanding_respects_weights():
+    light = Backend("light", None, "m", weight=1)
+    heavy = Backend("heavy", None, "m", weight=3)
+    pool = BackendPool([light, heavy])
+    for _ in range(8):
+        await pool.acquire()
+    assert (light.outstanding, heavy.outstanding) == (2, 6)
+
+
+@pytest.mark.asyncio
+async def test_ewma_routing_prefers_the_faster_backend():
+    slow = Backend("slow", None, "m")
+    fast = Backend("fast", None, "m")
+    pool = BackendPool([slow, fast], routing="ewma")
+    pool.record_latency(slow, 2.0)
+    pool.record_latency(fast, 0.2)
+    chosen = [(await pool.acquire()).name for _ in range(5)]
+    assert chosen.count("fast") >= 4
+    pool.record_latency(fast, 1.0)
+    assert fast.ewma_latency == pytest.approx(0.2 + 0.3 * 0.8)
+
+
+@pytest.mark.asyncio
+async def test_failures_eject_a_backend_until_the_window_passes():
+    flaky = Backend("flaky", None, "m")
+    steady = Backend("steady", None, "m")
+    pool = BackendPool([flaky, steady], max_failures=2, eject_seconds=60)
+
+    pool.record_failure(flaky)
+    assert pool.pick() is flaky  # one error is not enough
+    pool.record_failure(flaky)
+    assert flaky.ejections == 1
+    steady.outstanding = 10
+    assert pool.pick() is steady
+
+    # Every backend ejected: route over all of them rather than failing everything
+    pool.record_failure(steady)
+    pool.record_failure(steady)
+    assert pool.pick() is flaky
+
+    flaky.ejected_until = 0
+    pool.record_success(flaky)
+    assert flaky.consecutive_failures == 0
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit_makes_acquire_wait_for_a_slot():
+    only = Backend("only", None, "m", max_concurrency=1)
+    pool = BackendPool([only], acquire_timeout=1)
+    await pool.acquire()
+    waiter = asyncio.create_task(pool.acquire())
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+    pool.release(only)
+    assert await asyncio.wait_for(waiter, 1) is only
+    assert only.outstanding == 1
+
+    pool.acquire_timeout = 0.01
+    with pytest.raises(NoBackendAvailable):
+        await pool.acquire()
+
+
+@pytest.mark.asyncio
+async def test_stream_routes_around_a_failing_backend():
+    broken = Backend("broken", _client(error=_connection_error()), "m")
+    healthy = Backend("healthy", _client(tokens=["fine"]), "m")
+    pool = BackendPool([broken, healthy], retry_attempts=0, max_failures=1, eject_seconds=60)
+
+    with patch("services.llm.backend_pool", pool):
+        first = [e async for e in stream_llm_response("Hi", [], AsyncMock())]
+        second = [e async for e in stream_llm_response("Hi", [], AsyncMock())]
+
+    assert "error" in first[0]
+    assert broken.ejections == 1
+    assert second[0] == {"content": "fine"}
+    assert broken.outstanding == healthy.outstanding == 0
+    assert healthy.ewma_latency is not None
+
+
+@pytest.mark.asyncio
+async def test_affinity_keeps_a_conversation_on_one_backend():
+    backends = [Backend(name, None, "m") for name in ("a", "b", "c")]
+    pool = BackendPool(backends, routing="affinity")
+    placement = {}
+    for conversation_id in range(30):
+        backend = await pool.acquire(conversation_id)
+        placement[conversation_id] = backend
+        pool.release(backend)
+    assert len({b.name for b in placement.values()}) == 3
+
+    for conversation_id, first in placement.items():
+        backend = await pool.acquire(conversation_id)
+        assert backend is first
+        pool.release(backend)
+
+    # Ejecting a backend only moves the conversations it served
+    backends[0].ejected_until = float("inf")
+    for conversation_id, first in placement.items():
+        backend = pool.pick(conversation_id)
+        assert backend is not backends[0]
+        if first is not backends[0]:
+            assert backend is first
+
+
+@pytest.mark.asyncio
+async def test_affinity_spills_over_when_a_backend_is_overloaded():
+    a, b = Backend("a", None, "m"), Backend("b", None, "m")
+    pool = BackendPool([a, b], routing="affinity", affinity_load_factor=1.0)
+    home = pool.pick("conversation")
+    other = b if home is a else a
+    home.outstanding = 3
+    assert pool.pick("conversation") is other
+    home.outstanding = 0
+    assert pool.pick("conversation") is home
+
+
+def test_prefix_reuse_and_ttft_are_recorded_per_backend():
+    a, b = Backend("a", None, "m"), Backend("b", None, "m")
+    pool = BackendPool([a, b], routing="affinity")
+    assert pool.note_route(None, a) is None
+    assert pool.note_route(1, a) is None  # first turn
+    assert pool.note_route(1, a) is True
+    assert pool.note_route(1, b) is False
+    pool.record_latency(a, 0.1, prefix_hit=True)
+    pool.record_latency(b, 0.5, prefix_hit=False)
+
+    stats = {s["name"]: s for s in pool.stats()["backends"]}
+    assert (stats["a"]["prefix_hits"], stats["a"]["prefix_hit_rate"], stats["a"]["ttft_prefix_hit_ms"]) == (1, 1.0, 100.0)
+    assert (stats["b"]["prefix_misses"], stats["b"]["ttft_prefix_miss_ms"]) == (1, 500.0)
+
+    small = BackendPool([a], affinity_tracked=2)
+    for key in range(5):
+        small.note_route(key, a)
+    assert list(small._last_route) == ["3", "4"]
+
+
+@pytest.mark.asyncio
+async def test_stream_uses_the_conversation_as_affinity_key():
+    backends = [Backend(name, _client(tokens=[name]), "m") for name in ("a", "b", "c")]
+    pool = BackendPool(backends, routing="affinity")
+    with patch("services.llm.backend_pool", pool):
+        answers = [
+            [e async for e in stream_llm_response("Hi", [], AsyncMock(), affinity_key=42)][0]["content"]
+            for _ in range(3)
+        ]
+    assert len(set(answers)) == 1
+    assert sum(b.prefix_hits for b in backends) == 2
+
+
+def _flaky_client(errors, tokens=("ok",)):
+    """Raises the given errors on the first calls, then answers."""
+    remaining = list(errors)
+    working = _client(tokens=tokens)
+
+    async def create(**kwargs):
+        if remaining:
+            raise remaining.pop(0)
+        return await working.chat.completions.create(**kwargs)
+
+    client = MagicMock()
+    client.chat.completions.create = AsyncMock(side_effect=create)
+    return client
+
+
+def _connection_error():
+    return APIConnectionError(request=httpx.Request("POST", "http://upstream/v1/chat/completions"))
+
+
+@pytest.mark.asyncio
+async def test_connection_errors_are_retried_on_another_backend():
+    flaky = Backend("flaky", _flaky_client([_connection_error()]), "m")
+    healthy = Backend("healthy", _client(tokens=["fine"]), "m")
+    pool = BackendPool([flaky, healthy], retry_backoff=0)
+
+    with patch("services.llm.backend_pool", pool):
+        events = [e async for e in stream_llm_response("Hi", [], AsyncMock())]
+
+    assert events[0] == {"content": "fine"}
+    assert pool.retries == 1
+    assert (flaky.failures, healthy.failures) == (1, 0)
+    assert flaky.outstanding == healthy.outstanding == 0
+
+
+def _status_error(cls, status_code):
+    request = httpx.Request("POST", "http://upstream/v1/chat/completions")
+    return cls("upstream said no", response=httpx.Response(status_code, request=request), body=None)
+
+
+@pytest.mark.asyncio
+async def test_client_errors_do_not_count_against_the_backend():
+    errors = [_status_error(BadRequestError, 400), _status_error(AuthenticationError, 401)]
+    backend = Backend("a", _flaky_client(errors), "m")
+    pool = BackendPool([backend], retry_backoff=0, max_failures=1)
+
+    with patch("services.llm.backend_pool", pool):
+        for _ in errors:
+            events = [e async for e in stream_llm_response("Hi", [], AsyncMock())]
+            assert "error" in events[0]
+
+    # Not retried, and the backend stays in rotation
+    assert backend.client.chat.completions.create.call_count == 2
+    assert backend.failures == 0
+    assert backend.circuit(time.monotonic()) == "closed"
+    assert backend.outstanding == 0
+
+
+@pytest.mark.asyncio
+async def test_server_errors_count_against_the_backend():
+    backend = Backend("a", _flaky_client([_status_error(InternalServerError, 500)]), "m")
+    pool = BackendPool([backend], retry_attempts=0, max_failures=5)
+
+    with patch("services.llm.backend_pool", pool):
+        events = [e async for e in stream_llm_response("Hi", [], AsyncMock())]
+
+    assert "error" in events[0]
+    assert backend.failures == 1
+
+
+@pytest.mark.asyncio
+async def test_retries_give_up_after_the_configured_attempts():
+    errors = [_connection_error() for _ in range(3)]
+    only = Backend("only", _flaky_client(errors), "m")
+    pool = BackendPool([only], retry_attempts=1, retry_backoff=0, max_failures=0)
+
+    with patch("services.llm.backend_pool", pool):
+        events = [e async for e in stream_llm_response("Hi", [], AsyncMock())]
+
+    assert "error" in events[0]
+    assert only.client.chat.completions.create.call_count == 2
+    assert 0 <= pool.retry_delay(3) <= pool.retry_backoff_max
+
+
+@pytest.mark.asyncio
+async def test_slow_first_token_is_hedged_to_another_backend():
+    slow = Backend("slow", _client(tokens=["late"], first_token_delay=1.0), "m")
+    fast = Backend("fast", _client(tokens=["early"]), "m")
+    pool = BackendPool([slow, fast], hedge_percentile=95, hedge_min_delay=0.05)
+    for _ in range(20):
+        pool.record_latency(fast, 0.01)
+    assert pool.hedge_delay() == 0.05
+
+    with patch("services.llm.backend_pool", pool):
+        events = [e async for e in stream_llm_response("Hi", [], AsyncMock())]
+
+    assert events[0] == {"content": "early"}
+    assert (pool.hedges, pool.hedge_wins) == (1, 1)
+    # The cancelled loser is released without counting as a failure
+    assert slow.outstanding == fast.outstanding == 0
+    assert slow.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_lets_one_probe_through_when_half_open():
+    backend = Backend("a", None, "m")
+    other = Backend("b", None, "m")
+    pool = BackendPool([backend, other], max_failures=1, eject_seconds=0.05)
+    pool.record_failure(backend)
+    assert backend.circuit(time.monotonic()) == "open"
+
+    await asyncio.sleep(0.06)
+    assert backend.circuit(time.monotonic()) == "half_open"
+    probe = await pool.acquire(avoid=[other])
+    assert probe is backend and backend.probing
+    assert not backend.healthy(time.monotonic())  # no second request while the probe runs
+
+    pool.record_failure(backend)
+    pool.release(backend)
+    assert backend.circuit(time.monotonic()) == "open"
+
+    await asyncio.sleep(0.06)
+    await pool.acquire(avoid=[other])
+    pool.record_success(backend)
+    pool.release(backend)
+    assert backend.circuit(time.monotonic()) == "closed"
+    assert backend.stats()["circuit"] == "closed"
@@ -0,0 +1,54 @@
+"""Tests for the load-test harness and the fake LLM server"""
+import httpx
+import pytest
+from openai import AsyncOpenAI
+
+from benchmarks.fake_llm import FakeLLMConfig, create_app
+from benchmarks.load import compare, percentiles
+
+
+def _client(config: FakeLLMConfig) -> AsyncOpenAI:
+    transport = httpx.ASGITransport(app=create_app(config))
+    return AsyncOpenAI(
+        base_url="http://fake/v1",
+        api_key="fake",
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=transport, base_url="http://fake/v1"),
+    )
+
+
+@pytest.mark.asyncio
+async def test_fake_llm_streams_openai_chunks():
+    client = _client(FakeLLMConfig(ttft_ms=0, tokens_per_second=0, tokens=5))
+    stream = await client.chat.completions.create(
+        model="m", messages=[{"role": "user", "content": "Hi"}], stream=True
+    )
+    deltas = [chunk.choices[0].delta.content async for chunk in stream]
+    assert "".join(d for d in deltas if d) == "The quick brown fox jumps"
+    assert deltas[-1] is None  # finish chunk
+
+
+@pytest.mark.asyncio
+async def test_fake_llm_injects_failures():
+    client = _client(FakeLLMConfig(ttft_ms=0, tokens=1, failure_rate=1.0))
+    with pytest.raises(Exception):
+        await client.chat.completions.create(model="m", messages=[{"role": "user", "content": "Hi"}], stream=True)
+
+
+def test_percentiles_use_nearest_rank():
+    assert percentiles([]) is None
+    result = percentiles(list(range(1, 101)))
+    assert (result["p50"], result["p95"], result["p99"], result["max"]) == (50, 95, 99, 100)
+
+
+def test_compare_flags_regressions_beyond_tolerance():
+    baseline = {"scenarios": {"chat": {
+        "ttft_ms": {"p95": 100.0}, "latency_ms": {"p95": 1000.0}, "throughput_rps": 10.0, "errors": 0, "peak_rss_mb": 100.0,
+    }}}
+    current = {"scenarios": {"chat": {
+        "ttft_ms": {"p95": 110.0}, "latency_ms": {"p95": 1500.0}, "throughput_rps": 5.0, "errors": 2, "peak_rss_mb": None,
+    }, "new_scenario": {"errors": 3}}}
+    regressions = compare(current, baseline, tolerance=0.15)
+    assert [line.split(":")[0] for line in regressions] == [
+        "chat.latency_ms.p95", "chat.throughput_rps", "chat.errors",
+    ]
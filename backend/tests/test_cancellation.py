@@ -0,0 +1,115 @@
+"""Tests for stopping upstream generation when the SSE consumer goes away"""
+import asyncio
+import os
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from services.llm import CancellationStats, stream_llm_response
+
+
+def _chunk(text):
+    chunk = MagicMock()
+    chunk.choices = [MagicMock(delta=MagicMock(content=text))]
+    return chunk
+
+
+class FakeUpstream:
+    """Async iterator standing in for the OpenAI stream; records close()."""
+
+    def __init__(self, tokens, block_after=None):
+        self.tokens = list(tokens)
+        self.block_after = block_after
+        self.sent = 0
+        self.closed = False
+        self.blocked = asyncio.Event()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.block_after is not None and self.sent >= self.block_after:
+            self.blocked.set()
+            await asyncio.Event().wait()
+        if self.sent >= len(self.tokens):
+            raise StopAsyncIteration
+        self.sent += 1
+        return _chunk(self.tokens[self.sent - 1])
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_closing_the_stream_stops_upstream_and_saves_partial():
+    upstream = FakeUpstream(["Hel", "lo", " world"])
+    on_complete = AsyncMock()
+    stats = CancellationStats()
+
+    with patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create, \
+         patch("services.llm.cancellation_stats", stats):
+        mock_create.return_value = upstream
+        stream = stream_llm_response("Hi", [], on_complete)
+        await stream.__anext__()
+        await stream.__anext__()
+        await stream.aclose()
+
+    assert upstream.closed
+    assert upstream.sent == 2
+    on_complete.assert_awaited_once()
+    assert on_complete.call_args.args[0] == "Hello"
+    assert on_complete.call_args.kwargs == {"truncated": True}
+    assert stats.cancelled == 1
+    assert stats.tokens_before_cancel == 2
+
+
+@pytest.mark.asyncio
+async def test_task_cancellation_while_waiting_for_tokens():
+    upstream = FakeUpstream(["partial"], block_after=1)
+    on_complete = AsyncMock()
+
+    with patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create:
+        mock_create.return_value = upstream
+
+        async def consume():
+            async for _ in stream_llm_response("Hi", [], on_complete):
+                pass
+
+        task = asyncio.create_task(consume())
+        await upstream.blocked.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    assert upstream.closed
+    on_complete.assert_awaited_once_with("partial", on_complete.call_args.args[1], truncated=True)
+
+
+@pytest.mark.asyncio
+async def test_completed_stream_is_not_counted_as_cancelled():
+    upstream = FakeUpstream(["done"])
+    on_complete = AsyncMock()
+    stats = CancellationStats()
+
+    with patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create, \
+         patch("services.llm.cancellation_stats", stats):
+        mock_create.return_value = upstream
+        stream = stream_llm_response("Hi", [], on_complete)
+        results = [chunk async for chunk in stream]
+
+    assert results[-1]["type"] == "metadata"
+    assert on_complete.call_args.kwargs == {}
+    assert stats.cancelled == 0
+    assert stats.completed == 1
+
+
+def test_tokens_saved_estimate_uses_average_completion_length():
+    stats = CancellationStats()
+    stats.record_completion(100)
+    stats.record_cancellation(30)
+    assert stats.tokens_saved_estimate == 70
+    stats.record_cancellation(150)
+    assert stats.tokens_saved_estimate == 70
@@ -0,0 +1,270 @@
+"""Tests for incremental checkpointing of in-flight assistant answers"""
+import asyncio
+import functools
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from security import get_password_hash
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from database import Base, write_lock
+from services.checkpoints import (
+    CHECKPOINT_EVERY_SECONDS,
+    CHECKPOINT_RECOVERY_GRACE_SECONDS,
+    CheckpointStats,
+    ChunkAccumulator,
+    ResponseCheckpointer,
+    recover_after_grace,
+    recover_interrupted_messages,
+)
+from services.llm import stream_llm_response
+import models
+
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "test_checkpoints.db")
+engine = create_engine(f"sqlite:///{TEST_DB_PATH}", connect_args={"check_same_thread": False})
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+Base.metadata.create_all(bind=engine)
+
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_PATH}")
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+@pytest.fixture
+def conversation_id():
+    db = TestingSessionLocal()
+    db.query(models.Message).delete()
+    db.query(models.Conversation).delete()
+    db.query(models.User).delete()
+    db.commit()
+    user = models.User(email="checkpoint@example.com", hashed_password=get_password_hash("password123"))
+    db.add(user)
+    db.commit()
+    conv = models.Conversation(title="Checkpoints", user_id=user.id)
+    db.add(conv)
+    db.commit()
+    conv_id = conv.id
+    db.close()
+    return conv_id
+
+
+def _assistant_rows(conv_id):
+    db = TestingSessionLocal()
+    rows = [
+        (m.content, m.status, bool(m.truncated), m.response_time)
+        for m in db.query(models.Message).filter(models.Message.conversation_id == conv_id).order_by(models.Message.id)
+    ]
+    db.close()
+    return rows
+
+
+def test_accumulator_joins_lazily():
+    acc = ChunkAccumulator(every_tokens=0, every_seconds=0)
+    for part in ["a", "b", "c"]:
+        acc.append(part)
+    assert acc.text() == "abc"
+    acc.append("d")
+    assert acc.text() == "abcd"
+    assert acc.tokens == 4
+    assert not acc.checkpoint_due()
+
+
+def test_accumulator_checkpoint_every_n_tokens():
+    acc = ChunkAccumulator(every_tokens=3, every_seconds=0)
+    due = []
+    for i in range(7):
+        acc.append("x")
+        due.append(acc.checkpoint_due())
+    assert due == [False, False, True, False, False, True, False]
+
+
+def test_accumulator_checkpoint_after_interval():
+    acc = ChunkAccumulator(every_tokens=1000, every_seconds=0.01)
+    acc.append("x")
+    assert not acc.checkpoint_due()
+    acc._checkpoint_time -= 1
+    assert acc.checkpoint_due()
+    # Nothing new since the last checkpoint
+    acc._checkpoint_time -= 1
+    assert not acc.checkpoint_due()
+
+
+@pytest.mark.asyncio
+async def test_checkpoints_upsert_one_streaming_row_and_finalize(conversation_id):
+    stats = CheckpointStats()
+    checkpointer = ResponseCheckpointer(TestingAsyncSessionLocal, conversation_id, stats=stats)
+
+    await checkpointer.checkpoint("Hel")
+    await checkpointer._drain()
+    assert _assistant_rows(conversation_id) == [("Hel", "streaming", False, None)]
+
+    await checkpointer.checkpoint("Hello wor")
+    await checkpointer._drain()
+    assert _assistant_rows(conversation_id) == [("Hello wor", "streaming", False, None)]
+
+    assert await checkpointer.finalize("Hello world", 120)
+    assert _assistant_rows(conversation_id) == [("Hello world", "complete", False, 120)]
+    assert stats.checkpoints == 2
+
+    # Late checkpoints after finalization are ignored
+    await checkpointer.checkpoint("stale")
+    await checkpointer.abandon()
+    assert _assistant_rows(conversation_id) == [("Hello world", "complete", False, 120)]
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_is_skipped_while_a_write_is_running(conversation_id):
+    stats = CheckpointStats()
+    checkpointer = ResponseCheckpointer(TestingAsyncSessionLocal, conversation_id, stats=stats)
+    await checkpointer.checkpoint("a")
+    await checkpointer.checkpoint("ab")
+    await checkpointer._drain()
+    assert stats.skipped == 1
+    assert _assistant_rows(conversation_id) == [("a", "streaming", False, None)]
+
+
+@pytest.mark.asyncio
+async def test_finalize_without_checkpoint_leaves_storage_to_caller(conversation_id):
+    checkpointer = ResponseCheckpointer(TestingAsyncSessionLocal, conversation_id)
+    assert not await checkpointer.finalize("short answer", 5)
+    assert _assistant_rows(conversation_id) == []
+
+
+@pytest.mark.asyncio
+async def test_failed_final_write_is_retried_and_never_reported_as_unstored(conversation_id):
+    stats = CheckpointStats()
+    checkpointer = ResponseCheckpointer(TestingAsyncSessionLocal, conversation_id, stats=stats)
+    await checkpointer.checkpoint("Hel")
+    await checkpointer._drain()
+
+    update = checkpointer._update
+    calls = []
+
+    async def flaky_update(**values):
+        calls.append(values["status"])
+        if len(calls) == 1:
+            stats.errors += 1
+            return False
+        return await update(**values)
+
+    with patch.object(checkpointer, "_update", side_effect=flaky_update), \
+         patch("services.checkpoints.FINALIZE_RETRY_DELAY_SECONDS", 0):
+        assert await checkpointer.finalize("Hello", 50)
+    assert calls == ["complete", "complete"]
+    assert _assistant_rows(conversation_id) == [("Hello", "complete", False, 50)]
+
+
+@pytest.mark.asyncio
+async def test_final_write_that_keeps_failing_marks_the_row_interrupted(conversation_id):
+    checkpointer = ResponseCheckpointer(TestingAsyncSessionLocal, conversation_id)
+    await checkpointer.checkpoint("partial")
+    await checkpointer._drain()
+
+    update = checkpointer._update
+
+    async def failing_final_update(**values):
+        if values["status"] == "complete":
+            return False
+        return await update(**values)
+
+    with patch.object(checkpointer, "_update", side_effect=failing_final_update), \
+         patch("services.checkpoints.FINALIZE_RETRY_DELAY_SECONDS", 0):
+        # Handled: the caller must not insert a second assistant message
+        assert await checkpointer.finalize("partial answer", 50)
+    assert _assistant_rows(conversation_id) == [("partial", "interrupted", True, None)]
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_still_queued_for_the_write_lock_is_dropped_on_finalize(conversation_id):
+    stats = CheckpointStats()
+    checkpointer = ResponseCheckpointer(TestingAsyncSessionLocal, conversation_id, stats=stats)
+    async with TestingAsyncSessionLocal() as other_writer, write_lock(other_writer):
+        await checkpointer.checkpoint("Hel")
+        await asyncio.sleep(0.01)
+        # The answer completes while the checkpoint waits behind another write
+        assert not await checkpointer.finalize("Hello", 5)
+    assert stats.checkpoints == 0
+    assert _assistant_rows(conversation_id) == []
+
+
+@pytest.mark.asyncio
+async def test_abandon_marks_row_interrupted(conversation_id):
+    checkpointer = ResponseCheckpointer(TestingAsyncSessionLocal, conversation_id)
+    await checkpointer.checkpoint("partial")
+    await checkpointer.abandon()
+    assert _assistant_rows(conversation_id) == [("partial", "interrupted", True, None)]
+
+
+@pytest.mark.asyncio
+async def test_recovery_marks_orphaned_streaming_rows(conversation_id):
+    db = TestingSessionLocal()
+    now = datetime.utcnow()
+    db.add_all([
+        models.Message(conversation_id=conversation_id, role="assistant", content="old", status="streaming", updated_at=now - timedelta(minutes=5)),
+        models.Message(conversation_id=conversation_id, role="assistant", content="fresh", status="streaming", updated_at=now),
+        models.Message(conversation_id=conversation_id, role="assistant", content="done"),
+    ])
+    db.commit()
+    db.close()
+
+    assert await recover_interrupted_messages(TestingAsyncSessionLocal, grace_seconds=60) == 1
+    assert [r[:3] for r in _assistant_rows(conversation_id)] == [
+        ("old", "interrupted", True),
+        ("fresh", "streaming", False),
+        ("done", "complete", False),
+    ]
+    assert await recover_interrupted_messages(TestingAsyncSessionLocal, grace_seconds=0) == 1
+
+
+@pytest.mark.asyncio
+async def test_recovery_default_grace_spans_several_checkpoints(conversation_id):
+    assert CHECKPOINT_RECOVERY_GRACE_SECONDS >= 5 * CHECKPOINT_EVERY_SECONDS
+    db = TestingSessionLocal()
+    fresh = datetime.utcnow() - timedelta(seconds=CHECKPOINT_EVERY_SECONDS)
+    db.add(models.Message(conversation_id=conversation_id, role="assistant", content="live", status="streaming", updated_at=fresh))
+    db.commit()
+    db.close()
+
+    # A row checkpointed one interval ago may belong to another worker
+    assert await recover_interrupted_messages(TestingAsyncSessionLocal) == 0
+    # The second pass after the grace marks it once it went stale
+    with patch("services.checkpoints.asyncio.sleep", new_callable=AsyncMock) as sleep:
+        assert await recover_after_grace(TestingAsyncSessionLocal, grace_seconds=0.5) == 1
+    sleep.assert_awaited_once_with(0.5)
+
+
+@pytest.mark.asyncio
+async def test_stream_checkpoints_long_answers(conversation_id):
+    checkpointer = ResponseCheckpointer(TestingAsyncSessionLocal, conversation_id)
+    tokens = [f"t{i} " for i in range(10)]
+    seen = []
+
+    async def upstream():
+        for token in tokens:
+            chunk = MagicMock()
+            chunk.choices = [MagicMock(delta=MagicMock(content=token))]
+            yield chunk
+            # Let the background checkpoint write run between tokens
+            await asyncio.sleep(0.01)
+            seen.append(_assistant_rows(conversation_id))
+
+    with patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create, \
+         patch("services.llm.ChunkAccumulator", functools.partial(ChunkAccumulator, every_tokens=4, every_seconds=0)):
+        mock_create.return_value = upstream()
+        async for _ in stream_llm_response(
+            "Hi", [], checkpointer.finalize, on_checkpoint=checkpointer.checkpoint
+        ):
+            pass
+
+    assert ("t0 t1 t2 t3 ", "streaming", False, None) in [rows[0] for rows in seen if rows]
+    rows = _assistant_rows(conversation_id)
+    assert len(rows) == 1
+    assert rows[0][:3] == ("".join(tokens), "complete", False)
@@ -0,0 +1,100 @@
+"""Tests for adaptive coalescing of streamed content deltas"""
+import asyncio
+import time
+
+import pytest
+
+from services.coalescing import CoalescingStats, coalesce_events
+
+
+async def _source(items, delays=None):
+    for i, item in enumerate(items):
+        if delays and delays[i]:
+            await asyncio.sleep(delays[i])
+        yield item
+
+
+async def _collect(events):
+    return [event async for event in events]
+
+
+@pytest.mark.asyncio
+async def test_zero_delay_sends_every_delta():
+    stats = CoalescingStats()
+    items = [{"content": "a"}, {"content": "b"}, {"type": "metadata", "duration_ms": 1}]
+    out = await _collect(coalesce_events(_source(items), max_delay_ms=0, stats=stats))
+
+    assert [e.get("content") for e in out[:2]] == ["a", "b"]
+    assert out[-1]["frames"] == 3
+    assert stats.stats()["frames_per_response"] == 3
+    assert stats.deltas == 2
+
+
+@pytest.mark.asyncio
+async def test_first_delta_is_not_delayed_and_rest_are_merged():
+    stats = CoalescingStats()
+    items = [{"content": t} for t in ["He", "llo", " wor", "ld"]] + [{"type": "metadata", "duration_ms": 1}]
+    out = await _collect(coalesce_events(_source(items), max_delay_ms=50, stats=stats))
+
+    assert out == [
+        {"content": "He"},
+        {"content": "llo world"},
+        {"type": "metadata", "duration_ms": 1, "frames": 3},
+    ]
+    assert stats.deltas == 4
+    assert stats.stats()["deltas_per_frame"] == pytest.approx(4 / 3)
+
+
+@pytest.mark.asyncio
+async def test_buffer_is_flushed_when_the_window_elapses():
+    # "b" is buffered, then upstream stalls; it must not wait for "c"
+    items = [{"content": "a"}, {"content": "b"}, {"content": "c"}]
+    received = []
+    start = time.monotonic()
+    async for event in coalesce_events(_source(items, [0, 0, 0.3]), max_delay_ms=20):
+        received.append((event["content"], time.monotonic() - start))
+
+    assert [content for content, _ in received] == ["a", "b", "c"]
+    assert received[1][1] < 0.2
+
+
+@pytest.mark.asyncio
+async def test_byte_threshold_flushes_early():
+    items = [{"content": "x" * 4} for _ in range(5)]
+    out = await _collect(coalesce_events(_source(items), max_delay_ms=1000, max_bytes=8))
+    assert [e["content"] for e in out] == ["xxxx", "xxxxxxxx", "xxxxxxxx"]
+
+
+@pytest.mark.asyncio
+async def test_other_events_flush_the_buffer_in_order():
+    items = [{"content": "a"}, {"content": "b"}, "data: ping\n\n", {"content": "c"}, {"error": "boom"}]
+    out = await _collect(coalesce_events(_source(items), max_delay_ms=1000))
+    assert out == [{"content": "a"}, {"content": "b"}, "data: ping\n\n", {"content": "c"}, {"error": "boom"}]
+
+
+@pytest.mark.asyncio
+async def test_closing_cancels_the_pending_upstream_read():
+    cancelled = asyncio.Event()
+
+    async def upstream():
+        yield {"content": "a"}
+        yield {"content": "b"}
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        yield {"content": "never"}
+
+    stats = CoalescingStats()
+    events = coalesce_events(upstream(), max_delay_ms=1000, stats=stats)
+    assert await events.__anext__() == {"content": "a"}
+    next_frame = asyncio.ensure_future(events.__anext__())
+    await asyncio.sleep(0.05)
+    next_frame.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await next_frame
+    await events.aclose()
+
+    assert cancelled.is_set()
+    assert stats.responses == 1
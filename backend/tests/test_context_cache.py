@@ -0,0 +1,179 @@
+"""Tests for server-side history reconstruction and the conversation context cache"""
+import os
+import tempfile
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from unittest.mock import patch
+
+from security import get_password_hash, user_cache
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from database import Base, get_db, get_read_db
+from main import app
+from services.context_cache import ConversationContextCache, context_cache
+import models
+
+# The app talks to the DB through an async engine while fixtures and assertions
+# use a sync engine, so both point at the same temporary SQLite file.
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "test_context_cache.db")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DB_PATH}"
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+Base.metadata.create_all(bind=engine)
+
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_PATH}")
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
+@pytest.fixture(scope="module", autouse=True)
+def override_dependencies():
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    yield
+    app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_read_db, None)
+
+
+@pytest.fixture
+def clear_db():
+    db = TestingSessionLocal()
+    db.query(models.Message).delete()
+    db.query(models.Conversation).delete()
+    db.query(models.User).delete()
+    db.commit()
+    user_cache.clear()
+    db.close()
+    context_cache.clear()
+    yield
+
+
+@pytest.fixture
+def test_user(clear_db):
+    db = TestingSessionLocal()
+    user = models.User(
+        email="tester@example.com",
+        hashed_password=get_password_hash("password123"),
+    )
+    db.add(user)
+    db.commit()
+    db.refresh(user)
+    payload = {"email": user.email, "password": "password123", "id": user.id}
+    db.close()
+    return payload
+
+
+@pytest.fixture
+async def auth_headers(test_user):
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.post(
+            "/api/auth/login",
+            data={"username": test_user["email"], "password": test_user["password"]},
+        )
+        assert response.status_code == 200
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def test_cache_evicts_least_recently_used_by_size():
+    cache = ConversationContextCache(max_bytes=40, max_conversations=10)
+    cache.put(1, [{"role": "user", "content": "a" * 10}])
+    cache.put(2, [{"role": "user", "content": "b" * 10}])
+    assert cache.get(1) is not None  # touch 1 so 2 becomes the LRU entry
+
+    cache.put(3, [{"role": "user", "content": "c" * 10}])
+
+    assert cache.get(2) is None
+    assert cache.get(1) is not None
+    assert cache.get(3) is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_append_only_updates_cached_conversations():
+    cache = ConversationContextCache(max_bytes=1000, max_conversations=10)
+    assert cache.append(1, {"role": "user", "content": "hi"}) is False
+    assert cache.get(1) is None
+
+    cache.put(1, [])
+    assert cache.append(1, {"role": "user", "content": "hi"}) is True
+    assert cache.get(1) == [{"role": "user", "content": "hi"}]
+
+
+def test_cache_drops_conversation_larger_than_budget():
+    cache = ConversationContextCache(max_bytes=20, max_conversations=10)
+    cache.put(1, [])
+    cache.append(1, {"role": "user", "content": "x" * 50})
+    assert cache.get(1) is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_disabled_cache_always_misses():
+    # With several workers each one's cache would miss the others' writes
+    cache = ConversationContextCache(max_bytes=1000, max_conversations=10, enabled=False)
+    cache.put(1, [{"role": "user", "content": "hi"}])
+    assert cache.append(1, {"role": "assistant", "content": "hello"}) is False
+    assert cache.get(1) is None
+    assert cache.stats()["conversations"] == 0
+
+
+@pytest.mark.asyncio
+async def test_server_history_rebuilds_prompt_from_stored_messages(test_user, auth_headers):
+    db = TestingSessionLocal()
+    conv = models.Conversation(title="Existing", user_id=test_user["id"])
+    db.add(conv)
+    db.commit()
+    db.add_all([
+        models.Message(conversation_id=conv.id, role="user", content="First question"),
+        models.Message(conversation_id=conv.id, role="assistant", content="First answer"),
+    ])
+    db.commit()
+    conv_id = conv.id
+    db.close()
+
+    received_history = []
+
+    with patch("api.chat.stream_llm_response") as mock_stream:
+        async def mock_generator(msg, history, callback, **kwargs):
+            received_history.append(list(history))
+            await callback("Second answer", 50)
+            yield 'data: {"type": "metadata", "duration_ms": 50}\n\n'
+
+        mock_stream.side_effect = mock_generator
+
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            for text in ("Second question", "Third question"):
+                response = await client.post(
+                    "/api/chat",
+                    headers=auth_headers,
+                    json={
+                        "message": text,
+                        "history": [{"role": "user", "content": "ignored"}],
+                        "conversation_id": conv_id,
+                        "server_history": True,
+                    },
+                )
+                assert response.status_code == 200
+                await response.aread()
+
+    assert received_history[0] == [
+        {"role": "user", "content": "First question"},
+        {"role": "assistant", "content": "First answer"},
+    ]
+    # The second turn is served from the cache, which was updated on each append
+    assert received_history[1] == received_history[0] + [
+        {"role": "user", "content": "Second question"},
+        {"role": "assistant", "content": "Second answer"},
+    ]
+    assert context_cache.get(conv_id)[-1] == {"role": "assistant", "content": "Second answer"}
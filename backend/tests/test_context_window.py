@@ -0,0 +1,121 @@
+"""Tests for token-budget context window trimming and rolling summaries"""
+import os
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from services.context_window import (
+    SUMMARY_PREFIX,
+    ContextWindowManager,
+    HeuristicTokenizer,
+    extractive_summary,
+    get_tokenizer,
+)
+from services.llm import stream_llm_response
+
+
+class WordTokenizer:
+    def count(self, text):
+        return len(text.split())
+
+
+def _turns(n):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} " + "word " * 20}
+        for i in range(n)
+    ]
+
+
+def test_heuristic_tokenizer_estimates():
+    tokenizer = HeuristicTokenizer()
+    assert tokenizer.count("") == 0
+    assert tokenizer.count("abcd" * 10) == 10
+    assert tokenizer.count("你好世界") == 4
+
+
+def test_get_tokenizer_heuristic_is_offline():
+    assert isinstance(get_tokenizer("heuristic"), HeuristicTokenizer)
+
+
+def test_short_history_is_sent_unmodified():
+    manager = ContextWindowManager(max_tokens=1000, summary_max_tokens=50, tokenizer=WordTokenizer())
+    history = _turns(2)
+    window = manager.fit(history, "hello")
+    assert window.messages == history + [{"role": "user", "content": "hello"}]
+    assert window.summary is None
+    assert window.summarized_count == 0
+
+
+def test_long_history_keeps_newest_turns_within_budget():
+    manager = ContextWindowManager(max_tokens=200, summary_max_tokens=40, tokenizer=WordTokenizer())
+    history = _turns(20)
+    window = manager.fit(history, "latest question")
+
+    assert window.tokens <= 200
+    assert window.messages[-1] == {"role": "user", "content": "latest question"}
+    assert window.messages[-2] == history[-1]
+    assert window.messages[0]["role"] == "system"
+    assert window.messages[0]["content"].startswith(SUMMARY_PREFIX)
+    assert window.summarized_count == 20 - (len(window.messages) - 2)
+
+
+def test_cached_summary_is_reused_until_more_folding_is_needed():
+    manager = ContextWindowManager(max_tokens=200, summary_max_tokens=40, tokenizer=WordTokenizer())
+    history = _turns(20)
+    first = manager.fit(history, "q1")
+
+    history = history + [{"role": "user", "content": "q1"}]
+    second = manager.fit(history, "q2", first.summary, first.summarized_count)
+
+    # The low watermark leaves room for another short turn without refolding
+    assert second.summary == first.summary
+    assert second.summarized_count == first.summarized_count
+
+
+def test_summary_is_reset_when_it_does_not_match_history():
+    manager = ContextWindowManager(max_tokens=1000, summary_max_tokens=50, tokenizer=WordTokenizer())
+    window = manager.fit(_turns(2), "hello", summary="stale", summarized_count=10)
+    assert window.summary is None
+    assert window.summarized_count == 0
+
+
+def test_extractive_summary_drops_think_blocks_and_respects_budget():
+    tokenizer = WordTokenizer()
+    summary = extractive_summary(
+        "user: old line",
+        [{"role": "assistant", "content": "<think>hidden reasoning</think>Visible answer"}],
+        max_tokens=10,
+        tokenizer=tokenizer,
+    )
+    assert "hidden reasoning" not in summary
+    assert summary.endswith("assistant: Visible answer")
+    assert tokenizer.count(summary) <= 10
+
+
+@pytest.mark.asyncio
+async def test_stream_llm_response_sends_trimmed_window_and_reports_summary():
+    manager = ContextWindowManager(max_tokens=200, summary_max_tokens=40, tokenizer=WordTokenizer())
+
+    with patch("services.llm.context_window", manager), \
+         patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create:
+        chunk = MagicMock()
+        chunk.choices = [MagicMock(delta=MagicMock(content="ok"))]
+
+        async def async_gen():
+            yield chunk
+
+        mock_create.return_value = async_gen()
+        on_summary = AsyncMock()
+
+        async for _ in stream_llm_response("Hi", _turns(20), AsyncMock(), on_summary=on_summary):
+            pass
+
+        sent = mock_create.call_args.kwargs["messages"]
+        assert sent[0]["role"] == "system"
+        assert sent[-1] == {"role": "user", "content": "Hi"}
+        on_summary.assert_awaited_once()
+        summary, count = on_summary.call_args.args
+        assert summary and count > 0
@@ -0,0 +1,96 @@
+"""Tests for the SQLite tuning profile and read-only pool configuration"""
+import asyncio
+import os
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from database import configure_sqlite, sqlite_pragmas, write_lock
+
+
+def test_production_profile_pragmas():
+    pragmas = sqlite_pragmas("production")
+    assert pragmas["journal_mode"] == "WAL"
+    assert pragmas["synchronous"] == "NORMAL"
+    assert pragmas["busy_timeout"] == 5000
+    assert "mmap_size" in pragmas and "cache_size" in pragmas
+
+
+def test_default_profile_keeps_sqlite_defaults():
+    assert sqlite_pragmas("default") == {}
+
+
+def test_env_overrides_profile_values(monkeypatch):
+    monkeypatch.setenv("SQLITE_BUSY_TIMEOUT_MS", "250")
+    assert sqlite_pragmas("production")["busy_timeout"] == "250"
+
+
+def test_unknown_profile_is_rejected():
+    with pytest.raises(RuntimeError):
+        sqlite_pragmas("turbo")
+
+
+def test_connect_hook_applies_pragmas():
+    path = os.path.join(tempfile.mkdtemp(), "profile.db")
+    engine = create_engine(f"sqlite:///{path}")
+    configure_sqlite(engine, sqlite_pragmas("production"))
+
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+    engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_read_only_pool_rejects_writes():
+    path = os.path.join(tempfile.mkdtemp(), "profile_ro.db")
+    writer = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    configure_sqlite(writer.sync_engine, sqlite_pragmas("production"))
+    reader = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    configure_sqlite(reader.sync_engine, sqlite_pragmas("production"), read_only=True)
+
+    async with writer.begin() as conn:
+        await conn.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+        await conn.execute(text("INSERT INTO items (id) VALUES (1)"))
+
+    async with reader.connect() as conn:
+        assert (await conn.execute(text("SELECT count(*) FROM items"))).scalar() == 1
+        with pytest.raises(OperationalError):
+            await conn.execute(text("INSERT INTO items (id) VALUES (2)"))
+
+    await writer.dispose()
+    await reader.dispose()
+
+
+@pytest.mark.asyncio
+async def test_write_lock_takes_turns_without_deadlocking_on_the_pool():
+    path = os.path.join(tempfile.mkdtemp(), "profile_lock.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}", pool_size=1, max_overflow=0, pool_timeout=2)
+    configure_sqlite(engine.sync_engine, sqlite_pragmas("production"))
+    Session = async_sessionmaker(bind=engine)
+    async with engine.begin() as conn:
+        await conn.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY)"))
+
+    async def insert(item_id):
+        async with Session() as db, write_lock(db):
+            await db.execute(text("INSERT INTO items (id) VALUES (:id)"), {"id": item_id})
+            await db.commit()
+
+    async with Session() as request_db:
+        # The request session holds the only connection after a read; a writer
+        # queued behind it waits for the pool, not while holding the lock
+        await request_db.execute(text("SELECT count(*) FROM items"))
+        background = asyncio.create_task(insert(1))
+        await asyncio.sleep(0.05)
+        async with write_lock(request_db):
+            await request_db.execute(text("INSERT INTO items (id) VALUES (2)"))
+            await request_db.commit()
+    await asyncio.wait_for(background, 2)
+
+    async with engine.connect() as conn:
+        assert (await conn.execute(text("SELECT count(*) FROM items"))).scalar() == 2
+    await engine.dispose()
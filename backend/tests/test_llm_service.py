@@ -37,8 +37,9 @@ async def test_stream_llm_response_success():
             
         assert len(results) >= 2
         # Check that content chunks are present
-        content_chunks = [r for r in results if '"content"' in r]
-        assert len(content_chunks) >= 2
+        content_chunks = [r for r in results if "content" in r]
+        assert [r["content"] for r in content_chunks] == ["Hello", " World"]
+        assert results[-1]["type"] == "metadata"
 
 @pytest.mark.asyncio
 async def test_stream_llm_response_error():
@@ -53,6 +54,6 @@ async def test_stream_llm_response_error():
             
         assert len(results) >= 1
         # Check for error in response
-        error_chunks = [r for r in results if '"error"' in r]
+        error_chunks = [r for r in results if "error" in r]
         assert len(error_chunks) >= 1
 
@@ -0,0 +1,204 @@
+"""Tests for the write-behind batched message persistence queue"""
+import asyncio
+import os
+import tempfile
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from unittest.mock import patch
+
+from security import get_password_hash, user_cache
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from database import Base, get_db, get_read_db
+from main import app
+from services.persistence import MessageWriter, message_writer
+import models
+
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "test_message_writer.db")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DB_PATH}"
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+Base.metadata.create_all(bind=engine)
+
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_PATH}")
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
+@pytest.fixture(scope="module", autouse=True)
+def override_dependencies():
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    yield
+    app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_read_db, None)
+
+
+@pytest.fixture
+def clear_db():
+    db = TestingSessionLocal()
+    db.query(models.Message).delete()
+    db.query(models.Conversation).delete()
+    db.query(models.User).delete()
+    db.commit()
+    user_cache.clear()
+    db.close()
+    yield
+
+
+@pytest.fixture
+def conversation_id(clear_db):
+    db = TestingSessionLocal()
+    user = models.User(email="writer@example.com", hashed_password=get_password_hash("password123"))
+    db.add(user)
+    db.commit()
+    conv = models.Conversation(title="Batched", user_id=user.id)
+    db.add(conv)
+    db.commit()
+    conv_id = conv.id
+    db.close()
+    return conv_id
+
+
+def _stored_messages(conv_id):
+    db = TestingSessionLocal()
+    rows = (
+        db.query(models.Message)
+        .filter(models.Message.conversation_id == conv_id)
+        .order_by(models.Message.id)
+        .all()
+    )
+    db.close()
+    return [(m.role, m.content) for m in rows]
+
+
+@pytest.mark.asyncio
+async def test_writer_batches_messages_into_one_transaction(conversation_id):
+    writer = MessageWriter(max_batch=10, max_latency_ms=50)
+    await writer.start(TestingAsyncSessionLocal)
+    for i in range(5):
+        writer.submit(conversation_id, "user", f"message {i}")
+    assert len(writer.pending(conversation_id)) == 5
+
+    await asyncio.sleep(0.2)
+
+    assert writer.batches_written == 1
+    assert writer.pending(conversation_id) == []
+    assert _stored_messages(conversation_id) == [("user", f"message {i}") for i in range(5)]
+    await writer.stop()
+
+
+@pytest.mark.asyncio
+async def test_writer_respects_max_batch(conversation_id):
+    writer = MessageWriter(max_batch=2, max_latency_ms=1000)
+    await writer.start(TestingAsyncSessionLocal)
+    for i in range(4):
+        writer.submit(conversation_id, "user", f"message {i}")
+    await writer.stop()
+
+    assert writer.batches_written == 2
+    assert len(_stored_messages(conversation_id)) == 4
+
+
+@pytest.mark.asyncio
+async def test_writer_flushes_pending_messages_on_stop(conversation_id):
+    writer = MessageWriter(max_batch=100, max_latency_ms=60_000)
+    await writer.start(TestingAsyncSessionLocal)
+    writer.submit(conversation_id, "user", "Hello")
+    writer.submit(conversation_id, "assistant", "Hi there", 42)
+
+    await writer.stop()
+
+    assert not writer.running
+    assert _stored_messages(conversation_id) == [("user", "Hello"), ("assistant", "Hi there")]
+
+
+@pytest.mark.asyncio
+async def test_history_includes_messages_not_yet_flushed(conversation_id):
+    await message_writer.start(TestingAsyncSessionLocal)
+    default_latency = message_writer.max_latency
+    message_writer.max_latency = 60
+    try:
+        with patch("api.chat.stream_llm_response") as mock_stream:
+            async def mock_generator(msg, history, callback, **kwargs):
+                await callback("Queued answer", 10)
+                yield 'data: {"type": "metadata", "duration_ms": 10}\n\n'
+
+            mock_stream.side_effect = mock_generator
+
+            async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+                login = await client.post(
+                    "/api/auth/login",
+                    data={"username": "writer@example.com", "password": "password123"},
+                )
+                headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+
+                response = await client.post(
+                    "/api/chat",
+                    headers=headers,
+                    json={"message": "Queued question", "conversation_id": conversation_id},
+                )
+                await response.aread()
+
+                assert _stored_messages(conversation_id) == []
+                history = await client.get(f"/api/conversations/{conversation_id}", headers=headers)
+                assert [(m["role"], m["content"]) for m in history.json()] == [
+                    ("user", "Queued question"),
+                    ("assistant", "Queued answer"),
+                ]
+    finally:
+        await message_writer.stop()
+        message_writer.max_latency = default_latency
+
+    assert _stored_messages(conversation_id) == [("user", "Queued question"), ("assistant", "Queued answer")]
+
+
+@pytest.mark.asyncio
+async def test_new_conversation_is_committed_when_messages_are_queued(conversation_id):
+    await message_writer.start(TestingAsyncSessionLocal)
+    try:
+        with patch("api.chat.stream_llm_response") as mock_stream:
+            async def mock_generator(msg, history, callback, **kwargs):
+                await callback("Answer", 10)
+                yield 'data: {"type": "metadata", "duration_ms": 10}\n\n'
+
+            mock_stream.side_effect = mock_generator
+
+            async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+                login = await client.post(
+                    "/api/auth/login",
+                    data={"username": "writer@example.com", "password": "password123"},
+                )
+                headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+                response = await client.post("/api/chat", headers=headers, json={"message": "Fresh start"})
+                await response.aread()
+                new_id = int(response.text.split('"conversation_id":')[1].split("}")[0])
+
+                history = await client.get(f"/api/conversations/{new_id}", headers=headers)
+                assert history.status_code == 200
+                second = await client.post(
+                    "/api/chat",
+                    headers=headers,
+                    json={"message": "Second turn", "conversation_id": new_id},
+                )
+                await second.aread()
+                assert second.status_code == 200
+    finally:
+        await message_writer.stop()
+
+    assert _stored_messages(new_id) == [
+        ("user", "Fresh start"), ("assistant", "Answer"), ("user", "Second turn"), ("assistant", "Answer"),
+    ]
@@ -0,0 +1,99 @@
+"""Tests for the in-process metrics and the /metrics endpoint"""
+import math
+import os
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from unittest.mock import AsyncMock, MagicMock, patch
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from main import app
+from services.llm import stream_llm_response
+from services.metrics import Histogram, MetricsRegistry, generations_total, ttft_seconds
+
+
+def _upstream(tokens):
+    async def gen():
+        for token in tokens:
+            chunk = MagicMock()
+            chunk.choices = [MagicMock(delta=MagicMock(content=token))]
+            yield chunk
+    return gen()
+
+
+def test_histogram_buckets_and_exposition():
+    histogram = Histogram("chat_test_seconds", "Test.", buckets=(0.1, 1.0), labelnames=("op",))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, ("a",))
+
+    assert histogram.snapshot(("a",)) == {"count": 4, "sum": 3.65, "buckets": [2, 1, 1]}
+    assert histogram.quantile(0.5, ("a",)) == 0.1
+    assert histogram.quantile(0.99, ("a",)) == math.inf
+    assert histogram.quantile(0.5, ("b",)) is None
+    assert histogram.render() == [
+        "# HELP chat_test_seconds Test.",
+        "# TYPE chat_test_seconds histogram",
+        'chat_test_seconds_bucket{op="a",le="0.1"} 2',
+        'chat_test_seconds_bucket{op="a",le="1"} 3',
+        'chat_test_seconds_bucket{op="a",le="+Inf"} 4',
+        'chat_test_seconds_sum{op="a"} 3.65',
+        'chat_test_seconds_count{op="a"} 4',
+    ]
+
+
+def test_collectors_export_service_stats_as_gauges_and_counters():
+    registry = MetricsRegistry(prefix="t")
+    registry.register_collector(
+        "cache", lambda: {"hits": 3, "mode": "memory", "ratio": 0.5, "running": True}, counters=("hits",)
+    )
+    registry.register_collector(
+        "pool",
+        lambda: {"backends": [{"name": "a", "outstanding": 2, "failures": 1, "ewma_latency_ms": None}]},
+        counters=("failures",),
+    )
+    registry.register_collector("broken", lambda: 1 / 0)
+    text = registry.render()
+
+    assert "# TYPE t_cache_hits_total counter\nt_cache_hits_total 3\n" in text
+    assert "# TYPE t_cache_ratio gauge\nt_cache_ratio 0.5\n" in text
+    assert "t_cache_running 1\n" in text
+    assert "mode" not in text
+    assert 't_pool_backends_outstanding{name="a"} 2\n' in text
+    assert '# TYPE t_pool_backends_failures_total counter\nt_pool_backends_failures_total{name="a"} 1\n' in text
+    assert "ewma_latency_ms" not in text
+
+
+@pytest.mark.asyncio
+async def test_metadata_reports_ttft_and_tokens_per_second():
+    before = generations_total.value(("completed",))
+    ttft_before = ttft_seconds.snapshot() or {"count": 0}
+    with patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create:
+        mock_create.return_value = _upstream(["Hello", " there", "!"])
+        events = [e async for e in stream_llm_response("Hi", [], AsyncMock())]
+
+    metadata = events[-1]
+    assert metadata["type"] == "metadata"
+    assert metadata["ttft_ms"] >= 0
+    assert metadata["tokens_per_second"] > 0
+    assert generations_total.value(("completed",)) == before + 1
+    assert ttft_seconds.snapshot()["count"] == ttft_before["count"] + 1
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_serves_prometheus_text():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert "# TYPE chat_ttft_seconds histogram" in response.text
+        assert "chat_active_streams " in response.text
+        assert 'chat_backend_pool_backends_outstanding{name="default"}' in response.text
+        assert "# TYPE chat_scheduler_admitted_total counter" in response.text
+        assert "# TYPE chat_scheduler_running gauge" in response.text
+
+        with patch("api.metrics.METRICS_TOKEN", "secret"):
+            assert (await client.get("/metrics")).status_code == 401
+            authorized = await client.get("/metrics", headers={"Authorization": "Bearer secret"})
+            assert authorized.status_code == 200
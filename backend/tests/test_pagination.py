@@ -0,0 +1,206 @@
+"""Tests for composite indexes, keyset pagination and streaming of conversations and messages"""
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from security import get_password_hash, user_cache
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from database import Base, get_db, get_read_db
+from main import app
+import models
+
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "test_pagination.db")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DB_PATH}"
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+Base.metadata.create_all(bind=engine)
+
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_PATH}")
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
+@pytest.fixture(scope="module", autouse=True)
+def override_dependencies():
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    yield
+    app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_read_db, None)
+
+
+@pytest.fixture
+def seeded():
+    db = TestingSessionLocal()
+    db.query(models.Message).delete()
+    db.query(models.Conversation).delete()
+    db.query(models.User).delete()
+    db.commit()
+    user_cache.clear()
+
+    user = models.User(email="pager@example.com", hashed_password=get_password_hash("password123"))
+    db.add(user)
+    db.commit()
+
+    base = datetime(2024, 1, 1)
+    # Two conversations share a timestamp to exercise the id tie-breaker
+    stamps = [base, base + timedelta(minutes=1), base + timedelta(minutes=1), base + timedelta(minutes=2), base + timedelta(minutes=3)]
+    conversations = [
+        models.Conversation(title=f"Chat {i}", user_id=user.id, created_at=stamp)
+        for i, stamp in enumerate(stamps)
+    ]
+    db.add_all(conversations)
+    db.commit()
+
+    long_chat = conversations[0]
+    db.add_all([
+        models.Message(
+            conversation_id=long_chat.id,
+            role="user" if i % 2 == 0 else "assistant",
+            content=f"message {i}",
+            created_at=base + timedelta(seconds=i),
+        )
+        for i in range(7)
+    ])
+    db.commit()
+    data = {"conversation_id": long_chat.id}
+    db.close()
+    return data
+
+
+@pytest.fixture
+async def auth_headers(seeded):
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.post(
+            "/api/auth/login",
+            data={"username": "pager@example.com", "password": "password123"},
+        )
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def test_composite_indexes_exist():
+    inspector = inspect(engine)
+    conversation_indexes = {ix["name"]: ix["column_names"] for ix in inspector.get_indexes("conversations")}
+    message_indexes = {ix["name"]: ix["column_names"] for ix in inspector.get_indexes("messages")}
+    assert conversation_indexes["ix_conversations_user_id_created_at"] == ["user_id", "created_at"]
+    assert message_indexes["ix_messages_conversation_id_created_at"] == ["conversation_id", "created_at"]
+
+
+@pytest.mark.asyncio
+async def test_conversations_keyset_pagination(auth_headers):
+    titles = []
+    cursor = None
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        while True:
+            params = {"limit": 2}
+            if cursor:
+                params["cursor"] = cursor
+            response = await client.get("/api/conversations", headers=auth_headers, params=params)
+            assert response.status_code == 200
+            titles.extend(c["title"] for c in response.json())
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+
+    assert titles == ["Chat 4", "Chat 3", "Chat 2", "Chat 1", "Chat 0"]
+
+
+@pytest.mark.asyncio
+async def test_conversations_invalid_cursor(auth_headers):
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.get("/api/conversations", headers=auth_headers, params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_conversation_messages_pages_backwards_from_newest(seeded, auth_headers):
+    url = f"/api/conversations/{seeded['conversation_id']}/messages"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        first = (await client.get(url, headers=auth_headers, params={"limit": 3})).json()
+        assert [m["content"] for m in first["messages"]] == ["message 4", "message 5", "message 6"]
+
+        second = (await client.get(url, headers=auth_headers, params={"limit": 3, "cursor": first["next_cursor"]})).json()
+        assert [m["content"] for m in second["messages"]] == ["message 1", "message 2", "message 3"]
+
+        last = (await client.get(url, headers=auth_headers, params={"limit": 3, "cursor": second["next_cursor"]})).json()
+        assert [m["content"] for m in last["messages"]] == ["message 0"]
+        assert last["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_history_stream_emits_ndjson_rows(seeded, auth_headers):
+    url = f"/api/conversations/{seeded['conversation_id']}/stream"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.get(url, headers=auth_headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [r["content"] for r in rows] == [f"message {i}" for i in range(7)]
+        assert all(r["id"] is not None for r in rows)
+
+        since = rows[4]["id"]
+        tail = await client.get(url, headers=auth_headers, params={"since_message_id": since})
+        assert [json.loads(line)["content"] for line in tail.text.splitlines()] == ["message 5", "message 6"]
+
+
+@pytest.mark.asyncio
+async def test_history_stream_resends_answers_finalized_after_the_cursor(seeded, auth_headers):
+    conversation_id = seeded["conversation_id"]
+    started = datetime(2024, 1, 1, 0, 1)
+    db = TestingSessionLocal()
+    answer = models.Message(
+        conversation_id=conversation_id, role="assistant", content="Partial", status="streaming",
+        created_at=started, updated_at=started,
+    )
+    db.add(answer)
+    db.commit()
+    answer_id = answer.id
+    db.close()
+
+    url = f"/api/conversations/{conversation_id}/stream"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        rows = [json.loads(line) for line in (await client.get(url, headers=auth_headers)).text.splitlines()]
+        assert (rows[-1]["id"], rows[-1]["status"]) == (answer_id, "streaming")
+
+        # The checkpointed row is completed in place, keeping its id
+        db = TestingSessionLocal()
+        row = db.get(models.Message, answer_id)
+        row.content, row.status, row.updated_at = "Partial answer, finished", "complete", started + timedelta(seconds=5)
+        db.commit()
+        db.close()
+
+        tail = await client.get(url, headers=auth_headers, params={"since_message_id": answer_id})
+        resent = [json.loads(line) for line in tail.text.splitlines()]
+        assert [(r["id"], r["content"], r["status"]) for r in resent] == [
+            (answer_id, "Partial answer, finished", "complete"),
+        ]
+
+        # Older messages that were never checkpointed are not sent again
+        tail = await client.get(url, headers=auth_headers, params={"since_message_id": rows[4]["id"]})
+        assert [json.loads(line)["content"] for line in tail.text.splitlines()] == [
+            "message 5", "message 6", "Partial answer, finished",
+        ]
+
+
+@pytest.mark.asyncio
+async def test_history_stream_requires_owner(seeded, auth_headers):
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.get("/api/conversations/999999/stream", headers=auth_headers)
+    assert response.status_code == 404
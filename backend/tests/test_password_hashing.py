@@ -0,0 +1,123 @@
+"""Tests for off-loop password hashing, its admission limit and rehash-on-login"""
+import asyncio
+import os
+import tempfile
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from unittest.mock import patch
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from database import Base, get_db
+from main import app
+from security import (
+    PasswordHasher,
+    PasswordHasherBusy,
+    get_password_hash,
+    password_hasher,
+    password_needs_rehash,
+    user_cache,
+    verify_password,
+)
+import models
+
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "test_password_hashing.db")
+engine = create_engine(f"sqlite:///{TEST_DB_PATH}", connect_args={"check_same_thread": False})
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+Base.metadata.create_all(bind=engine)
+
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_PATH}")
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
+@pytest.fixture(scope="module", autouse=True)
+def override_dependencies():
+    app.dependency_overrides[get_db] = override_get_db
+    yield
+    app.dependency_overrides.pop(get_db, None)
+
+
+@pytest.fixture
+def legacy_user():
+    db = TestingSessionLocal()
+    db.query(models.User).delete()
+    db.commit()
+    user_cache.clear()
+    user = models.User(email="legacy@example.com", hashed_password=get_password_hash("password123", rounds=4))
+    db.add(user)
+    db.commit()
+    db.close()
+    return {"email": "legacy@example.com", "password": "password123"}
+
+
+def test_password_needs_rehash_compares_cost():
+    hashed = get_password_hash("secret", rounds=4)
+    assert password_needs_rehash(hashed, rounds=5)
+    assert not password_needs_rehash(hashed, rounds=4)
+    assert password_needs_rehash("not-a-bcrypt-hash", rounds=4)
+
+
+@pytest.mark.asyncio
+async def test_hasher_runs_off_the_event_loop():
+    hasher = PasswordHasher(workers=2, max_pending=4)
+    with patch("security.BCRYPT_ROUNDS", 4):
+        hashed = await hasher.hash("secret")
+    assert await hasher.verify("secret", hashed)
+    assert not await hasher.verify("wrong", hashed)
+    assert hasher.stats()["completed"] == 3
+    hasher.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_hasher_rejects_beyond_max_pending():
+    hasher = PasswordHasher(workers=1, max_pending=1)
+    hashed = get_password_hash("secret", rounds=10)
+
+    first = asyncio.create_task(hasher.verify("secret", hashed))
+    await asyncio.sleep(0)
+    assert hasher.stats()["pending"] == 1
+    with pytest.raises(PasswordHasherBusy):
+        await hasher.verify("secret", hashed)
+
+    assert await first
+    assert hasher.stats()["rejected"] == 1
+    hasher.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_login_returns_503_when_hasher_is_saturated(legacy_user):
+    with patch.object(password_hasher, "max_pending", 0):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post(
+                "/api/auth/login",
+                data={"username": legacy_user["email"], "password": legacy_user["password"]},
+            )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+@pytest.mark.asyncio
+async def test_login_upgrades_hash_when_cost_changes(legacy_user):
+    with patch("security.BCRYPT_ROUNDS", 5):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post(
+                "/api/auth/login",
+                data={"username": legacy_user["email"], "password": legacy_user["password"]},
+            )
+    assert response.status_code == 200
+
+    db = TestingSessionLocal()
+    stored = db.query(models.User).filter(models.User.email == legacy_user["email"]).first().hashed_password
+    db.close()
+    assert stored.split("$")[2] == "05"
+    assert verify_password(legacy_user["password"], stored)
@@ -0,0 +1,164 @@
+"""Tests for per-user token-bucket rate limiting"""
+import os
+import tempfile
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from unittest.mock import patch
+
+from security import get_password_hash, user_cache
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from database import Base, get_db, get_read_db
+from main import app
+from services.rate_limit import RateLimiter
+from services.scheduler import GenerationScheduler
+import models
+
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "test_rate_limit.db")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DB_PATH}"
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+Base.metadata.create_all(bind=engine)
+
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_PATH}")
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
+@pytest.fixture(scope="module", autouse=True)
+def override_dependencies():
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    yield
+    app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_read_db, None)
+
+
+@pytest.fixture
+async def auth_headers():
+    db = TestingSessionLocal()
+    db.query(models.Message).delete()
+    db.query(models.Conversation).delete()
+    db.query(models.User).delete()
+    db.commit()
+    user_cache.clear()
+    db.add(models.User(email="limited@example.com", hashed_password=get_password_hash("password123")))
+    db.commit()
+    db.close()
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.post(
+            "/api/auth/login",
+            data={"username": "limited@example.com", "password": "password123"},
+        )
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.mark.asyncio
+async def test_bucket_allows_a_burst_then_refills():
+    limiter = RateLimiter(mode="memory", capacity=2, refill_per_second=1)
+    assert (await limiter.check(1)).allowed
+    assert (await limiter.check(1)).allowed
+    denied = await limiter.check(1)
+    assert not denied.allowed
+    assert denied.headers()["RateLimit-Remaining"] == "0"
+    assert denied.headers()["Retry-After"] == "1"
+    assert (await limiter.check(2)).allowed  # buckets are per key
+
+    bucket_tokens, updated_at = limiter._buckets["1"]
+    limiter._buckets["1"] = (bucket_tokens, updated_at - 1.5)
+    allowed = await limiter.check(1)
+    assert allowed.allowed
+    assert allowed.headers() == {"RateLimit-Limit": "2", "RateLimit-Remaining": "0", "RateLimit-Reset": "2"}
+    assert limiter.stats()["limited"] == 1
+
+
+@pytest.mark.asyncio
+async def test_token_unit_charges_estimated_tokens():
+    limiter = RateLimiter(mode="memory", unit="tokens", capacity=1000, refill_per_second=10)
+    assert limiter.cost(600) == 600
+    assert limiter.cost(5000) == 1000  # capped so a huge prompt is not rejected forever
+    assert (await limiter.check("u", limiter.cost(600))).remaining == 400
+    denied = await limiter.check("u", limiter.cost(600))
+    assert not denied.allowed
+    assert denied.retry_after == pytest.approx(20, abs=0.1)
+    assert RateLimiter(mode="memory").cost(5000) == 1
+    assert await RateLimiter(mode="off").check("u") is None
+
+
+@pytest.mark.asyncio
+async def test_sqlite_buckets_are_shared_between_workers():
+    path = os.path.join(tempfile.mkdtemp(), "buckets.db")
+    worker_a = RateLimiter(mode="sqlite", path=path, capacity=3, refill_per_second=0)
+    worker_b = RateLimiter(mode="sqlite", path=path, capacity=3, refill_per_second=0)
+    try:
+        assert (await worker_a.check(7)).allowed
+        assert (await worker_b.check(7)).allowed
+        assert (await worker_a.check(7)).remaining == 0
+        assert not (await worker_b.check(7)).allowed
+
+        # worker_b now knows the bucket is empty and rejects without the file
+        assert not (await worker_b.check(7)).allowed
+        assert worker_b.stats()["local_rejections"] == 1
+    finally:
+        worker_a.close()
+        worker_b.close()
+
+
+@pytest.mark.asyncio
+async def test_chat_endpoint_returns_429_with_rate_limit_headers(auth_headers):
+    limiter = RateLimiter(mode="memory", capacity=1, refill_per_second=0.5)
+    with patch("api.chat.chat_rate_limiter", limiter), \
+         patch("api.chat.stream_llm_response") as mock_stream:
+        async def fake_stream(*args, **kwargs):
+            yield {"content": "Hi"}
+        mock_stream.side_effect = fake_stream
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            first = await client.post("/api/chat", json={"message": "Hi"}, headers=auth_headers)
+            second = await client.post("/api/chat", json={"message": "Hi again"}, headers=auth_headers)
+
+    assert first.status_code == 200
+    assert first.headers["RateLimit-Remaining"] == "0"
+    assert second.status_code == 429
+    assert second.headers["Retry-After"] == "2"
+    assert second.headers["RateLimit-Limit"] == "1"
+    assert mock_stream.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_requests_rejected_by_admission_control_are_not_charged(auth_headers):
+    limiter = RateLimiter(mode="memory", capacity=1, refill_per_second=0)
+    scheduler = GenerationScheduler(capacity=1, max_queue=0)
+    busy = scheduler.enqueue()
+    [p async for p in busy.wait()]
+    with patch("api.chat.chat_rate_limiter", limiter), \
+         patch("api.chat.generation_scheduler", scheduler), \
+         patch("api.chat.stream_llm_response") as mock_stream:
+        async def fake_stream(*args, **kwargs):
+            yield {"content": "Hi"}
+        mock_stream.side_effect = fake_stream
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            rejected = await client.post("/api/chat", json={"message": "Hi"}, headers=auth_headers)
+            busy.release()
+            accepted = await client.post("/api/chat", json={"message": "Hi again"}, headers=auth_headers)
+            limited = await client.post("/api/chat", json={"message": "Once more"}, headers=auth_headers)
+
+    assert rejected.status_code == 503
+    assert accepted.status_code == 200
+    assert limited.status_code == 429
+    # Only the accepted request still holds a ticket (the mocked stream never waits on it);
+    # the rate-limited one gave its queue place back
+    assert scheduler.stats()["waiting"] == 1
+    assert limiter.stats()["allowed"] == 1
@@ -0,0 +1,268 @@
+"""Tests for resumable SSE generations and the replay buffer"""
+import asyncio
+import json
+import os
+import tempfile
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from unittest.mock import patch
+
+from security import get_password_hash, user_cache
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from database import Base, get_db, get_read_db
+from main import app
+from services.replay import ReplayGapError, ReplayRegistry, replay_registry
+import models
+
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "test_replay.db")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DB_PATH}"
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+Base.metadata.create_all(bind=engine)
+
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_PATH}")
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
+@pytest.fixture(scope="module", autouse=True)
+def override_dependencies():
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    yield
+    app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_read_db, None)
+
+
+@pytest.fixture
+async def auth_headers():
+    db = TestingSessionLocal()
+    db.query(models.Message).delete()
+    db.query(models.Conversation).delete()
+    db.query(models.User).delete()
+    db.commit()
+    user_cache.clear()
+    replay_registry.clear()
+    db.add(models.User(email="resume@example.com", hashed_password=get_password_hash("password123")))
+    db.commit()
+    db.close()
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.post(
+            "/api/auth/login",
+            data={"username": "resume@example.com", "password": "password123"},
+        )
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def _frames(queue):
+    while True:
+        frame = await queue.get()
+        if frame is None:
+            return
+        yield frame
+
+
+def _parse(body: str):
+    events = []
+    for block in body.split("\n\n"):
+        if not block:
+            continue
+        fields = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((int(fields["id"]), json.loads(fields["data"])))
+    return events
+
+
+@pytest.mark.asyncio
+async def test_frames_get_increasing_ids_and_can_be_resumed():
+    registry = ReplayRegistry()
+    queue = asyncio.Queue()
+    generation = registry.create(user_id=1, conversation_id=1)
+    generation.start(_frames(queue))
+    for i in range(3):
+        queue.put_nowait(f'data: {{"content": "{i}"}}\n\n')
+    queue.put_nowait(None)
+    await generation.wait()
+
+    everything = [frame async for frame in generation.subscribe()]
+    assert everything[0] == b'id: 1\ndata: {"content": "0"}\n\n'
+    assert len(everything) == 3
+
+    tail = [frame async for frame in generation.subscribe(2)]
+    assert tail == [b'id: 3\ndata: {"content": "2"}\n\n']
+    assert registry.get(generation.id, user_id=1) is generation
+    assert registry.get(generation.id, user_id=2) is None
+
+
+@pytest.mark.asyncio
+async def test_subscriber_follows_live_frames():
+    registry = ReplayRegistry()
+    queue = asyncio.Queue()
+    generation = registry.create(user_id=1, conversation_id=1)
+    generation.start(_frames(queue))
+    received = []
+
+    async def consume():
+        async for frame in generation.subscribe():
+            received.append(frame)
+
+    consumer = asyncio.create_task(consume())
+    queue.put_nowait(b"data: {}\n\n")
+    await asyncio.sleep(0.01)
+    assert received == [b"id: 1\ndata: {}\n\n"]
+    queue.put_nowait(b"data: {}\n\n")
+    queue.put_nowait(None)
+    await asyncio.wait_for(consumer, 1)
+    assert len(received) == 2
+
+
+@pytest.mark.asyncio
+async def test_ring_buffer_is_bounded():
+    registry = ReplayRegistry(max_events=2)
+    queue = asyncio.Queue()
+    generation = registry.create(user_id=1, conversation_id=1)
+    generation.start(_frames(queue))
+    for _ in range(5):
+        queue.put_nowait(b"data: {}\n\n")
+    queue.put_nowait(None)
+    await generation.wait()
+
+    assert generation.last_event_id == 5
+    assert registry.total_bytes == generation.size == 2 * len(b"id: 5\ndata: {}\n\n")
+    generation.check_resumable(3)
+    with pytest.raises(ReplayGapError):
+        generation.check_resumable(1)
+
+
+@pytest.mark.asyncio
+async def test_finished_generations_expire_and_respect_memory_cap():
+    registry = ReplayRegistry(max_bytes=40, ttl_seconds=60)
+    generations = []
+    for _ in range(3):
+        queue = asyncio.Queue()
+        generation = registry.create(user_id=1, conversation_id=1)
+        generation.start(_frames(queue))
+        queue.put_nowait(b"data: " + b"x" * 10 + b"\n\n")
+        queue.put_nowait(None)
+        await generation.wait()
+        generations.append(generation)
+
+    # Each buffer holds 24 bytes, so only the newest one fits in 40
+    assert registry.get(generations[0].id, 1) is None
+    assert registry.get(generations[1].id, 1) is None
+    assert registry.get(generations[2].id, 1) is generations[2]
+    assert registry.total_bytes == generations[2].size
+
+    registry.ttl_seconds = 0
+    assert registry.get(generations[2].id, 1) is None
+    assert registry.total_bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_generation_without_subscribers_is_cancelled_after_grace():
+    registry = ReplayRegistry(grace_seconds=0.05)
+    cancelled = asyncio.Event()
+
+    async def endless():
+        try:
+            yield b"data: {}\n\n"
+            await asyncio.sleep(10)
+        finally:
+            cancelled.set()
+
+    generation = registry.create(user_id=1, conversation_id=1)
+    generation.start(endless())
+    subscription = generation.subscribe()
+    assert await subscription.__anext__() == b"id: 1\ndata: {}\n\n"
+    await subscription.aclose()
+
+    # Reattaching within the grace period keeps the generation alive
+    await asyncio.sleep(0.02)
+    resumed = generation.subscribe(1)
+    waiter = asyncio.ensure_future(resumed.__anext__())
+    await asyncio.sleep(0.1)
+    assert generation.running
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    await resumed.aclose()
+
+    await asyncio.wait_for(cancelled.wait(), 1)
+    await generation.wait()
+    assert generation.done
+    assert registry.abandoned == 1
+
+
+@pytest.mark.asyncio
+async def test_resumable_chat_stream_and_reconnect(auth_headers):
+    with patch("api.chat.stream_llm_response") as mock_stream:
+        async def mock_generator(*args, **kwargs):
+            yield {"content": "Hello"}
+            yield {"content": " again"}
+            yield {"type": "metadata", "duration_ms": 5}
+
+        mock_stream.side_effect = mock_generator
+
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post(
+                "/api/chat",
+                headers=auth_headers,
+                json={"message": "Resume me", "history": [], "resumable": True},
+            )
+            assert response.status_code == 200
+            generation_id = response.headers["X-Generation-Id"]
+            events = _parse(response.text)
+            assert [event_id for event_id, _ in events] == [1, 2, 3]
+            assert events[-1][1]["generation_id"] == generation_id
+
+            resumed = await client.get(
+                f"/api/chat/{generation_id}/events",
+                headers={**auth_headers, "Last-Event-ID": "1"},
+            )
+            assert resumed.status_code == 200
+            assert _parse(resumed.text) == events[1:]
+
+            by_query = await client.get(
+                f"/api/chat/{generation_id}/events", headers=auth_headers, params={"last_event_id": 2}
+            )
+            assert _parse(by_query.text) == events[2:]
+
+            missing = await client.get("/api/chat/unknown/events", headers=auth_headers)
+            assert missing.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_reconnect_past_the_replay_window_is_gone(auth_headers):
+    with patch("api.chat.stream_llm_response") as mock_stream, \
+         patch.object(replay_registry, "max_events", 1):
+        async def mock_generator(*args, **kwargs):
+            yield {"content": "a"}
+            yield {"content": "b"}
+
+        mock_stream.side_effect = mock_generator
+
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post(
+                "/api/chat",
+                headers=auth_headers,
+                json={"message": "Window", "history": [], "resumable": True},
+            )
+            generation_id = response.headers["X-Generation-Id"]
+            resumed = await client.get(
+                f"/api/chat/{generation_id}/events",
+                headers={**auth_headers, "Last-Event-ID": "0"},
+            )
+            assert resumed.status_code == 410
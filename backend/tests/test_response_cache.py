@@ -0,0 +1,108 @@
+"""Tests for the exact-match response cache"""
+import os
+import tempfile
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from services.llm import stream_llm_response
+from services.response_cache import ResponseCache
+
+
+def _upstream(tokens):
+    async def gen():
+        for token in tokens:
+            chunk = MagicMock()
+            chunk.choices = [MagicMock(delta=MagicMock(content=token))]
+            yield chunk
+    return gen()
+
+
+def test_key_normalizes_messages_and_includes_parameters():
+    key = ResponseCache.key
+    base = key("m", [{"role": "user", "content": "Hi there"}], 0.0, 0.9)
+    assert key("m", [{"role": "User", "content": "  Hi there\r\n"}], 0.0, 0.9) == base
+    assert key("m", [{"role": "user", "content": "Hi  there"}], 0.0, 0.9) != base
+    assert key("other", [{"role": "user", "content": "Hi there"}], 0.0, 0.9) != base
+    assert key("m", [{"role": "user", "content": "Hi there"}], 0.0, 0.5) != base
+
+
+def test_only_deterministic_requests_are_cacheable():
+    assert not ResponseCache(mode="off").cacheable(0.0)
+    cache = ResponseCache(mode="memory")
+    assert cache.cacheable(0.0)
+    assert not cache.cacheable(0.7)
+    with pytest.raises(RuntimeError):
+        ResponseCache(mode="redis")
+
+
+@pytest.mark.asyncio
+async def test_memory_tier_lru_and_ttl():
+    cache = ResponseCache(mode="memory", max_entries=2, ttl_seconds=60)
+    await cache.put("a", "A")
+    await cache.put("b", "B")
+    assert await cache.get("a") == "A"
+    await cache.put("c", "C")
+    assert await cache.get("b") is None  # least recently used
+    assert await cache.get("a") == "A"
+    assert cache.evictions == 1
+
+    cache.ttl_seconds = 0
+    await cache.put("d", "D")
+    assert await cache.get("d") is None
+    assert cache.expirations == 1
+
+
+@pytest.mark.asyncio
+async def test_sqlite_tier_survives_a_new_instance():
+    path = os.path.join(tempfile.mkdtemp(), "responses.db")
+    first = ResponseCache(mode="sqlite", path=path)
+    await first.put("k", "persisted answer")
+    first.close()
+
+    second = ResponseCache(mode="sqlite", path=path)
+    assert await second.get("k") == "persisted answer"
+    assert second.disk_hits == 1
+    # Promoted into the memory tier
+    assert await second.get("k") == "persisted answer"
+    assert second.disk_hits == 1
+    second.ttl_seconds = -1
+    await second.put("old", "expired")
+    second._entries.clear()
+    assert await second.get("old") is None
+    second.close()
+
+
+@pytest.mark.asyncio
+async def test_identical_deterministic_request_is_served_from_cache():
+    cache = ResponseCache(mode="memory")
+    with patch("services.llm.response_cache", cache), \
+         patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create:
+        mock_create.return_value = _upstream(["Welcome", " aboard"])
+        first = [e async for e in stream_llm_response("How do I start?", [], AsyncMock(), temperature=0.0)]
+
+        on_complete = AsyncMock()
+        mock_create.return_value = _upstream(["should not be used"])
+        second = [e async for e in stream_llm_response("How do I start?", [], on_complete, temperature=0.0)]
+
+    assert mock_create.await_count == 1
+    assert "cached" not in first[-1]
+    assert second[0] == {"content": "Welcome aboard"}
+    assert second[-1]["type"] == "metadata" and second[-1]["cached"] is True
+    assert on_complete.await_args.args[0] == "Welcome aboard"
+
+
+@pytest.mark.asyncio
+async def test_sampled_requests_bypass_the_cache():
+    cache = ResponseCache(mode="memory")
+    with patch("services.llm.response_cache", cache), \
+         patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create:
+        for _ in range(2):
+            mock_create.return_value = _upstream(["Hi"])
+            [e async for e in stream_llm_response("Hello", [], AsyncMock(), temperature=0.7)]
+
+    assert mock_create.await_count == 2
+    assert cache.stores == 0
@@ -0,0 +1,214 @@
+"""Tests for generation admission control and priority scheduling"""
+import asyncio
+import os
+import tempfile
+import time
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from security import get_password_hash, user_cache
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from database import Base, get_db, get_read_db
+from main import app
+from services.llm import stream_llm_response
+from services.scheduler import GenerationScheduler, QueueFull, QueueTimeout, request_priority
+import models
+
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "test_scheduler.db")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DB_PATH}"
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+Base.metadata.create_all(bind=engine)
+
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_PATH}")
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
+@pytest.fixture(scope="module", autouse=True)
+def override_dependencies():
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    yield
+    app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_read_db, None)
+
+
+@pytest.fixture
+async def auth_headers():
+    db = TestingSessionLocal()
+    db.query(models.Message).delete()
+    db.query(models.Conversation).delete()
+    db.query(models.User).delete()
+    db.commit()
+    user_cache.clear()
+    db.add(models.User(email="queue@example.com", hashed_password=get_password_hash("password123")))
+    db.commit()
+    db.close()
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.post(
+            "/api/auth/login",
+            data={"username": "queue@example.com", "password": "password123"},
+        )
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def _positions(ticket, into):
+    async for position in ticket.wait():
+        into.append(position)
+
+
+@pytest.mark.asyncio
+async def test_free_slot_is_granted_without_queueing():
+    scheduler = GenerationScheduler(capacity=1)
+    ticket = scheduler.enqueue()
+    assert [p async for p in ticket.wait()] == []
+    assert scheduler.running == 1
+    ticket.release()
+    ticket.release()  # idempotent
+    assert scheduler.running == 0
+    assert GenerationScheduler(capacity=0).enqueue() is None
+
+
+@pytest.mark.asyncio
+async def test_waiters_are_served_by_priority_and_see_their_position():
+    scheduler = GenerationScheduler(capacity=1)
+    running = scheduler.enqueue()
+    [p async for p in running.wait()]
+
+    follow_up = scheduler.enqueue(request_priority(first_turn=False, prompt_chars=100))
+    long_first = scheduler.enqueue(request_priority(first_turn=True, prompt_chars=5000))
+    short_first = scheduler.enqueue(request_priority(first_turn=True, prompt_chars=100))
+    seen = {t: [] for t in (follow_up, long_first, short_first)}
+    waiters = [asyncio.create_task(_positions(t, seen[t])) for t in seen]
+    await asyncio.sleep(0.01)
+    assert (seen[short_first], seen[long_first], seen[follow_up]) == ([1], [2], [3])
+
+    order = []
+    for _ in range(3):
+        running.release()
+        await asyncio.sleep(0.01)
+        running = next(t for t in seen if t.granted_at is not None and t not in order)
+        order.append(running)
+    await asyncio.gather(*waiters)
+    assert order == [short_first, long_first, follow_up]
+    assert seen[follow_up] == [3, 2, 1]
+    assert scheduler.stats()["queued"] == 3
+
+
+@pytest.mark.asyncio
+async def test_queued_waiter_resumes_right_after_a_release():
+    scheduler = GenerationScheduler(capacity=1)
+    running = scheduler.enqueue()
+    [p async for p in running.wait()]
+    waiter = scheduler.enqueue()
+    task = asyncio.create_task(_positions(waiter, []))
+    await asyncio.sleep(0.01)
+
+    released_at = time.monotonic()
+    running.release()
+    await asyncio.wait_for(task, 0.5)
+    # Woken by the grant itself, not by the once-a-second position refresh
+    assert time.monotonic() - released_at < 0.05
+    waiter.release()
+
+
+@pytest.mark.asyncio
+async def test_aged_waiters_overtake_higher_priorities():
+    scheduler = GenerationScheduler(capacity=1, aging_seconds=0.05)
+    running = scheduler.enqueue()
+    [p async for p in running.wait()]
+    old = scheduler.enqueue((1,))
+    await asyncio.sleep(0.06)
+    new = scheduler.enqueue((0,))
+    assert scheduler.position(old) == 1
+    assert scheduler.position(new) == 2
+
+
+@pytest.mark.asyncio
+async def test_full_queue_is_rejected_with_a_retry_hint():
+    scheduler = GenerationScheduler(capacity=1, max_queue=1)
+    scheduler.avg_hold_seconds = 4.0
+    first = scheduler.enqueue()
+    [p async for p in first.wait()]
+    scheduler.enqueue()
+    with pytest.raises(QueueFull) as exc:
+        scheduler.enqueue()
+    assert exc.value.retry_after == 8
+    assert scheduler.stats()["rejected"] == 1
+
+
+@pytest.mark.asyncio
+async def test_waiting_times_out_and_abandoned_tickets_expire():
+    scheduler = GenerationScheduler(capacity=1, max_queue=1, timeout=0.05)
+    first = scheduler.enqueue()
+    [p async for p in first.wait()]
+    late = scheduler.enqueue()
+    with pytest.raises(QueueTimeout):
+        [p async for p in late.wait()]
+    assert scheduler.stats()["waiting"] == 0
+
+    scheduler.enqueue()  # never waited on, e.g. the response was never streamed
+    await asyncio.sleep(0.06)
+    scheduler.enqueue()
+    assert scheduler.stats()["expired"] == 1
+
+
+def _upstream(tokens):
+    async def gen():
+        for token in tokens:
+            chunk = MagicMock()
+            chunk.choices = [MagicMock(delta=MagicMock(content=token))]
+            yield chunk
+    return gen()
+
+
+@pytest.mark.asyncio
+async def test_stream_reports_queue_position_and_frees_the_slot():
+    scheduler = GenerationScheduler(capacity=1)
+    busy = scheduler.enqueue()
+    [p async for p in busy.wait()]
+    ticket = scheduler.enqueue()
+    with patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create:
+        mock_create.side_effect = lambda **kwargs: _upstream(["Hi"])
+        stream = stream_llm_response("Hello", [], AsyncMock(), admission=ticket)
+        assert await stream.__anext__() == {"type": "queue", "position": 1}
+        busy.release()
+        rest = [e async for e in stream]
+    assert rest[0] == {"content": "Hi"}
+    assert rest[-1]["type"] == "metadata"
+    assert scheduler.running == 0
+
+
+@pytest.mark.asyncio
+async def test_chat_endpoint_returns_503_when_the_queue_is_full(auth_headers):
+    scheduler = GenerationScheduler(capacity=1, max_queue=0)
+    scheduler.avg_hold_seconds = 2.5
+    busy = scheduler.enqueue()
+    [p async for p in busy.wait()]
+    with patch("api.chat.generation_scheduler", scheduler), \
+         patch("api.chat.stream_llm_response") as mock_stream:
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post("/api/chat", json={"message": "Hi"}, headers=auth_headers)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+    mock_stream.assert_not_called()
+
+    db = TestingSessionLocal()
+    assert db.query(models.Message).count() == 0
+    db.close()
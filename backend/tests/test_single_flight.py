@@ -0,0 +1,270 @@
+"""Tests for sharing one upstream generation between concurrent identical requests"""
+import asyncio
+import os
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from services.llm import stream_llm_response
+from services.scheduler import GenerationScheduler
+from services.single_flight import SingleFlight
+
+
+def _controlled_source(gate: asyncio.Queue, closed: list):
+    async def source():
+        try:
+            while True:
+                delta = await gate.get()
+                if delta is None:
+                    return
+                yield delta
+        finally:
+            closed.append(True)
+    return source
+
+
+async def _drain(stream, into):
+    async for delta in stream:
+        into.append(delta)
+
+
+@pytest.mark.asyncio
+async def test_late_joiner_is_backfilled():
+    group = SingleFlight()
+    gate, closed = asyncio.Queue(), []
+    factory = _controlled_source(gate, closed)
+    first, second = [], []
+
+    leader = asyncio.create_task(_drain(group.stream("k", factory), first))
+    gate.put_nowait("a")
+    gate.put_nowait("b")
+    await asyncio.sleep(0.01)
+    follower = asyncio.create_task(_drain(group.stream("k", factory), second))
+    await asyncio.sleep(0.01)
+    gate.put_nowait("c")
+    gate.put_nowait(None)
+    await asyncio.gather(leader, follower)
+
+    assert first == second == ["a", "b", "c"]
+    assert group.stats() == {"in_flight": 0, "flights": 1, "shared": 1, "backfilled_deltas": 2, "cancelled": 0}
+    assert closed == [True]
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_does_not_block_the_producer():
+    group = SingleFlight()
+    gate, closed = asyncio.Queue(), []
+    factory = _controlled_source(gate, closed)
+    stalled = group.stream("k", factory)
+    assert await asyncio.wait_for(_first(stalled, gate), 1) == "a"
+
+    fast = []
+    reader = asyncio.create_task(_drain(group.stream("k", factory), fast))
+    for delta in ["b", "c", None]:
+        gate.put_nowait(delta)
+    await asyncio.wait_for(reader, 1)
+
+    assert fast == ["a", "b", "c"]
+    await stalled.aclose()
+
+
+async def _first(stream, gate):
+    gate.put_nowait("a")
+    return await stream.__anext__()
+
+
+@pytest.mark.asyncio
+async def test_upstream_is_cancelled_when_every_caller_leaves():
+    group = SingleFlight()
+    gate, closed = asyncio.Queue(), []
+    factory = _controlled_source(gate, closed)
+    one, two = group.stream("k", factory), group.stream("k", factory)
+    gate.put_nowait("a")
+    await one.__anext__()
+    await two.__anext__()
+
+    await one.aclose()
+    await asyncio.sleep(0.01)
+    assert closed == []
+    await two.aclose()
+    await asyncio.sleep(0.01)
+
+    assert closed == [True]
+    assert group.cancelled == 1
+    assert group.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_errors_reach_every_caller():
+    group = SingleFlight()
+
+    async def failing():
+        yield "partial"
+        raise ValueError("upstream failed")
+
+    async def consume():
+        return [d async for d in group.stream("k", failing)]
+
+    results = await asyncio.gather(consume(), consume(), return_exceptions=True)
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+def _upstream(tokens):
+    async def gen():
+        for token in tokens:
+            await asyncio.sleep(0)
+            chunk = MagicMock()
+            chunk.choices = [MagicMock(delta=MagicMock(content=token))]
+            yield chunk
+    return gen()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_deterministic_requests_share_one_upstream_call():
+    group = SingleFlight()
+    with patch("services.llm.SINGLE_FLIGHT", True), \
+         patch("services.llm.single_flight", group), \
+         patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create:
+        mock_create.side_effect = lambda **kwargs: _upstream(["Same", " answer"])
+        callbacks = [AsyncMock(), AsyncMock(), AsyncMock()]
+
+        async def ask(callback):
+            return [e async for e in stream_llm_response("FAQ", [], callback, temperature=0.0)]
+
+        results = await asyncio.gather(*(ask(cb) for cb in callbacks))
+
+    assert mock_create.call_count == 1
+    for events, callback in zip(results, callbacks):
+        assert [e["content"] for e in events if "content" in e] == ["Same", " answer"]
+        assert events[-1]["type"] == "metadata"
+        assert callback.await_args.args[0] == "Same answer"
+
+
+@pytest.mark.asyncio
+async def test_sampled_requests_are_not_shared():
+    group = SingleFlight()
+    with patch("services.llm.SINGLE_FLIGHT", True), \
+         patch("services.llm.single_flight", group), \
+         patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create:
+        mock_create.side_effect = lambda **kwargs: _upstream(["Hi"])
+
+        async def ask():
+            return [e async for e in stream_llm_response("FAQ", [], AsyncMock(), temperature=0.8)]
+
+        await asyncio.gather(ask(), ask())
+
+    assert mock_create.call_count == 2
+    assert group.flights == 0
+
+
+@pytest.mark.asyncio
+async def test_requests_are_not_shared_unless_enabled():
+    group = SingleFlight()
+    with patch("services.llm.SINGLE_FLIGHT", False), \
+         patch("services.llm.single_flight", group), \
+         patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create:
+        mock_create.side_effect = lambda **kwargs: _upstream(["Hi"])
+
+        async def ask():
+            return [e async for e in stream_llm_response("FAQ", [], AsyncMock(), temperature=0.0)]
+
+        await asyncio.gather(ask(), ask())
+
+    assert mock_create.call_count == 2
+    assert group.flights == 0
+
+
+@pytest.mark.asyncio
+async def test_joining_a_running_flight_takes_no_admission_slot():
+    group = SingleFlight()
+    scheduler = GenerationScheduler(capacity=1)
+    gate = asyncio.Queue()
+
+    async def create(**kwargs):
+        async def gen():
+            while True:
+                token = await gate.get()
+                if token is None:
+                    return
+                chunk = MagicMock()
+                chunk.choices = [MagicMock(delta=MagicMock(content=token))]
+                yield chunk
+        return gen()
+
+    async def ask():
+        ticket = scheduler.enqueue()
+        return [e async for e in stream_llm_response("FAQ", [], AsyncMock(), temperature=0.0, admission=ticket)]
+
+    with patch("services.llm.SINGLE_FLIGHT", True), \
+         patch("services.llm.single_flight", group), \
+         patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create:
+        mock_create.side_effect = create
+        leader = asyncio.create_task(ask())
+        await asyncio.sleep(0.01)
+        assert scheduler.running == 1
+        # The only slot is taken, yet an identical request joins without queueing
+        follower = asyncio.create_task(ask())
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()["waiting"] == 0
+        gate.put_nowait("Same")
+        gate.put_nowait(None)
+        results = await asyncio.gather(leader, follower)
+
+    assert mock_create.call_count == 1
+    for events in results:
+        assert [e.get("type") for e in events if "content" not in e] == ["metadata"]
+        assert [e["content"] for e in events if "content" in e] == ["Same"]
+    assert scheduler.stats()["admitted"] == 1
+    assert scheduler.running == 0
+
+
+@pytest.mark.asyncio
+async def test_slot_is_held_while_the_flight_runs_after_its_starter_leaves():
+    group = SingleFlight()
+    scheduler = GenerationScheduler(capacity=1)
+    gate = asyncio.Queue()
+    closed = []
+    source = _controlled_source(gate, closed)
+
+    async def create(**kwargs):
+        async def gen():
+            async for token in source():
+                chunk = MagicMock()
+                chunk.choices = [MagicMock(delta=MagicMock(content=token))]
+                yield chunk
+        return gen()
+
+    def ask():
+        return stream_llm_response("FAQ", [], AsyncMock(), temperature=0.0, admission=scheduler.enqueue())
+
+    with patch("services.llm.SINGLE_FLIGHT", True), \
+         patch("services.llm.single_flight", group), \
+         patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create:
+        mock_create.side_effect = create
+        starter, follower = ask(), ask()
+        gate.put_nowait("a")
+        assert await starter.__anext__() == {"content": "a"}
+        assert await follower.__anext__() == {"content": "a"}
+
+        # The starter disconnects; the upstream generation goes on for the follower
+        await starter.aclose()
+        await asyncio.sleep(0.01)
+        assert closed == []
+        assert scheduler.running == 1
+        waiting = scheduler.enqueue()
+        waiter = asyncio.create_task(_drain(waiting.wait(), []))
+        await asyncio.sleep(0.01)
+        assert waiting.granted_at is None
+
+        gate.put_nowait("b")
+        gate.put_nowait(None)
+        rest = [e async for e in follower]
+        await asyncio.wait_for(waiter, 1)
+
+    assert [e["content"] for e in rest if "content" in e] == ["b"]
+    assert waiting.granted_at is not None
+    waiting.release()
+    assert scheduler.running == 0
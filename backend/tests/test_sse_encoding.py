@@ -0,0 +1,31 @@
+"""Tests for the SSE event encoder"""
+import json
+
+from unittest.mock import patch
+
+from services import sse
+
+
+def test_encode_event_produces_data_frame():
+    frame = sse.encode_event({"content": "Hello ünïcode"})
+    assert isinstance(frame, bytes)
+    assert frame.startswith(b"data: ") and frame.endswith(b"\n\n")
+    assert json.loads(frame[6:]) == {"content": "Hello ünïcode"}
+
+
+def test_encode_event_without_orjson():
+    with patch("services.sse.orjson", None):
+        frame = sse.encode_event({"type": "metadata", "duration_ms": 5})
+    assert frame == b'data: {"type":"metadata","duration_ms":5}\n\n'
+
+
+def test_pre_encoded_frames_pass_through():
+    assert sse.encode_event(": keep-alive\n\n") == ": keep-alive\n\n"
+    assert sse.encode_event(b"data: {}\n\n") == b"data: {}\n\n"
+
+
+def test_decode_frame():
+    assert sse.decode_frame('data: {"type": "metadata"}\n\n') == {"type": "metadata"}
+    assert sse.decode_frame("data: {invalid json}\n\n") is None
+    assert sse.decode_frame("data: ping\n\n") is None
+    assert sse.decode_frame("event: ping\n") is None
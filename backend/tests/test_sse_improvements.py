@@ -1,45 +1,51 @@
 """Tests for SSE metadata parsing and DB session handling improvements"""
+import json
 import os
+import tempfile
 
 import pytest
 from httpx import ASGITransport, AsyncClient
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
 from unittest.mock import patch
 
-from security import get_password_hash
+from security import get_password_hash, user_cache
 
 os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
 os.environ.setdefault("LLM_API_KEY", "test-key")
 
-from database import Base, get_db
+from database import Base, get_db, get_read_db
 from main import app
 import models
 
 # Setup test DB (in-memory)
-SQLALCHEMY_DATABASE_URL = "sqlite://"
+# The app talks to the DB through an async engine while fixtures and assertions
+# use a sync engine, so both point at the same temporary SQLite file.
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "test_sse_improvements.db")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DB_PATH}"
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base.metadata.create_all(bind=engine)
 
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_PATH}")
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 @pytest.fixture(scope="module", autouse=True)
 def override_dependencies():
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
     yield
     app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_read_db, None)
 
 @pytest.fixture
 def clear_db():
@@ -49,6 +55,7 @@ def clear_db():
     db.query(models.Conversation).delete()
     db.query(models.User).delete()
     db.commit()
+    user_cache.clear()
     db.close()
     yield
 
@@ -238,3 +245,53 @@ async def test_sse_non_data_lines_passthrough(test_user, auth_headers):
             # Comment and event lines should be present
             assert ': comment line' in content_str or 'comment line' in content_str
             assert 'Test' in content_str
+
+@pytest.mark.asyncio
+async def test_sse_structured_events_are_encoded_once(test_user, auth_headers):
+    """Event dicts from the LLM service are serialized by the single encoder stage"""
+    with patch("api.chat.stream_llm_response") as mock_stream:
+        async def mock_generator(*args, **kwargs):
+            yield {"content": "Hé \"quoted\"\n"}
+            yield {"type": "metadata", "duration_ms": 42}
+
+        mock_stream.side_effect = mock_generator
+
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post(
+                "/api/chat",
+                headers=auth_headers,
+                json={"message": "Structured", "history": []}
+            )
+            assert response.status_code == 200
+            frames = [f for f in response.text.split("\n\n") if f]
+
+    events = [json.loads(f[len("data: "):]) for f in frames]
+    assert events[0] == {"content": "Hé \"quoted\"\n"}
+    assert events[1]["type"] == "metadata"
+    assert events[1]["duration_ms"] == 42
+    assert isinstance(events[1]["conversation_id"], int)
+
+@pytest.mark.asyncio
+async def test_sse_coalescing_requested_per_response(test_user, auth_headers):
+    """coalesce_ms merges deltas after the first one and reports the frame count"""
+    with patch("api.chat.stream_llm_response") as mock_stream:
+        async def mock_generator(*args, **kwargs):
+            for token in ["One", " two", " three", " four"]:
+                yield {"content": token}
+            yield {"type": "metadata", "duration_ms": 10}
+
+        mock_stream.side_effect = mock_generator
+
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post(
+                "/api/chat",
+                headers=auth_headers,
+                json={"message": "Coalesce", "history": [], "coalesce_ms": 50}
+            )
+            assert response.status_code == 200
+            frames = [f for f in response.text.split("\n\n") if f]
+
+    events = [json.loads(f[len("data: "):]) for f in frames]
+    assert [e.get("content") for e in events[:-1]] == ["One", " two three four"]
+    assert events[-1]["frames"] == 3
+    assert "conversation_id" in events[-1]
@@ -0,0 +1,185 @@
+"""Tests for opt-in request tracing and the sampling profiler"""
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from security import get_password_hash, user_cache
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from database import Base, get_db, get_read_db
+from main import app
+from services import sse
+from services.tracing import SamplingProfiler, Trace, TracingMiddleware, current_trace, span
+import models
+
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "test_tracing.db")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{TEST_DB_PATH}"
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+Base.metadata.create_all(bind=engine)
+
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{TEST_DB_PATH}")
+TestingAsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
+@pytest.fixture(scope="module", autouse=True)
+def override_dependencies():
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    yield
+    app.dependency_overrides.pop(get_db, None)
+    app.dependency_overrides.pop(get_read_db, None)
+
+
+@pytest.fixture
+async def auth_headers():
+    db = TestingSessionLocal()
+    db.query(models.Message).delete()
+    db.query(models.Conversation).delete()
+    db.query(models.User).delete()
+    db.commit()
+    user_cache.clear()
+    db.add(models.User(email="traced@example.com", hashed_password=get_password_hash("password123")))
+    db.commit()
+    db.close()
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.post(
+            "/api/auth/login",
+            data={"username": "traced@example.com", "password": "password123"},
+        )
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def _upstream(tokens):
+    async def gen():
+        for token in tokens:
+            chunk = MagicMock()
+            chunk.choices = [MagicMock(delta=MagicMock(content=token))]
+            yield chunk
+    return gen()
+
+
+async def _traced_endpoint(scope, receive, send):
+    with span("work"):
+        await asyncio.sleep(0.01)
+    trace = current_trace()
+    if trace is not None:
+        trace.accumulate("loop", 0.002)
+        trace.accumulate("loop", 0.003)
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+def test_spans_are_noops_outside_a_trace():
+    assert current_trace() is None
+    with span("anything") as result:
+        assert result is None
+
+    trace = Trace("GET /x")
+    with trace.span("db"):
+        pass
+    with trace.span("db"):
+        pass
+    trace.accumulate("sse_encode", 0.001)
+    assert set(trace.durations_ms()) == {"db", "sse_encode"}
+    assert trace.server_timing().startswith("db;dur=")
+    assert len(trace.to_chrome_trace()["traceEvents"]) == 3
+
+
+@pytest.mark.asyncio
+async def test_middleware_traces_on_debug_header_and_writes_chrome_trace():
+    trace_dir = tempfile.mkdtemp()
+    middleware = TracingMiddleware(_traced_endpoint, sample_rate=0, debug_token="s3cret", trace_dir=trace_dir)
+    async with AsyncClient(transport=ASGITransport(app=middleware), base_url="http://test") as client:
+        untraced = await client.get("/x")
+        wrong_token = await client.get("/x", headers={"X-Debug-Trace": "1", "X-Debug-Token": "nope"})
+        traced = await client.get("/x", headers={"X-Debug-Trace": "1", "X-Debug-Token": "s3cret"})
+
+    assert "server-timing" not in untraced.headers
+    assert "server-timing" not in wrong_token.headers
+    timings = dict(part.split(";dur=") for part in traced.headers["server-timing"].split(", "))
+    assert float(timings["work"]) >= 10
+    assert float(timings["loop"]) == pytest.approx(5)
+    assert middleware.traced == 1
+
+    with open(os.path.join(trace_dir, f"{traced.headers['x-trace-id']}.json")) as f:
+        exported = json.load(f)
+    assert [e["name"] for e in exported["traceEvents"]] == ["GET /x", "work"]
+    assert exported["otherData"]["accumulated"]["loop"]["count"] == 2
+
+
+@pytest.mark.asyncio
+async def test_debug_header_is_ignored_without_a_configured_token():
+    middleware = TracingMiddleware(_traced_endpoint, sample_rate=0, debug_token="", trace_dir="")
+    async with AsyncClient(transport=ASGITransport(app=middleware), base_url="http://test") as client:
+        response = await client.get("/x", headers={"X-Debug-Trace": "profile", "X-Debug-Token": ""})
+    assert "server-timing" not in response.headers
+    assert middleware.traced == 0
+
+
+@pytest.mark.asyncio
+async def test_sample_rate_traces_without_a_header():
+    middleware = TracingMiddleware(_traced_endpoint, sample_rate=1.0, trace_dir="")
+    async with AsyncClient(transport=ASGITransport(app=middleware), base_url="http://test") as client:
+        response = await client.get("/x")
+    assert "work;dur=" in response.headers["server-timing"]
+
+
+def test_sampling_profiler_collects_folded_stacks():
+    def busy_wait():
+        deadline = time.monotonic() + 0.1
+        while time.monotonic() < deadline:
+            pass
+
+    profiler = SamplingProfiler(threading.get_ident(), interval=0.002)
+    profiler.start()
+    busy_wait()
+    profiler.stop()
+
+    folded = profiler.folded()
+    assert "busy_wait (test_tracing.py:" in folded
+    stack, count = folded.splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0
+
+
+@pytest.mark.asyncio
+async def test_traced_chat_reports_stages_in_header_and_metadata(auth_headers):
+    # The app's middleware stack was built by the login request
+    middleware = app.middleware_stack
+    while not isinstance(middleware, TracingMiddleware):
+        middleware = middleware.app
+    with patch("services.llm.client.chat.completions.create", new_callable=AsyncMock) as mock_create, \
+         patch.object(middleware, "debug_token", b"s3cret"):
+        mock_create.return_value = _upstream(["Hello", " there"])
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.post(
+                "/api/chat",
+                json={"message": "Hi"},
+                headers={**auth_headers, "X-Debug-Trace": "1", "X-Debug-Token": "s3cret"},
+            )
+
+    assert response.status_code == 200
+    header_stages = {part.split(";")[0] for part in response.headers["server-timing"].split(", ")}
+    assert {"auth", "auth_db", "db_commit"} <= header_stages
+    metadata = [sse.decode_frame(f + "\n\n") for f in response.text.split("\n\n") if '"metadata"' in f][0]
+    assert {"context_window", "upstream_ttft", "upstream_wait", "sse_encode", "persist"} <= set(metadata["server_timing"])
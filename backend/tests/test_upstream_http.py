@@ -0,0 +1,178 @@
+"""Tests for the shared upstream HTTP client and the stream deadlines"""
+import asyncio
+import os
+
+import httpx
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from services.backends import Backend, BackendPool, load_backends
+from services.llm import stream_llm_response
+from services.upstream_http import StallWatchdog, UpstreamHTTP, upstream_http
+
+
+def _client(delays):
+    """Upstream whose n-th chunk arrives after delays[n] seconds."""
+    async def create(**kwargs):
+        async def gen():
+            for i, delay in enumerate(delays):
+                await asyncio.sleep(delay)
+                chunk = MagicMock()
+                chunk.choices = [MagicMock(delta=MagicMock(content=f"t{i}"))]
+                yield chunk
+        return gen()
+
+    client = MagicMock()
+    client.chat.completions.create = AsyncMock(side_effect=create)
+    return client
+
+
+def test_backends_share_one_http_client():
+    backends = load_backends(
+        '[{"name": "a", "base_url": "http://a/v1"}, {"name": "b", "base_url": "http://b/v1"}]',
+        default_api_key="k",
+        default_model="m",
+    )
+    assert backends[0].client._client is backends[1].client._client is upstream_http.client
+    assert backends[0].client.timeout == upstream_http.timeout
+
+
+@pytest.mark.asyncio
+async def test_pool_counts_requests_until_the_body_is_closed():
+    async def body():
+        yield b"data: x\n\n"
+
+    pool = UpstreamHTTP(max_connections=10)
+    pool._transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body()))
+    try:
+        async with pool.client.stream("POST", "http://upstream/v1/chat/completions") as response:
+            assert pool.stats()["in_flight"] == 1
+            assert pool.stats()["utilization"] == 0.1
+            await response.aread()
+        stats = pool.stats()
+        assert (stats["in_flight"], stats["peak_in_flight"], stats["requests"]) == (0, 1, 1)
+    finally:
+        await pool.close()
+    assert pool.stats()["started"] is False
+
+
+@pytest.mark.asyncio
+async def test_body_after_done_is_drained_so_the_connection_is_kept():
+    async def body():
+        yield b"data: {}\n\n"
+        yield b"data: [DONE]\n\n"
+        yield b""
+
+    pool = UpstreamHTTP()
+    pool._transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body()))
+    try:
+        # Read up to [DONE] and stop, like the OpenAI SDK does
+        async with pool.client.stream("POST", "http://upstream/v1/chat/completions") as response:
+            async for part in response.aiter_raw():
+                if part.endswith(b"[DONE]\n\n"):
+                    break
+        async with pool.client.stream("POST", "http://upstream/v1/chat/completions") as response:
+            async for part in response.aiter_raw():
+                break
+    finally:
+        await pool.close()
+    assert pool.stats()["drained"] == 1
+    assert pool.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_pool_is_opened_lazily_and_closed():
+    pool = UpstreamHTTP(max_connections=0, keepalive_expiry=1)
+    assert pool.stats()["started"] is False
+    assert pool.stats()["utilization"] is None
+    transport = pool.start()
+    assert pool.start() is transport
+    await pool.close()
+    assert pool._transport is None
+
+
+@pytest.mark.asyncio
+async def test_watchdog_only_fires_while_waiting():
+    watchdog = StallWatchdog()
+    watchdog.arm(0.05)
+    await asyncio.sleep(0.01)
+    watchdog.disarm()
+    # The consumer holding the stream past the deadline is not a stall
+    await asyncio.sleep(0.08)
+    watchdog.arm(0.05)
+    with pytest.raises(asyncio.CancelledError):
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            assert watchdog.expired()
+            raise
+    watchdog.close()
+
+
+@pytest.mark.asyncio
+async def test_watchdog_expiry_does_not_need_task_uncancel():
+    # Tasks on Python 3.10 have no uncancel(); the fired flag alone decides there
+    watchdog = StallWatchdog()
+    watchdog.arm(0.01)
+    with pytest.raises(asyncio.CancelledError):
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            task = watchdog._task
+            watchdog._task = MagicMock(spec=["cancel"])
+            assert watchdog.expired()
+            task.uncancel()
+            raise
+    watchdog.close()
+
+    idle = StallWatchdog()
+    idle.arm(1)
+    idle._task = MagicMock(spec=["cancel"])
+    assert not idle.expired()
+    idle.close()
+
+
+@pytest.mark.asyncio
+async def test_outside_cancellation_is_not_mistaken_for_a_stall():
+    watchdog = StallWatchdog()
+    watchdog.arm(0.01)
+    task = asyncio.current_task()
+    # The client goes away at the moment the deadline passes
+    asyncio.get_running_loop().call_at(watchdog.deadline, task.cancel)
+    with pytest.raises(asyncio.CancelledError):
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            assert watchdog.fired
+            assert not watchdog.expired()
+            raise
+    task.uncancel()
+    watchdog.close()
+
+
+@pytest.mark.asyncio
+async def test_slow_first_token_times_out_and_counts_against_the_backend():
+    slow = Backend("slow", _client([0.5]), "m")
+    pool = BackendPool([slow], max_failures=5)
+    with patch("services.llm.backend_pool", pool), \
+         patch.object(upstream_http, "first_token_timeout", 0.05):
+        events = [e async for e in stream_llm_response("Hi", [], AsyncMock())]
+
+    assert events == [{"error": "No first token from slow within 0.05s"}]
+    assert slow.failures == 1
+    assert slow.outstanding == 0
+
+
+@pytest.mark.asyncio
+async def test_stalled_stream_times_out_between_tokens():
+    stalling = Backend("stalling", _client([0, 0.01, 0.5]), "m")
+    pool = BackendPool([stalling], max_failures=5)
+    with patch("services.llm.backend_pool", pool), \
+         patch.object(upstream_http, "inter_token_timeout", 0.1):
+        events = [e async for e in stream_llm_response("Hi", [], AsyncMock())]
+
+    assert events[:2] == [{"content": "t0"}, {"content": "t1"}]
+    assert events[2] == {"error": "stalling stalled for more than 0.1s between tokens"}
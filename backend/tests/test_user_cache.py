@@ -0,0 +1,53 @@
+"""Tests for the authenticated-user resolution cache"""
+import os
+
+os.environ.setdefault("LLM_BASE_URL", "http://localhost:1234/v1")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from unittest.mock import patch
+
+import models
+from security import UserCache
+
+
+def _user(email):
+    return models.User(email=email, hashed_password="x")
+
+
+def test_cache_hit_and_miss_counters():
+    cache = UserCache(ttl_seconds=60, max_entries=10)
+    assert cache.get("a@example.com") is None
+    user = _user("a@example.com")
+    cache.put("a@example.com", user)
+    assert cache.get("a@example.com") is user
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_entries_expire_after_ttl():
+    cache = UserCache(ttl_seconds=10, max_entries=10)
+    with patch("security.time.monotonic", return_value=100.0):
+        cache.put("a@example.com", _user("a@example.com"))
+    with patch("security.time.monotonic", return_value=111.0):
+        assert cache.get("a@example.com") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_cache_evicts_least_recently_used():
+    cache = UserCache(ttl_seconds=60, max_entries=2)
+    cache.put("a@example.com", _user("a@example.com"))
+    cache.put("b@example.com", _user("b@example.com"))
+    cache.get("a@example.com")
+    cache.put("c@example.com", _user("c@example.com"))
+
+    assert cache.get("b@example.com") is None
+    assert cache.get("a@example.com") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_invalidate_removes_entry():
+    cache = UserCache(ttl_seconds=60, max_entries=10)
+    cache.put("a@example.com", _user("a@example.com"))
+    cache.invalidate("a@example.com")
+    assert cache.get("a@example.com") is None
+    assert cache.stats()["invalidations"] == 1
@@ -241,7 +241,10 @@ function App() {
     setPerformanceStatus('loading');
 
     try {
-      const history = messages.map((m) => ({ role: m.role, content: m.content }));
+      // Existing conversations are rebuilt server-side, so only new chats upload history.
+      const history = currentConversationId
+        ? []
+        : messages.map((m) => ({ role: m.role, content: m.content }));
 
       const response = await fetch(`${API_BASE_URL}/chat`, {
         method: 'POST',
@@ -253,6 +256,7 @@ function App() {
           message: text,
           history,
           conversation_id: currentConversationId,
+          server_history: Boolean(currentConversationId),
           top_p: topP,
           temperature,
         }),